@@ -49,7 +49,8 @@ class AbstractBuildSlave(pb.Avatar, service.MultiService):
 
     def __init__(self, name, password, max_builds=None,
                  notify_on_missing=[], missing_timeout=3600,
-                 properties={}, locks=None, keepalive_interval=3600):
+                 properties={}, locks=None, keepalive_interval=3600,
+                 compress_logs=False):
         """
         @param name: botname this machine will supply when it connects
         @param password: password this machine will supply when
@@ -63,6 +64,8 @@ class AbstractBuildSlave(pb.Avatar, service.MultiService):
         @param locks: A list of locks that must be acquired before this slave
                       can be used
         @type locks: dictionary
+        @param compress_logs: if true, ask the slave to compress the output
+                              of its commands, if it supports that
         """
         service.MultiService.__init__(self)
         self.slavename = name
@@ -90,6 +93,7 @@ class AbstractBuildSlave(pb.Avatar, service.MultiService):
         self.missing_timeout = missing_timeout
         self.missing_timer = None
         self.keepalive_interval = keepalive_interval
+        self.compress_logs = compress_logs
 
         self.detached_subs = None
 
@@ -121,6 +125,7 @@ class AbstractBuildSlave(pb.Avatar, service.MultiService):
         self.notify_on_missing = new.notify_on_missing
         self.missing_timeout = new.missing_timeout
         self.keepalive_interval = new.keepalive_interval
+        self.compress_logs = new.compress_logs
 
         self.properties = Properties()
         self.properties.updateFromProperties(new.properties)
@@ -690,10 +695,11 @@ class AbstractLatentBuildSlave(AbstractBuildSlave):
     def __init__(self, name, password, max_builds=None,
                  notify_on_missing=[], missing_timeout=60*20,
                  build_wait_timeout=60*10,
-                 properties={}, locks=None):
+                 properties={}, locks=None, compress_logs=False):
         AbstractBuildSlave.__init__(
             self, name, password, max_builds, notify_on_missing,
-            missing_timeout, properties, locks)
+            missing_timeout, properties, locks,
+            compress_logs=compress_logs)
         self.building = set()
         self.build_wait_timeout = build_wait_timeout
 
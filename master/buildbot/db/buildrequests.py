@@ -89,7 +89,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
     @with_master_objectid
     def getBuildRequests(self, buildername=None, complete=None, claimed=None,
-            bsid=None, _master_objectid=None):
+            bsid=None, after_brid=None, fresh=True, _master_objectid=None):
         """
         Get a list of build requests matching the given characteristics.  Note
         that C{unclaimed}, C{my_claimed}, and C{other_claimed} all default to
@@ -102,16 +102,20 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         builds claimed by this master instance.  A request is considered
         unclaimed if its C{claimed_at} column is either NULL or 0, and it is
         not complete.  If C{bsid} is specified, then only build requests for
-        that buildset will be returned.
+        that buildset will be returned.  If C{after_brid} is specified, then
+        only build requests with a larger id will be returned.
 
         A build is considered completed if its C{complete} column is 1; the
         C{complete_at} column is not consulted.
 
         Since this method is often used to detect changed build requests, it
-        always bypasses the cache.
+        always bypasses the cache.  If C{fresh} is false, it uses the read
+        pool, which may return slightly stale results; only callers that
+        merely display the requests, such as status displays, should do so.
 
-        @param buildername: limit results to buildrequests for this builder
-        @type buildername: string
+        @param buildername: limit results to buildrequests for this builder, or
+        for any of a list of builders
+        @type buildername: string or list of strings
 
         @param complete: if true, limit to completed buildrequests; if false,
         limit to incomplete buildrequests; if None, do not limit based on
@@ -121,6 +125,10 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         @param bsid: see above
 
+        @param after_brid: see above
+
+        @param fresh: if false, query the read pool
+
         @returns: List of build request dictionaries as above, via Deferred
         """
         def thd(conn):
@@ -139,7 +147,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                 else:
                     q = q.where(
                         (claims_tbl.c.claimed_at != None))
-            if buildername is not None:
+            if isinstance(buildername, basestring):
                 q = q.where(reqs_tbl.c.buildername == buildername)
             if complete is not None:
                 if complete:
@@ -148,10 +156,79 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                     q = q.where(reqs_tbl.c.complete == 0)
             if bsid is not None:
                 q = q.where(reqs_tbl.c.buildsetid == bsid)
-            res = conn.execute(q)
+            if after_brid is not None:
+                q = q.where(reqs_tbl.c.id > after_brid)
+
+            if buildername is None or isinstance(buildername, basestring):
+                res = conn.execute(q)
+                return [ self._brdictFromRow(row, _master_objectid)
+                         for row in res.fetchall() ]
+
+            # for a list of builders, we'll need to batch the buildernames
+            # into groups of 100, so that the parameter lists supported by the
+            # DBAPI aren't exhausted
+            rv = []
+            iterator = iter(buildername)
+            while 1:
+                batch = list(itertools.islice(iterator, 100))
+                if not batch:
+                    return rv
+                res = conn.execute(q.where(reqs_tbl.c.buildername.in_(batch)))
+                rv.extend([ self._brdictFromRow(row, _master_objectid)
+                            for row in res.fetchall() ])
+        pool = fresh and self.db.pool or self.db.read_pool
+        return pool.do(thd)
+
+    def getLatestBuildRequestId(self):
+        """
+        Get the most-recently-assigned buildrequest id, or None if there are no
+        build requests at all.
 
-            return [ self._brdictFromRow(row, _master_objectid)
-                     for row in res.fetchall() ]
+        @returns: brid via Deferred
+        """
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            q = sa.select([ sa.func.max(reqs_tbl.c.id) ])
+            return conn.scalar(q)
+        return self.db.pool.do(thd)
+
+    def getMergeKeys(self, brids):
+        """
+        Get the merge key for each of the given build requests.  A merge key
+        is a tuple C{(repository, branch, project)} taken from the request's
+        sourcestamp; requests whose sourcestamps have different merge keys are
+        never compatible (see
+        L{buildbot.sourcestamp.SourceStamp.canBeMergedWith}), although
+        requests with equal merge keys may not be compatible either.
+        Nonexistent build requests are omitted from the result.
+
+        @param brids: build request ids
+        @type brids: list of integers
+
+        @returns: dictionary mapping brid to merge key, via Deferred
+        """
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            bs_tbl = self.db.model.buildsets
+            ss_tbl = self.db.model.sourcestamps
+            q = sa.select([ reqs_tbl.c.id, ss_tbl.c.repository,
+                            ss_tbl.c.branch, ss_tbl.c.project ],
+                    from_obj=[ reqs_tbl.join(bs_tbl,
+                                   reqs_tbl.c.buildsetid == bs_tbl.c.id)
+                               .join(ss_tbl,
+                                   bs_tbl.c.sourcestampid == ss_tbl.c.id) ])
+
+            # batch the brids into groups of 100, so that the parameter lists
+            # supported by the DBAPI aren't exhausted
+            rv = {}
+            iterator = iter(brids)
+            while 1:
+                batch = list(itertools.islice(iterator, 100))
+                if not batch:
+                    return rv
+                res = conn.execute(q.where(reqs_tbl.c.id.in_(batch)))
+                for row in res.fetchall():
+                    rv[row.id] = (row.repository, row.branch, row.project)
         return self.db.pool.do(thd)
 
     @with_master_objectid
@@ -200,6 +277,78 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         return self.db.pool.do(thd)
 
+    # number of times claimAnyBuildRequests will retry when another master
+    # claims some of the requests while it is working
+    CLAIM_ANY_ATTEMPTS = 3
+
+    @with_master_objectid
+    def claimAnyBuildRequests(self, brids, _reactor=reactor,
+                            _master_objectid=None):
+        """
+        Try to claim as many as possible of the indicated build requests for
+        this buildmaster instance.  Unlike L{claimBuildRequests}, this method
+        does not fail if some of the requests are already claimed; those
+        requests are simply omitted from the result.  The claims that are made
+        are made in a single transaction.
+
+        Like L{claimBuildRequests}, this method cannot be used to re-claim build
+        requests, and does not prevent claims for nonexistent build requests on
+        database backends that do not enforce referential integrity.
+
+        @param brids: ids of buildrequests to claim
+        @type brids: list
+
+        @param _reactor: reactor to use (for testing)
+
+        @returns: list of the brids actually claimed, via Deferred
+        """
+
+        def thd(conn):
+            tbl = self.db.model.buildrequest_claims
+            claimed_at = _reactor.seconds()
+
+            for attempt in range(self.CLAIM_ANY_ATTEMPTS):
+                transaction = conn.begin()
+
+                # find the requests that are already claimed, batching the
+                # brids into groups of 100, so that the parameter lists
+                # supported by the DBAPI aren't exhausted
+                already_claimed = set()
+                iterator = iter(brids)
+                while 1:
+                    batch = list(itertools.islice(iterator, 100))
+                    if not batch:
+                        break
+                    res = conn.execute(sa.select([ tbl.c.brid ],
+                                        tbl.c.brid.in_(batch)))
+                    already_claimed.update([ row.brid
+                                             for row in res.fetchall() ])
+
+                to_claim = [ id for id in brids if id not in already_claimed ]
+                if not to_claim:
+                    transaction.commit()
+                    return []
+
+                try:
+                    conn.execute(tbl.insert(),
+                            [ dict(brid=id, objectid=_master_objectid,
+                                   claimed_at=claimed_at)
+                              for id in to_claim ])
+                except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+                    # another master claimed some of these in the meantime;
+                    # look again
+                    transaction.rollback()
+                    continue
+
+                transaction.commit()
+                return to_claim
+
+            log.msg("could not claim any of %d build requests after %d "
+                    "attempts" % (len(brids), self.CLAIM_ANY_ATTEMPTS))
+            return []
+
+        return self.db.pool.do(thd)
+
     @with_master_objectid
     def reclaimBuildRequests(self, brids, _reactor=reactor,
                             _master_objectid=None):
@@ -352,7 +501,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         @param _reactor: for testing
 
-        @returns: Deferred
+        @returns: number of unclaimed requests, via Deferred
         """
         def thd(conn):
             reqs_tbl = self.db.model.buildrequests
@@ -371,6 +520,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             if count != 0:
                 log.msg("unclaimed %d expired buildrequests (over %d seconds "
                         "old)" % (count, old))
+            return count
         d.addCallback(log_nonzero_count)
         return d
 
@@ -161,18 +161,21 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
             return self._row2dict(row)
         return self.db.pool.do(thd)
 
-    def getBuildsets(self, complete=None):
+    def getBuildsets(self, complete=None, fresh=True):
         """
         Get a list of buildset dictionaries (see L{getBuildset}) matching
         the given criteria.
 
         Since this method is often used to detect changed build requests, it
-        always bypasses the cache.
+        always bypasses the cache.  It uses the read pool, which may return
+        slightly stale results, if C{fresh} is false.
 
         @param complete: if True, return only complete buildsets; if False,
         return only incomplete buildsets; if None or omitted, return all
         buildsets
 
+        @param fresh: if false, query the read pool
+
         @returns: list of dictionaries, via Deferred
         """
         def thd(conn):
@@ -186,7 +189,8 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
                                 (bs_tbl.c.complete == None))
             res = conn.execute(q)
             return [ self._row2dict(row) for row in res.fetchall() ]
-        return self.db.pool.do(thd)
+        pool = fresh and self.db.pool or self.db.read_pool
+        return pool.do(thd)
 
     def getBuildsetProperties(self, buildsetid):
         """
@@ -17,6 +17,7 @@
 Support for changes in the database
 """
 
+import itertools
 from buildbot.util import json
 import sqlalchemy as sa
 from twisted.internet import defer, reactor
@@ -194,13 +195,75 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
         d = self.db.pool.do(thd)
         return d
 
-    def getRecentChanges(self, count):
+    def getChanges(self, changeids):
+        """
+        Get change dictionaries for each of the given changeids.  Changes that
+        are not already cached are fetched in a constant number of queries,
+        in a single database thread, and added to the C{chdicts} cache.
+
+        @param changeids: ids of the changes to fetch
+        @type changeids: list of integers
+
+        @returns: list of change dictionaries (or None for changes that do not
+        exist), in the same order as C{changeids}, via Deferred
+        """
+        changeids = list(changeids)
+        cache = self.getChange.cache
+        missing = set([ changeid for changeid in changeids
+                        if not cache.contains(changeid) ])
+
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            rows = []
+
+            # batch the changeids into groups of 100, so that the parameter
+            # lists supported by the DBAPI aren't exhausted
+            iterator = iter(sorted(missing))
+            while 1:
+                batch = list(itertools.islice(iterator, 100))
+                if not batch:
+                    break
+                q = changes_tbl.select(
+                        whereclause=(changes_tbl.c.changeid.in_(batch)))
+                rows.extend(conn.execute(q).fetchall())
+
+            return self._chdicts_from_change_rows_thd(conn, rows)
+
+        if missing:
+            d = self.db.pool.do(thd)
+        else:
+            d = defer.succeed({})
+
+        def collect(fetched):
+            # get the already-cached changes before adding the fetched ones,
+            # which may push them out of the cache
+            dl = []
+            for changeid in changeids:
+                if changeid in fetched:
+                    dl.append(defer.succeed(fetched[changeid]))
+                elif changeid in missing:
+                    dl.append(defer.succeed(None))
+                else:
+                    dl.append(self.getChange(changeid))
+
+            for changeid, chdict in fetched.iteritems():
+                cache.add(changeid, chdict)
+            return defer.gatherResults(dl)
+        d.addCallback(collect)
+        return d
+
+    def getRecentChanges(self, count, fresh=True):
         """
         Get a list of the C{count} most recent changes, represented as
         dictionaies; returns fewer if that many do not exist.
 
+        This query uses the read pool, which may return slightly stale
+        results, if C{fresh} is false.
+
         @param count: maximum number of instances to return
 
+        @param fresh: if false, query the read pool
+
         @returns: list of dictionaries via Deferred, ordered by changeid
         """
         def thd(conn):
@@ -213,15 +276,35 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             changeids = [ row.changeid for row in rp ]
             rp.close()
             return list(reversed(changeids))
-        d = self.db.pool.do(thd)
+        pool = fresh and self.db.pool or self.db.read_pool
+        d = pool.do(thd)
 
         # then turn those into changes, using the cache
-        def get_changes(changeids):
-            return defer.gatherResults([ self.getChange(changeid)
-                                         for changeid in changeids ])
-        d.addCallback(get_changes)
+        d.addCallback(self.getChanges)
         return d
 
+    def getChangeidsAfter(self, changeid, count=None):
+        """
+        Get the ids of the changes following the given changeid, in ascending
+        order.
+
+        @param changeid: return only changeids greater than this value
+        @param count: maximum number of changeids to return, or None for all
+
+        @returns: list of changeids via Deferred
+        """
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            q = sa.select([changes_tbl.c.changeid],
+                    whereclause=(changes_tbl.c.changeid > changeid),
+                    order_by=[changes_tbl.c.changeid],
+                    limit=count)
+            rp = conn.execute(q)
+            changeids = [ row.changeid for row in rp ]
+            rp.close()
+            return changeids
+        return self.db.pool.do(thd)
+
     def getLatestChangeid(self):
         """
         Get the most-recently-assigned changeid, or None if there are no
@@ -269,6 +352,14 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
     def _chdict_from_change_row_thd(self, conn, ch_row):
         # This method must be run in a db.pool thread, and returns a chdict
         # given a row from the 'changes' table
+        return self._chdicts_from_change_rows_thd(conn,
+                                            [ ch_row ])[ch_row.changeid]
+
+    def _chdicts_from_change_rows_thd(self, conn, ch_rows):
+        # This method must be run in a db.pool thread, and returns a dictionary
+        # mapping changeid to chdict given a list of rows from the 'changes'
+        # table.  The ancillary data is fetched with one query per table for
+        # each batch of 100 changes.
         change_links_tbl = self.db.model.change_links
         change_files_tbl = self.db.model.change_files
         change_properties_tbl = self.db.model.change_properties
@@ -277,7 +368,9 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             if epoch:
                 return epoch2datetime(epoch)
 
-        chdict = ChDict(
+        chdicts = {}
+        for ch_row in ch_rows:
+            chdicts[ch_row.changeid] = ChDict(
                 changeid=ch_row.changeid,
                 author=ch_row.author,
                 files=[], # see below
@@ -293,18 +386,6 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 repository=ch_row.repository,
                 project=ch_row.project)
 
-        query = change_links_tbl.select(
-                whereclause=(change_links_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            chdict['links'].append(r.link)
-
-        query = change_files_tbl.select(
-                whereclause=(change_files_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            chdict['files'].append(r.filename)
-
         # and properties must be given without a source, so strip that, but
         # be flexible in case users have used a development version where the
         # change properties were recorded incorrectly
@@ -317,11 +398,29 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 v,s = vs, "Change"
             return v, s
 
-        query = change_properties_tbl.select(
-                whereclause=(change_properties_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            v, s = split_vs(json.loads(r.property_value))
-            chdict['properties'][r.property_name] = (v,s)
-
-        return chdict
+        iterator = iter(sorted(chdicts))
+        while 1:
+            batch = list(itertools.islice(iterator, 100))
+            if not batch:
+                break
+
+            query = change_links_tbl.select(
+                    whereclause=(change_links_tbl.c.changeid.in_(batch)))
+            rows = conn.execute(query)
+            for r in rows:
+                chdicts[r.changeid]['links'].append(r.link)
+
+            query = change_files_tbl.select(
+                    whereclause=(change_files_tbl.c.changeid.in_(batch)))
+            rows = conn.execute(query)
+            for r in rows:
+                chdicts[r.changeid]['files'].append(r.filename)
+
+            query = change_properties_tbl.select(
+                    whereclause=(change_properties_tbl.c.changeid.in_(batch)))
+            rows = conn.execute(query)
+            for r in rows:
+                v, s = split_vs(json.loads(r.property_value))
+                chdicts[r.changeid]['properties'][r.property_name] = (v,s)
+
+        return chdicts
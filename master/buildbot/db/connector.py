@@ -28,13 +28,19 @@ class DBConnector(service.MultiService):
     Most of the interesting operations available via the connector are
     implemented in connector components, available as attributes of this
     object, and listed below.
+
+    Queries run in C{pool}.  Read-only queries that opt in because they can
+    tolerate slightly stale data, such as those made by status displays, run
+    in C{read_pool},
+    which uses a separate database (e.g., a replica) if C{db_read_url} is
+    given, and is the same as C{pool} otherwise.
     """
 
     # Period, in seconds, of the cleanup task.  This master will perform
     # periodic cleanup actions on this schedule.
     CLEANUP_PERIOD = 3600
 
-    def __init__(self, master, db_url, basedir):
+    def __init__(self, master, db_url, basedir, db_read_url=None):
         service.MultiService.__init__(self)
         self.master = master
         self.basedir = basedir
@@ -42,6 +48,13 @@ class DBConnector(service.MultiService):
         self._engine = enginestrategy.create_engine(db_url, basedir=self.basedir)
         self.pool = pool.DBThreadPool(self._engine)
 
+        if db_read_url:
+            self._read_engine = enginestrategy.create_engine(db_read_url,
+                                                    basedir=self.basedir)
+            self.read_pool = pool.DBThreadPool(self._read_engine)
+        else:
+            self.read_pool = self.pool
+
         # set up components
         self.model = model.Model(self)
         self.changes = changes.ChangesConnectorComponent(self)
@@ -136,14 +136,36 @@ class BuildbotEngineStrategy(strategies.ThreadLocalEngineStrategy):
 
         return u, kwargs, None
 
+    def get_thread_pool_args(self, u):
+        """Take thread_pool_min, thread_pool_max, and thread_pool_adaptive out
+        of the query arguments; these control the L{DBThreadPool} rather than
+        the database connection.  Returns the url and a dictionary of the
+        values given, which is empty if none were given."""
+        args = {}
+        for arg in ('thread_pool_min', 'thread_pool_max'):
+            if arg in u.query:
+                try:
+                    args[arg] = int(u.query.pop(arg))
+                except ValueError:
+                    raise TypeError("%s must be an integer" % arg)
+                if args[arg] < 1:
+                    raise TypeError("%s must be at least 1" % arg)
+        if 'thread_pool_adaptive' in u.query:
+            args['thread_pool_adaptive'] = \
+                u.query.pop('thread_pool_adaptive').lower() \
+                        not in ('0', 'false', 'no')
+        return u, args
+
     def create(self, name_or_url, **kwargs):
         if 'basedir' not in kwargs:
             raise TypeError('no basedir supplied to create_engine')
 
         max_conns = None
 
-        # apply special cases
         u = url.make_url(name_or_url)
+        u, thread_pool_args = self.get_thread_pool_args(u)
+
+        # apply special cases
         if u.drivername.startswith('sqlite'):
             u, kwargs, max_conns = self.special_case_sqlite(u, kwargs)
         elif u.drivername.startswith('mysql'):
@@ -160,9 +182,18 @@ class BuildbotEngineStrategy(strategies.ThreadLocalEngineStrategy):
         engine = strategies.ThreadLocalEngineStrategy.create(self,
                                             u, **kwargs)
 
+        # the thread pool can be made smaller, but there's no sense in having
+        # more threads than connections
+        if 'thread_pool_max' in thread_pool_args:
+            max_conns = min(max_conns, thread_pool_args['thread_pool_max'])
+
         # annotate the engine with the optimal thread pool size; this is used
         # by DBConnector to configure the surrounding thread pool
         engine.optimal_thread_pool_size = max_conns
+        engine.min_thread_pool_size = min(max_conns,
+                            thread_pool_args.get('thread_pool_min', 1))
+        engine.adaptive_thread_pool = \
+                thread_pool_args.get('thread_pool_adaptive', False)
 
         # keep the basedir
         engine.buildbot_basedir = basedir
@@ -13,6 +13,7 @@
 #
 # Copyright Buildbot Team Members
 
+import sys
 import time
 import traceback
 import shutil
@@ -22,6 +23,7 @@ import twisted
 import tempfile
 from twisted.internet import reactor, threads, defer
 from twisted.python import threadpool, failure, versions, log
+from buildbot.process import metrics
 
 # set this to True for *very* verbose query debugging output; this can
 # be monkey-patched from master.cfg, too:
@@ -52,6 +54,25 @@ def timed_do_fn(f):
     wrap.__doc__ = f.__doc__
     return wrap
 
+def caller_name():
+    """Return a short name for the innermost calling function outside of this
+    module, such as C{buildrequests.getBuildRequests}.  This is much cheaper
+    than extracting a traceback."""
+    frame = sys._getframe(1)
+    while frame.f_back and frame.f_globals is globals():
+        frame = frame.f_back
+    module = frame.f_globals.get('__name__', '?').rsplit('.', 1)[-1]
+    return "%s.%s" % (module, frame.f_code.co_name)
+
+def count_rows(result):
+    """Estimate the number of rows represented by the result of a query.  A
+    dictionary, such as a change or build request dictionary, is one row."""
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple, set)):
+        return len(result)
+    return 1
+
 class DBThreadPool(threadpool.ThreadPool):
     """
     A pool of threads ready and waiting to execute queries.
@@ -59,11 +80,30 @@ class DBThreadPool(threadpool.ThreadPool):
     If the engine has an C{optimal_thread_pool_size} attribute, then the
     maxthreads of the thread pool will be set to that value.  This is most
     useful for SQLite in-memory connections, where exactly one connection
-    (and thus thread) should be used.
+    (and thus thread) should be used.  Similarly, C{min_thread_pool_size}
+    sets the minthreads of the pool.
+
+    If the engine has a true C{adaptive_thread_pool} attribute, then the pool
+    starts with at most minthreads threads, and adds or removes threads within
+    those bounds depending on how long queries wait for a thread.
+
+    The time each query spends waiting for a thread and executing is reported
+    as the C{DBThreadPool.wait} and C{DBThreadPool.execute} metrics, and the
+    number of waiting queries as the C{DBThreadPool.queue_depth} metric.  Each
+    query is also reported as a L{metrics.MetricQueryEvent}, named for the
+    method that called L{do} or L{do_with_engine}, so that the cost of each
+    kind of query can be profiled.
     """
 
     running = False
 
+    # adaptive sizing parameters: after every ADAPT_INTERVAL queries, add a
+    # thread if the average wait was more than ADAPT_GROW_WAIT seconds, or
+    # remove one if it was less than ADAPT_SHRINK_WAIT seconds
+    ADAPT_INTERVAL = 20
+    ADAPT_GROW_WAIT = 0.05
+    ADAPT_SHRINK_WAIT = 0.005
+
     # Some versions of SQLite incorrectly cache metadata about which tables are
     # and are not present on a per-connection basis.  This cache can be flushed
     # by querying the sqlite_master table.  We currently assume all versions of
@@ -76,9 +116,14 @@ class DBThreadPool(threadpool.ThreadPool):
         pool_size = 5
         if hasattr(engine, 'optimal_thread_pool_size'):
             pool_size = engine.optimal_thread_pool_size
+        min_size = min(getattr(engine, 'min_thread_pool_size', 1), pool_size)
+        self.max_pool_size = pool_size
+        self.adaptive = getattr(engine, 'adaptive_thread_pool', False)
+        self._adapt_count = 0
+        self._adapt_wait = 0.0
         threadpool.ThreadPool.__init__(self,
-                        minthreads=1,
-                        maxthreads=pool_size,
+                        minthreads=min_size,
+                        maxthreads=self.adaptive and min_size or pool_size,
                         name='DBThreadPool')
         self.engine = engine
         if engine.dialect.name == 'sqlite':
@@ -139,7 +184,7 @@ class DBThreadPool(threadpool.ThreadPool):
             finally:
                 conn.close()
             return rv
-        return threads.deferToThreadPool(reactor, self, thd)
+        return self._deferTimed(thd, caller_name())
 
     def do_with_engine(self, callable, *args, **kwargs):
         """
@@ -154,7 +199,60 @@ class DBThreadPool(threadpool.ThreadPool):
             assert not isinstance(rv, sa.engine.ResultProxy), \
                     "do not return ResultProxy objects!"
             return rv
-        return threads.deferToThreadPool(reactor, self, thd)
+        return self._deferTimed(thd, caller_name())
+
+    def _deferTimed(self, thd, query):
+        # run thd in the pool, noting when it was queued, started, and
+        # finished, and report the timings once it is done
+        timing = [ time.time() ]
+        def timed_thd():
+            timing.append(time.time())
+            try:
+                return thd()
+            finally:
+                timing.append(time.time())
+        metrics.MetricCountEvent.log('DBThreadPool.queue_depth',
+                                     self.q.qsize(), absolute=True)
+        d = threads.deferToThreadPool(reactor, self, timed_thd)
+        def report(res):
+            if len(timing) == 3:
+                queued_at, started_at, finished_at = timing
+                if isinstance(res, failure.Failure):
+                    rows = 0
+                else:
+                    rows = count_rows(res)
+                self._reportTiming(started_at - queued_at,
+                                   finished_at - started_at, query, rows)
+            return res
+        d.addBoth(report)
+        return d
+
+    def _reportTiming(self, wait, execute, query=None, rows=0):
+        metrics.MetricTimeEvent.log('DBThreadPool.wait', wait)
+        metrics.MetricTimeEvent.log('DBThreadPool.execute', execute)
+        if query:
+            metrics.MetricQueryEvent.log(query, execute, rows)
+        if self.adaptive:
+            self._adapt(wait)
+
+    def _adapt(self, wait):
+        self._adapt_count += 1
+        self._adapt_wait += wait
+        if self._adapt_count < self.ADAPT_INTERVAL:
+            return
+
+        avg_wait = self._adapt_wait / self._adapt_count
+        self._adapt_count = 0
+        self._adapt_wait = 0.0
+
+        if avg_wait > self.ADAPT_GROW_WAIT and self.max < self.max_pool_size:
+            self.adjustPoolsize(maxthreads=self.max + 1)
+        elif avg_wait < self.ADAPT_SHRINK_WAIT and self.max > self.min:
+            self.adjustPoolsize(maxthreads=self.max - 1)
+        else:
+            return
+        metrics.MetricCountEvent.log('DBThreadPool.maxthreads', self.max,
+                                     absolute=True)
 
     # older implementations for twisted < 0.8.2, which does not have
     # deferToThreadPool; this basically re-implements it, although it gets some
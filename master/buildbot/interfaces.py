@@ -159,7 +159,7 @@ class IStatus(Interface):
 
     def generateFinishedBuilds(builders=[], branches=[],
                                num_builds=None, finished_before=None,
-                               max_search=200):
+                               results=None, max_search=200):
         """Return a generator that will produce IBuildStatus objects each
         time you invoke its .next() method, starting with the most recent
         finished build and working backwards.
@@ -182,6 +182,10 @@ class IStatus(Interface):
         @param finished_before: if provided, do not produce any builds that
                                 finished after the given timestamp.
 
+        @type results: list of result codes
+        @param results: if provided, only produce builds whose result is in
+                        this list.
+
         @type max_search: int
         @param max_search: this method may have to examine a lot of builds
                            to find some that match the search parameters,
@@ -354,15 +358,28 @@ class IBuilderStatus(Interface):
         longer available. Older builds are likely to have less information
         stored: Logs are the first to go, then Steps."""
 
+    def getBuildAsync(number):
+        """Like getBuild, but returns a Deferred. Builds that are not in
+        memory are loaded without blocking the master."""
+
     def getEvent(number):
         """Return an IStatusEvent object for a recent Event. Builders
         connecting and disconnecting are events, as are ping attempts.
         getEvent(-1) will return the most recent event. Events are numbered,
         but it probably doesn't make sense to ever do getEvent(+n)."""
 
+    def getBuildSummary(number):
+        """Return a summary of a finished build, taken from the builder's
+        build index so that the build itself need not be loaded. The summary
+        is a dictionary with keys 'number', 'start', 'end', 'results',
+        'branch', 'revision', 'slavename', 'blamelist' and 'committers'.
+        Negative numbers are handled as for getBuild. Returns None if the
+        build does not exist or has not finished."""
+
     def generateFinishedBuilds(branches=[],
                                num_builds=None,
                                max_buildnum=None, finished_before=None,
+                               results=None,
                                max_search=200,
                                ):
         """Return a generator that will produce IBuildStatus objects each
@@ -394,6 +411,10 @@ class IBuilderStatus(Interface):
         @param finished_before: if provided, do not produce any builds that
                                 finished after the given timestamp.
 
+        @type results: list of result codes
+        @param results: if provided, only produce builds whose result is in
+                        this list.
+
         @type max_search: int
         @param max_search: this method may have to examine a lot of builds
                            to find some that match the search parameters,
@@ -801,10 +822,11 @@ class IStatusLog(Interface):
         """Return one big string with the contents of the Log. This merges
         all non-header chunks together."""
 
-    def readlines(channel=LOG_CHANNEL_STDOUT):
-        """Read lines from one channel of the logfile. This returns an
-        iterator that will provide single lines of text (including the
-        trailing newline).
+    def readlines(channel=LOG_CHANNEL_STDOUT, channels=None):
+        """Read lines from one channel of the logfile, or from the list of
+        channels given as 'channels'. This returns an iterator that will
+        provide single lines of text (including the trailing newline), read
+        from the log as they are needed.
         """
 
     def getTextWithHeaders():
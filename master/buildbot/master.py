@@ -80,6 +80,14 @@ class BuildMaster(service.MultiService):
     # database poll operation.
     WARNING_UNCLAIMED_COUNT = 10000
 
+    # number of changes fetched from the database at once while catching up
+    # on new changes in pollDatabaseChanges
+    CHANGE_POLL_WINDOW = 100
+
+    # number of changes delivered between writes of the last_processed_change
+    # state while catching up
+    CHANGE_CHECKPOINT_INTERVAL = 100
+
     def __init__(self, basedir, configFileName="master.cfg"):
         service.MultiService.__init__(self)
         self.setName("buildmaster")
@@ -116,6 +124,8 @@ class BuildMaster(service.MultiService):
         self.db = None
         self.db_url = None
         self.db_poll_interval = _Unset
+        self.db_read_url = _Unset
+        self.db_poll_reconcile_interval = None
 
         self.metrics = None
 
@@ -240,7 +250,10 @@ class BuildMaster(service.MultiService):
                           "eventHorizon", "buildCacheSize", "changeCacheSize",
                           "logHorizon", "buildHorizon", "changeHorizon",
                           "logMaxSize", "logMaxTailSize", "logCompressionMethod",
-                          "db_url", "multiMaster", "db_poll_interval",
+                          "buildStatusFormat",
+                          "db_url", "db_read_url", "multiMaster",
+                          "db_poll_interval",
+                          "db_poll_reconcile_interval", "buildStartConcurrency",
                           "metrics", "caches"
                           )
             for k in config.keys():
@@ -259,7 +272,10 @@ class BuildMaster(service.MultiService):
 
                 # optional
                 db_url = config.get("db_url", "sqlite:///state.sqlite")
+                db_read_url = config.get("db_read_url", None)
                 db_poll_interval = config.get("db_poll_interval", None)
+                db_poll_reconcile_interval = config.get(
+                                        "db_poll_reconcile_interval", None)
                 debugPassword = config.get('debugPassword')
                 manhole = config.get('manhole')
                 status = config.get('status', [])
@@ -281,6 +297,9 @@ class BuildMaster(service.MultiService):
                 logCompressionMethod = config.get('logCompressionMethod', "bz2")
                 if logCompressionMethod not in ('bz2', 'gz'):
                     raise ValueError("logCompressionMethod needs to be 'bz2', or 'gz'")
+                buildStatusFormat = config.get('buildStatusFormat', "pickle")
+                if buildStatusFormat not in ('pickle', 'records'):
+                    raise ValueError("buildStatusFormat needs to be 'pickle' or 'records'")
                 logMaxSize = config.get('logMaxSize')
                 if logMaxSize is not None and not \
                         isinstance(logMaxSize, int):
@@ -296,6 +315,10 @@ class BuildMaster(service.MultiService):
                 prioritizeBuilders = config.get('prioritizeBuilders')
                 if prioritizeBuilders is not None and not callable(prioritizeBuilders):
                     raise ValueError("prioritizeBuilders must be callable")
+                buildStartConcurrency = config.get('buildStartConcurrency', 1)
+                if (not isinstance(buildStartConcurrency, int)
+                            or buildStartConcurrency < 1):
+                    raise ValueError("buildStartConcurrency must be a positive int")
                 changeHorizon = config.get("changeHorizon")
                 if changeHorizon is not None and not isinstance(changeHorizon, int):
                     raise ValueError("changeHorizon needs to be an int")
@@ -366,10 +389,17 @@ class BuildMaster(service.MultiService):
                 raise KeyError("c['interlocks'] is no longer accepted")
             assert self.db_url is None or db_url == self.db_url, \
                     "Cannot change db_url after master has started"
+            assert (self.db_read_url is _Unset
+                    or db_read_url == self.db_read_url), \
+                    "Cannot change db_read_url after master has started"
             assert db_poll_interval is None or isinstance(db_poll_interval, int), \
                    "db_poll_interval must be an integer: seconds between polls"
             assert self.db_poll_interval is _Unset or db_poll_interval == self.db_poll_interval, \
                    "Cannot change db_poll_interval after master has started"
+            assert (db_poll_reconcile_interval is None
+                    or isinstance(db_poll_reconcile_interval, int)), \
+                   "db_poll_reconcile_interval must be an integer: seconds " \
+                   "between full polls of unclaimed build requests"
 
             assert isinstance(change_sources, (list, tuple))
             for s in change_sources:
@@ -499,6 +529,7 @@ class BuildMaster(service.MultiService):
 
             self.status.logCompressionLimit = logCompressionLimit
             self.status.logCompressionMethod = logCompressionMethod
+            self.status.buildStatusFormat = buildStatusFormat
             self.status.logMaxSize = logMaxSize
             self.status.logMaxTailSize = logMaxTailSize
             # Update any of our existing builders with the current log parameters.
@@ -507,6 +538,7 @@ class BuildMaster(service.MultiService):
             for builder in self.botmaster.builders.values():
                 builder.builder_status.setLogCompressionLimit(logCompressionLimit)
                 builder.builder_status.setLogCompressionMethod(logCompressionMethod)
+                builder.builder_status.setBuildStatusFormat(buildStatusFormat)
                 builder.builder_status.setLogMaxSize(logMaxSize)
                 builder.builder_status.setLogMaxTailSize(logMaxTailSize)
 
@@ -514,17 +546,20 @@ class BuildMaster(service.MultiService):
                 self.botmaster.mergeRequests = mergeRequests
             if prioritizeBuilders is not None:
                 self.botmaster.prioritizeBuilders = prioritizeBuilders
+            self.botmaster.brd.concurrency = buildStartConcurrency
 
             self.buildCacheSize = buildCacheSize
             self.changeCacheSize = changeCacheSize
             self.eventHorizon = eventHorizon
             self.logHorizon = logHorizon
             self.buildHorizon = buildHorizon
+            self.db_poll_reconcile_interval = db_poll_reconcile_interval
             self.slavePortnum = slavePortnum # TODO: move this to master.config.slavePortnum
 
             # Set up the database
             d.addCallback(lambda res:
-                          self.loadConfig_Database(db_url, db_poll_interval))
+                          self.loadConfig_Database(db_url, db_poll_interval,
+                                                   db_read_url))
 
             # set up slaves
             d.addCallback(lambda res: self.loadConfig_Slaves(slaves))
@@ -593,11 +628,12 @@ class BuildMaster(service.MultiService):
             caches_config['changes'] = changeCacheSize
         self.caches.load_config(caches_config)
 
-    def loadDatabase(self, db_url, db_poll_interval=None):
+    def loadDatabase(self, db_url, db_poll_interval=None, db_read_url=None):
         if self.db:
             return
 
-        self.db = connector.DBConnector(self, db_url, self.basedir)
+        self.db = connector.DBConnector(self, db_url, self.basedir,
+                                        db_read_url=db_read_url)
         self.db.setServiceParent(self)
 
         # make sure it's up to date
@@ -634,10 +670,11 @@ class BuildMaster(service.MultiService):
         d.addCallback(set_up_db_dependents)
         return d
 
-    def loadConfig_Database(self, db_url, db_poll_interval):
+    def loadConfig_Database(self, db_url, db_poll_interval, db_read_url=None):
         self.db_url = db_url
         self.db_poll_interval = db_poll_interval
-        return self.loadDatabase(db_url, db_poll_interval)
+        self.db_read_url = db_read_url
+        return self.loadDatabase(db_url, db_poll_interval, db_read_url)
 
     def loadConfig_Slaves(self, new_slaves):
         return self.botmaster.loadConfig_Slaves(new_slaves)
@@ -1139,27 +1176,63 @@ class BuildMaster(service.MultiService):
             timer.stop()
             return
 
+        # fetch the new changes a window at a time, delivering only the run of
+        # consecutive changeids following the last processed change; a gap
+        # may be a change whose transaction has not yet committed, so stop
+        # there and pick it up on the next poll.
+        since_checkpoint = 0
         while True:
-            changeid = self._last_processed_change + 1
             wfd = defer.waitForDeferred(
-                self.db.changes.getChange(changeid))
+                self.db.changes.getChangeidsAfter(
+                    self._last_processed_change,
+                    count=self.CHANGE_POLL_WINDOW))
             yield wfd
-            chdict = wfd.getResult()
+            changeids = wfd.getResult()
 
-            # if there's no such change, we've reached the end and can
+            consecutive = []
+            expected = self._last_processed_change + 1
+            for changeid in changeids:
+                if changeid != expected:
+                    break
+                consecutive.append(changeid)
+                expected += 1
+
+            # if there's no next change, we've reached the end and can
             # stop polling
-            if not chdict:
+            if not consecutive:
                 break
 
             wfd = defer.waitForDeferred(
-                changes.Change.fromChdict(self, chdict))
+                self.db.changes.getChanges(consecutive))
+            yield wfd
+            chdicts = [ chd for chd in wfd.getResult() if chd ]
+
+            wfd = defer.waitForDeferred(
+                defer.gatherResults([ changes.Change.fromChdict(self, chdict)
+                                      for chdict in chdicts ]))
             yield wfd
-            change = wfd.getResult()
+            new_changes = wfd.getResult()
 
-            self._change_subs.deliver(change)
+            for change in new_changes:
+                self._change_subs.deliver(change)
 
-            self._last_processed_change = changeid
-            need_setState = True
+                self._last_processed_change = change.number
+                need_setState = True
+
+                since_checkpoint += 1
+                if since_checkpoint >= self.CHANGE_CHECKPOINT_INTERVAL:
+                    wfd = defer.waitForDeferred(
+                        self._setState('last_processed_change',
+                                       self._last_processed_change))
+                    yield wfd
+                    wfd.getResult()
+                    since_checkpoint = 0
+                    need_setState = False
+
+            # a short window or a gap means we've caught up
+            if (len(new_changes) < len(changeids)
+                    or len(changeids) < self.CHANGE_POLL_WINDOW):
+                break
 
         # write back the updated state, if it's changed
         if need_setState:
@@ -1172,6 +1245,8 @@ class BuildMaster(service.MultiService):
 
     _last_unclaimed_brids_set = None
     _last_claim_cleanup = 0
+    _last_seen_brid = None
+    _last_buildrequest_reconcile = 0
     @defer.deferredGenerator
     def pollDatabaseBuildRequests(self):
         # deal with cleaning up unclaimed requests, and (if necessary)
@@ -1179,15 +1254,27 @@ class BuildMaster(service.MultiService):
         timer = metrics.Timer("BuildMaster.pollDatabaseBuildRequests()")
         timer.start()
 
+        # unless db_poll_reconcile_interval is set, every poll reloads all
+        # unclaimed requests.  Otherwise, only requests newer than those
+        # already seen are loaded, with a full reconciliation on the first
+        # poll, periodically thereafter, and whenever claims have expired.
+        now = reactor.seconds()
+        reconcile = (not self.db_poll_reconcile_interval
+                     or self._last_unclaimed_brids_set is None
+                     or self._last_seen_brid is None
+                     or now - self._last_buildrequest_reconcile
+                            >= self.db_poll_reconcile_interval)
+
         # cleanup unclaimed builds
-        since_last_cleanup = reactor.seconds() - self._last_claim_cleanup 
+        since_last_cleanup = now - self._last_claim_cleanup
         if since_last_cleanup < self.RECLAIM_BUILD_INTERVAL:
             unclaimed_age = (self.RECLAIM_BUILD_INTERVAL
                            * self.UNCLAIMED_BUILD_FACTOR)
             wfd = defer.waitForDeferred(
                 self.db.buildrequests.unclaimExpiredRequests(unclaimed_age))
             yield wfd
-            wfd.getResult()
+            if wfd.getResult():
+                reconcile = True
 
             self._last_claim_cleanup = reactor.seconds()
 
@@ -1196,6 +1283,12 @@ class BuildMaster(service.MultiService):
         # the last poll, it notifies the subscribers.  It only tracks that
         # state within the master instance, though; on startup, it notifies for
         # all unclaimed requests in the database.
+        #
+        # Between reconciliations, only requests newer than _last_seen_brid
+        # are fetched, and they are added to that set; requests that have
+        # since been claimed or completed are only removed from it at the
+        # next reconciliation, so that a poll does not depend on the size of
+        # the backlog.
 
         last_unclaimed = self._last_unclaimed_brids_set or set()
         if len(last_unclaimed) > self.WARNING_UNCLAIMED_COUNT:
@@ -1203,21 +1296,51 @@ class BuildMaster(service.MultiService):
                     "producing builds for which no builder is running?"
                     % len(last_unclaimed))
 
-        # get the current set of unclaimed buildrequests
-        wfd = defer.waitForDeferred(
-            self.db.buildrequests.getBuildRequests(claimed=False))
+        # note the latest brid *before* fetching, so that requests added
+        # in the interim are picked up by the next poll
+        if self.db_poll_reconcile_interval:
+            wfd = defer.waitForDeferred(
+                self.db.buildrequests.getLatestBuildRequestId())
+            yield wfd
+            latest_brid = wfd.getResult() or 0
+
+        # get the current set of unclaimed buildrequests, or just the new ones
+        if reconcile:
+            wfd = defer.waitForDeferred(
+                self.db.buildrequests.getBuildRequests(claimed=False))
+        else:
+            wfd = defer.waitForDeferred(
+                self.db.buildrequests.getBuildRequests(claimed=False,
+                                        after_brid=self._last_seen_brid))
         yield wfd
         now_unclaimed_brdicts = wfd.getResult()
         now_unclaimed = set([ brd['brid'] for brd in now_unclaimed_brdicts ])
 
-        # and store that for next time
-        self._last_unclaimed_brids_set = now_unclaimed
+        metrics.MetricCountEvent.log(
+                "BuildMaster.pollDatabaseBuildRequests.rows_scanned",
+                len(now_unclaimed_brdicts), absolute=True)
 
-        # see what's new, and notify if anything is
-        new_unclaimed = now_unclaimed - last_unclaimed
+        # and store that for next time
+        if reconcile:
+            metrics.MetricCountEvent.log(
+                "BuildMaster.pollDatabaseBuildRequests.reconciliations", 1)
+            self._last_unclaimed_brids_set = now_unclaimed
+            self._last_buildrequest_reconcile = now
+        else:
+            self._last_unclaimed_brids_set = last_unclaimed | now_unclaimed
+        if self.db_poll_reconcile_interval:
+            self._last_seen_brid = latest_brid
+
+        # see what's new, and notify if anything is.  Incremental polls cannot
+        # see a request that was claimed and then unclaimed again, so in that
+        # mode a reconciliation announces every unclaimed request.
+        if reconcile and self.db_poll_reconcile_interval:
+            new_unclaimed = now_unclaimed
+        else:
+            new_unclaimed = now_unclaimed - last_unclaimed
         if new_unclaimed:
             brdicts = dict((brd['brid'], brd) for brd in now_unclaimed_brdicts)
-            for brid in new_unclaimed:
+            for brid in sorted(new_unclaimed):
                 brd = brdicts[brid]
                 self.buildRequestAdded(brd['buildsetid'], brd['brid'],
                                        brd['buildername'])
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 
+import inspect
 from twisted.python import log
 from twisted.python.failure import Failure
 from twisted.internet import defer, reactor
@@ -354,6 +355,12 @@ class BuildRequestDistributor(service.Service):
     are still working on the previous build request, then this class will
     correctly re-prioritize invocations of builders' C{maybeStartBuild}
     methods.
+
+    The unclaimed build requests for all pending builders are fetched with a
+    single query, and this snapshot is used both to sort the builders and to
+    supply each builder's C{maybeStartBuild} with its requests.  A builder's
+    entry in the snapshot is discarded when it is used, whenever that builder
+    is asked to start builds again, and when the activity loop finishes.
     """
 
     def __init__(self, botmaster):
@@ -369,12 +376,29 @@ class BuildRequestDistributor(service.Service):
         self.activity_lock = defer.DeferredLock()
         self.active = False
 
+        # maximum number of builders whose maybeStartBuild may run at once;
+        # see _activityLoop
+        self.concurrency = 1
+
+        # in-progress maybeStartBuild calls, keyed by builder name, and a
+        # Deferred to fire when one of them finishes
+        self._active_calls = {}
+        self._activity_changed = None
+
+        # snapshot of unclaimed build requests, keyed by builder name, and the
+        # sets of builder names invalidated during each in-progress fetch
+        self._unclaimed_requests = {}
+        self._unclaimed_fetches = []
+
     def stopService(self):
         # let the parent stopService succeed between activity; then the loop
-        # will stop calling itself, since self.running is false
+        # will stop calling itself, since self.running is false.  Any
+        # in-progress builder calls are allowed to finish first.
         d = self.activity_lock.acquire()
         d.addCallback(lambda _ : service.Service.stopService(self))
         d.addBoth(lambda _ : self.activity_lock.release())
+        d.addCallback(lambda _ :
+                defer.DeferredList(self._active_calls.values()))
         return d
 
     @defer.deferredGenerator
@@ -390,6 +414,9 @@ class BuildRequestDistributor(service.Service):
         new_builders = set(new_builders)
         existing_pending = set(self._pending_builders)
 
+        # any snapshot of these builders' requests is now out of date
+        self._invalidateUnclaimedRequests(new_builders)
+
         # if we won't add any builders, there's nothing to do
         if new_builders < existing_pending:
             return
@@ -422,17 +449,84 @@ class BuildRequestDistributor(service.Service):
         # release the lock unconditionally
         self.pending_builders_lock.release()
 
+    def _invalidateUnclaimedRequests(self, buildernames):
+        for n in buildernames:
+            self._unclaimed_requests.pop(n, None)
+        for invalidated in self._unclaimed_fetches:
+            invalidated.update(buildernames)
+
+    @defer.deferredGenerator
+    def _fetchUnclaimedRequests(self, buildernames):
+        # make sure that the snapshot has an entry for each of the given
+        # builders, fetching any that are missing with a single query
+        missing = [ n for n in buildernames
+                    if n not in self._unclaimed_requests ]
+        if not missing:
+            return
+
+        timer = metrics.Timer(
+                "BuildRequestDistributor._fetchUnclaimedRequests()")
+        timer.start()
+
+        invalidated = set()
+        self._unclaimed_fetches.append(invalidated)
+        try:
+            wfd = defer.waitForDeferred(
+                self.master.db.buildrequests.getBuildRequests(
+                        buildername=missing, claimed=False))
+            yield wfd
+            brdicts = wfd.getResult()
+        finally:
+            self._unclaimed_fetches.remove(invalidated)
+
+        # group them by builder, skipping any builders that were invalidated
+        # while the query was in progress
+        by_builder = dict([ (n, []) for n in missing
+                            if n not in invalidated ])
+        for brdict in brdicts:
+            if brdict['buildername'] in by_builder:
+                by_builder[brdict['buildername']].append(brdict)
+        for n, brdicts in by_builder.iteritems():
+            self._unclaimed_requests.setdefault(n, brdicts)
+
+        timer.stop()
+
+    def _callWithUnclaimedRequests(self, method, unclaimed_requests):
+        # call a builder method, passing it the builder's unclaimed requests
+        # if it is Builder's own or declares an unclaimed_requests argument;
+        # overrides written before the method took them (including decorated
+        # overrides, whose arguments cannot be seen) are called without them,
+        # and fetch the requests themselves
+        func = getattr(method, 'im_func', method)
+        default = getattr(Builder, getattr(func, '__name__', ''), None)
+        if func is getattr(default, 'im_func', None):
+            return method(unclaimed_requests=unclaimed_requests)
+        try:
+            args = inspect.getargspec(func)[0]
+        except TypeError:
+            args = []
+        if 'unclaimed_requests' in args:
+            return method(unclaimed_requests=unclaimed_requests)
+        return method()
+
     @defer.deferredGenerator
     def _defaultSorter(self, master, builders):
         timer = metrics.Timer("BuildRequestDistributor._defaultSorter()")
         timer.start()
-        # perform an asynchronous schwarzian transform, transforming None
-        # into sys.maxint so that it sorts to the end
+
+        wfd = defer.waitForDeferred(
+            self._fetchUnclaimedRequests([ bldr.name for bldr in builders ]))
+        yield wfd
+        wfd.getResult()
+
+        # perform an asynchronous schwarzian transform, giving each builder
+        # its requests from the snapshot (a builder invalidated while fetching
+        # gets None, and queries for itself)
         def xform(bldr):
-            d = defer.maybeDeferred(lambda :
-                    bldr.getOldestRequestTime())
-            d.addCallback(lambda time :
-                (((time is None) and None or time),bldr))
+            d = defer.maybeDeferred(self._callWithUnclaimedRequests,
+                    bldr.getOldestRequestTime,
+                    self._unclaimed_requests.get(bldr.name))
+            d.addCallback(lambda time : (time, bldr))
             return d
         wfd = defer.waitForDeferred(
             defer.gatherResults(
@@ -486,6 +580,10 @@ class BuildRequestDistributor(service.Service):
 
     @defer.deferredGenerator
     def _activityLoop(self):
+        # Call maybeStartBuild for each pending builder, in order.  Up to
+        # self.concurrency builders may be working at once, but a builder is
+        # never called while a previous call for it is in progress, nor while
+        # a builder sharing any of its slaves is being called.
         self.active = True
 
         timer = metrics.Timer('BuildRequestDistributor._activityLoop()')
@@ -504,39 +602,108 @@ class BuildRequestDistributor(service.Service):
             wfd.getResult()
 
             # bail out if we shouldn't keep looping
-            if not self.running or not self._pending_builders:
+            if not self.running:
                 self.pending_builders_lock.release()
                 self.activity_lock.release()
                 break
 
-            bldr_name = self._pending_builders.pop(0)
+            bldr_name = self._popRunnableBuilder()
             self.pending_builders_lock.release()
 
-            try:
-                wfd = defer.waitForDeferred(
-                    self._callABuilder(bldr_name))
+            if bldr_name is None:
+                self.activity_lock.release()
+
+                # if nothing is running, then nothing is pending either
+                if not self._active_calls:
+                    break
+
+                # otherwise, wait for a running builder to finish
+                self._activity_changed = defer.Deferred()
+                wfd = defer.waitForDeferred(self._activity_changed)
                 yield wfd
                 wfd.getResult()
-            except:
-                log.err(Failure(),
-                        "from maybeStartBuild for builder '%s'" % (bldr_name,))
+                continue
 
+            self._startCall(bldr_name)
             self.activity_lock.release()
 
+        # wait for any builders still running when the service stopped
+        if self._active_calls:
+            wfd = defer.waitForDeferred(
+                defer.DeferredList(self._active_calls.values()))
+            yield wfd
+            wfd.getResult()
+
         timer.stop()
 
+        # drop the snapshot entries of builders that were sorted, but are
+        # no longer pending
+        for n in self._unclaimed_requests.keys():
+            if n not in self._pending_builders:
+                del self._unclaimed_requests[n]
+
         self.active = False
         self._quiet()
 
+    def _popRunnableBuilder(self):
+        # pop and return the first pending builder that can be called now, or
+        # None if there is no such builder.  This must be called with
+        # pending_builders_lock held.
+        if len(self._active_calls) >= self.concurrency:
+            return None
+
+        busy_slaves = set()
+        for n in self._active_calls:
+            busy_slaves.update(self._getSlavenames(n))
+
+        for i, bldr_name in enumerate(self._pending_builders):
+            if bldr_name in self._active_calls:
+                continue
+            if busy_slaves and busy_slaves & set(self._getSlavenames(bldr_name)):
+                continue
+            return self._pending_builders.pop(i)
+        return None
+
+    def _getSlavenames(self, bldr_name):
+        bldr = self.botmaster.builders.get(bldr_name)
+        if not bldr:
+            return []
+        return bldr.slavenames
+
+    def _startCall(self, bldr_name):
+        d = self._callABuilder(bldr_name)
+        self._active_calls[bldr_name] = d
+        d.addErrback(log.err,
+                "from maybeStartBuild for builder '%s'" % (bldr_name,))
+        def finished(_):
+            del self._active_calls[bldr_name]
+            if self._activity_changed:
+                d, self._activity_changed = self._activity_changed, None
+                d.callback(None)
+        d.addCallback(finished)
+
+    @defer.deferredGenerator
     def _callABuilder(self, bldr_name):
         # get the actual builder object
         bldr = self.botmaster.builders.get(bldr_name)
         if not bldr:
-            return defer.succeed(None)
+            return
+
+        # get the unclaimed requests for this builder from the snapshot,
+        # fetching them along with those of all other pending builders if
+        # necessary, and consume the snapshot entry
+        wfd = defer.waitForDeferred(
+            self._fetchUnclaimedRequests([bldr_name] + self._pending_builders))
+        yield wfd
+        wfd.getResult()
+        unclaimed_requests = self._unclaimed_requests.pop(bldr_name, None)
 
-        d = bldr.maybeStartBuild()
+        d = self._callWithUnclaimedRequests(bldr.maybeStartBuild,
+                                            unclaimed_requests)
         d.addErrback(log.err, 'in maybeStartBuild for %r' % (bldr,))
-        return d
+        wfd = defer.waitForDeferred(d)
+        yield wfd
+        wfd.getResult()
 
     def _quiet(self):
         # shim for tests
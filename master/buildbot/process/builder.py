@@ -26,9 +26,9 @@ from buildbot.status.progress import Expectations
 from buildbot.status.builder import RETRY
 from buildbot.status.buildrequest import BuildRequestStatus
 from buildbot.process.properties import Properties
-from buildbot.process import buildrequest, slavebuilder
+from buildbot.process import buildrequest, slavebuilder, metrics
 from buildbot.process.slavebuilder import BUILDING
-from buildbot.db import buildrequests
+from buildbot.util import datetime2epoch, now
 
 class Builder(pb.Referenceable, service.MultiService):
     """I manage all Builds of a given type.
@@ -132,6 +132,10 @@ class Builder(pb.Referenceable, service.MultiService):
         self.reclaim_svc = internet.TimerService(10*60, self.reclaimAllBuilds)
         self.reclaim_svc.setServiceParent(self)
 
+        # merge keys of the unclaimed build requests, keyed by brid; see
+        # _getMergeKeys
+        self._mergekeys = {}
+
         # for testing, to help synchronize tests
         self.run_count = 0
 
@@ -191,18 +195,25 @@ class Builder(pb.Referenceable, service.MultiService):
         return "<Builder '%r' at %d>" % (self.name, id(self))
 
     @defer.deferredGenerator
-    def getOldestRequestTime(self):
+    def getOldestRequestTime(self, unclaimed_requests=None):
 
         """Returns the submitted_at of the oldest unclaimed build request for
         this builder, or None if there are no build requests.
 
+        @param unclaimed_requests: this builder's unclaimed build request
+        dictionaries, if the caller has already fetched them; otherwise they
+        are fetched from the database
+
         @returns: datetime instance or None, via Deferred
         """
-        wfd = defer.waitForDeferred(
-            self.master.db.buildrequests.getBuildRequests(
-                        buildername=self.name, claimed=False))
-        yield wfd
-        unclaimed = wfd.getResult()
+        if unclaimed_requests is None:
+            wfd = defer.waitForDeferred(
+                self.master.db.buildrequests.getBuildRequests(
+                            buildername=self.name, claimed=False))
+            yield wfd
+            unclaimed = wfd.getResult()
+        else:
+            unclaimed = unclaimed_requests
 
         if unclaimed:
             unclaimed = [ brd['submitted_at'] for brd in unclaimed ]
@@ -614,11 +625,14 @@ class Builder(pb.Referenceable, service.MultiService):
     # Build Creation
 
     @defer.deferredGenerator
-    def maybeStartBuild(self):
+    def maybeStartBuild(self, unclaimed_requests=None):
         # This method is called by the botmaster whenever this builder should
         # check for and potentially start new builds.  Do not call this method
         # directly - use master.botmaster.maybeStartBuildsForBuilder, or one
-        # of the other similar methods if more appropriate
+        # of the other similar methods if more appropriate.  The botmaster
+        # supplies this builder's unclaimed build requests (as fetched for
+        # all pending builders at once) as unclaimed_requests; if that is
+        # None, they are fetched here.
 
         # first, if we're not running, then don't start builds; stopService
         # uses this to ensure that any ongoing maybeStartBuild invocations
@@ -635,11 +649,14 @@ class Builder(pb.Referenceable, service.MultiService):
             return
 
         # now, get the available build requests
-        wfd = defer.waitForDeferred(
-                self.master.db.buildrequests.getBuildRequests(
-                        buildername=self.name, claimed=False))
-        yield wfd
-        unclaimed_requests = wfd.getResult()
+        if unclaimed_requests is None:
+            wfd = defer.waitForDeferred(
+                    self.master.db.buildrequests.getBuildRequests(
+                            buildername=self.name, claimed=False))
+            yield wfd
+            unclaimed_requests = wfd.getResult()
+        else:
+            unclaimed_requests = unclaimed_requests[:]
 
         if not unclaimed_requests:
             self.updateBigStatus()
@@ -690,25 +707,35 @@ class Builder(pb.Referenceable, service.MultiService):
             brdicts = wfd.getResult()
 
             # try to claim the build requests
-            brids = [ brdict['brid'] for brdict in brdicts ]
-            try:
-                wfd = defer.waitForDeferred(
-                        self.master.db.buildrequests.claimBuildRequests(brids))
-                yield wfd
-                wfd.getResult()
-            except buildrequests.AlreadyClaimedError:
-                # one or more of the build requests was already claimed;
-                # re-fetch the now-partially-claimed build requests and keep
-                # trying to match them
-                self._breakBrdictRefloops(unclaimed_requests)
-                wfd = defer.waitForDeferred(
-                        self.master.db.buildrequests.getBuildRequests(
-                                buildername=self.name, claimed=False))
-                yield wfd
-                unclaimed_requests = wfd.getResult()
-
-                # go around the loop again
-                continue
+            brids = [ br['brid'] for br in brdicts ]
+            wfd = defer.waitForDeferred(
+                    self.master.db.buildrequests.claimAnyBuildRequests(brids))
+            yield wfd
+            claimed_brids = set(wfd.getResult())
+
+            if len(claimed_brids) < len(brids):
+                # some of the build requests were already claimed by another
+                # master; forget about those, and keep trying to match the rest
+                lost_requests = [ br for br in brdicts
+                                  if br['brid'] not in claimed_brids ]
+                self._breakBrdictRefloops(lost_requests)
+                for br in lost_requests:
+                    unclaimed_requests.remove(br)
+                brdicts = [ br for br in brdicts
+                            if br['brid'] in claimed_brids ]
+                brids = [ br['brid'] for br in brdicts ]
+
+                # if the chosen request itself was lost, the others may not
+                # belong together, so release them and go around the loop
+                # again
+                if brdict['brid'] not in claimed_brids:
+                    if brids:
+                        wfd = defer.waitForDeferred(
+                            self.master.db.buildrequests.unclaimBuildRequests(
+                                                                    brids))
+                        yield wfd
+                        wfd.getResult()
+                    continue
 
             # claim was successful, so initiate a build for this set of
             # requests.  Note that if the build fails from here on out (e.g.,
@@ -717,8 +744,8 @@ class Builder(pb.Referenceable, service.MultiService):
 
             # _startBuildFor expects BuildRequest objects, so cook some up
             wfd = defer.waitForDeferred(
-                    defer.gatherResults([ self._brdictToBuildRequest(brdict)
-                                          for brdict in brdicts ]))
+                    defer.gatherResults([ self._brdictToBuildRequest(br)
+                                          for br in brdicts ]))
             yield wfd
             breqs = wfd.getResult()
 
@@ -737,6 +764,14 @@ class Builder(pb.Referenceable, service.MultiService):
                 # and try starting builds again.  If we still have a working slave,
                 # then this may re-claim the same buildrequests
                 self.botmaster.maybeStartBuildsForBuilder(self.name)
+            else:
+                # record how long each request waited for its build to start
+                started_at = now()
+                for brdict in brdicts:
+                    if brdict['submitted_at']:
+                        metrics.MetricTimeEvent.log(
+                            "Builder.request_to_build_start",
+                            started_at - datetime2epoch(brdict['submitted_at']))
 
             # finally, remove the buildrequests and slavebuilder from the
             # respective queues
@@ -820,6 +855,22 @@ class Builder(pb.Referenceable, service.MultiService):
             yield [ breq ]
             return
 
+        # the default merge function only merges requests with equal merge
+        # keys, so narrow the field to those before building any objects
+        if mergeRequests_fn == Builder._defaultMergeRequestFn:
+            wfd = defer.waitForDeferred(
+                self._getMergeKeys(unclaimed_requests))
+            yield wfd
+            mergekeys = wfd.getResult()
+
+            mergekey = mergekeys.get(breq['brid'])
+            if mergekey is not None:
+                unclaimed_requests = [ brdict for brdict in unclaimed_requests
+                                if mergekeys.get(brdict['brid']) == mergekey ]
+            if len(unclaimed_requests) == 1:
+                yield [ breq ]
+                return
+
         # we'll need BuildRequest objects, so get those first
         wfd = defer.waitForDeferred(
             defer.gatherResults(
@@ -844,6 +895,33 @@ class Builder(pb.Referenceable, service.MultiService):
         merged_requests = [ br.brdict for br in merged_request_objects ]
         yield merged_requests
 
+    def _getMergeKeys(self, requests):
+        """
+        Look up the merge key (see
+        L{buildbot.db.buildrequests.BuildRequestsConnectorComponent.getMergeKeys})
+        for each of the given build request dictionaries.  A request's merge
+        key never changes, so the keys are kept in C{self._mergekeys}, which
+        is trimmed to the given requests, and only those not already known
+        are fetched.  Requests that no longer exist have no merge key.
+
+        @param requests: build request dictionaries
+
+        @returns: dictionary mapping brid to merge key, via Deferred
+        """
+        brids = [ brdict['brid'] for brdict in requests ]
+        known = self._mergekeys
+        self._mergekeys = dict([ (brid, known[brid]) for brid in brids
+                                 if brid in known ])
+        missing = [ brid for brid in brids if brid not in self._mergekeys ]
+        if not missing:
+            return defer.succeed(self._mergekeys)
+        d = self.master.db.buildrequests.getMergeKeys(missing)
+        def keep(mergekeys):
+            self._mergekeys.update(mergekeys)
+            return self._mergekeys
+        d.addCallback(keep)
+        return d
+
     def _brdictToBuildRequest(self, brdict):
         """
         Convert a build request dictionary to a L{buildrequest.BuildRequest}
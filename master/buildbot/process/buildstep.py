@@ -15,6 +15,7 @@
 
 
 import re
+import zlib
 
 from zope.interface import implements
 from twisted.internet import reactor, defer, error
@@ -67,6 +68,17 @@ class RemoteCommand(pb.Referenceable):
 
     active = False
 
+    # the version of the update protocol requested from slaves that support
+    # it (command version 2.15 and later). With version 2, an update may be
+    # a list of (key, value) pairs rather than a dictionary, and the slave
+    # sends several updates in each remote_update call.
+    updateProtocol = 2
+
+    # the compression requested for the command's output, on buildslaves
+    # configured with compress_logs (command version 2.16 and later); only
+    # commands that can decompress it in remoteUpdate should set this
+    updateCompression = None
+
     def __init__(self, remote_command, args, ignore_updates=False):
         """
         @type  remote_command: string
@@ -131,10 +143,26 @@ class RemoteCommand(pb.Referenceable):
         # We will receive remote_update messages as the command runs.
         # We will get a single remote_complete when it finishes.
         # We should fire self.deferred when the command is done.
+        kwargs = {}
+        if self._slaveVersionIsAtLeast("2.15"):
+            kwargs['updateProtocol'] = self.updateProtocol
+            if (self.updateCompression and self.buildslave.compress_logs
+                    and self._slaveVersionIsAtLeast("2.16")):
+                kwargs['updateCompression'] = self.updateCompression
         d = self.remote.callRemote("startCommand", self, self.commandID,
-                                   self.remote_command, cmd_args)
+                                   self.remote_command, cmd_args, **kwargs)
         return d
 
+    def _slaveVersionIsAtLeast(self, minversion):
+        # slaves older than command version 2.15 do not accept the
+        # updateProtocol argument to startCommand, nor older than 2.16 the
+        # updateCompression argument
+        sv = self.step.build.getSlaveCommandVersion(self.remote_command, None)
+        if not isinstance(sv, basestring):
+            return False
+        return not self.step.slaveVersionIsOlderThan(self.remote_command,
+                                                     minversion)
+
     def interrupt(self, why):
         # TODO: consider separating this into interrupt() and stop(), where
         # stop() unconditionally calls _finished, but interrupt() merely
@@ -174,7 +202,10 @@ class RemoteCommand(pb.Referenceable):
         I can receive updates from the running remote command.
 
         @type  updates: list of [object, int]
-        @param updates: list of updates from the remote command
+        @param updates: list of updates from the remote command; each is a
+                        dictionary, or with version 2 of the update protocol,
+                        a list of (key, value) pairs, which are passed on to
+                        remoteUpdate one at a time, in order
         """
         self.buildslave.messageReceivedFromSlave()
         max_updatenum = 0
@@ -182,7 +213,11 @@ class RemoteCommand(pb.Referenceable):
             #log.msg("update[%d]:" % num)
             try:
                 if self.active and not self.ignore_updates:
-                    self.remoteUpdate(update)
+                    if isinstance(update, list):
+                        for key, value in update:
+                            self.remoteUpdate({key: value})
+                    else:
+                        self.remoteUpdate(update)
             except:
                 # log failure, terminate build, let slave retire the update
                 self._finished(Failure())
@@ -272,16 +307,23 @@ class LoggedRemoteCommand(RemoteCommand):
                               LogFile will be closed when the RemoteCommand
                               finishes. LogFiles which are shared between
                               multiple RemoteCommands should use False here.
+    @ivar outputBytes: the number of bytes of output received
+    @ivar wireBytes: the number of bytes those took on the wire, which is
+                     smaller than outputBytes if the slave compressed them
 
     """
 
     rc = None
     debug = False
+    updateCompression = 'zlib'
 
     def __init__(self, *args, **kwargs):
         self.logs = {}
         self.delayedLogs = {}
         self._closeWhenFinished = {}
+        self.decompressors = {}
+        self.outputBytes = 0
+        self.wireBytes = 0
         RemoteCommand.__init__(self, *args, **kwargs)
 
     def __repr__(self):
@@ -360,11 +402,45 @@ class LoggedRemoteCommand(RemoteCommand):
         else:
             log.msg("%s.addToLog: no such log %s" % (self, logname))
 
+    def _decompressUpdate(self, key, logname, data):
+        # each stream of output is a separate zlib stream
+        if (key, logname) not in self.decompressors:
+            self.decompressors[(key, logname)] = zlib.decompressobj()
+        self.wireBytes += len(data)
+        data = self.decompressors[(key, logname)].decompress(data)
+        self.outputBytes += len(data)
+        if key == 'log':
+            return {'log' : (logname, data)}
+        return {key : data}
+
+    def _countOutput(self, update):
+        size = 0
+        for key in ('stdout', 'stderr', 'header'):
+            if update.has_key(key):
+                size += len(update[key])
+        if update.has_key('log'):
+            size += len(update['log'][1])
+        self.outputBytes += size
+        self.wireBytes += size
+
+    def getCompressionRatio(self):
+        """Return the ratio of the size of the command's output to the
+        number of bytes it took on the wire, or None if there was none."""
+        if not self.wireBytes:
+            return None
+        return float(self.outputBytes) / self.wireBytes
+
     @metrics.countMethod('LoggedRemoteCommand.remoteUpdate()')
     def remoteUpdate(self, update):
         if self.debug:
             for k,v in update.items():
                 log.msg("Update[%s]: %s" % (k,v))
+        if update.has_key('zlib'):
+            # 'zlib': (key, logname or None, data), for output compressed by
+            # the slave
+            update = self._decompressUpdate(*update['zlib'])
+        else:
+            self._countOutput(update)
         if update.has_key('stdout'):
             # 'stdout': data
             self.addStdout(update['stdout'])
@@ -396,6 +472,20 @@ class LoggedRemoteCommand(RemoteCommand):
             delta = (util.now() - self._startTime) - self._remoteElapsed
             metrics.MetricTimeEvent.log("LoggedRemoteCommand.overhead", delta)
 
+        if self.wireBytes:
+            metrics.MetricCountEvent.log("LoggedRemoteCommand.outputBytes",
+                                         self.outputBytes)
+            metrics.MetricCountEvent.log("LoggedRemoteCommand.wireBytes",
+                                         self.wireBytes)
+            # and per step, so that the ratio can be compared between steps
+            metrics.MetricTransferEvent.log(self.step.name,
+                                            self.outputBytes, self.wireBytes)
+            if self.decompressors:
+                log.msg("%s: %d bytes of output took %d bytes on the wire "
+                        "(compression ratio %.1f)"
+                        % (self, self.outputBytes, self.wireBytes,
+                           self.getCompressionRatio()))
+
         for name,loog in self.logs.items():
             if self._closeWhenFinished[name]:
                 if maybeFailure:
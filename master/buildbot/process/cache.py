@@ -32,6 +32,12 @@ class CacheManager(object):
     def __init__(self):
         self.config = {}
         self._caches = {}
+        self._sizes = {}
+
+    def _get_max_size(self, cache_name):
+        config_name, default_size = self._sizes.get(cache_name,
+                                        (cache_name, self.DEFAULT_CACHE_SIZE))
+        return self.config.get(config_name, default_size)
 
     def get_cache(self, cache_name, miss_fn):
         """
@@ -49,15 +55,50 @@ class CacheManager(object):
         try:
             return self._caches[cache_name]
         except KeyError:
-            max_size = self.config.get(cache_name, self.DEFAULT_CACHE_SIZE)
+            max_size = self._get_max_size(cache_name)
             assert max_size >= 1
             c = self._caches[cache_name] = lru.AsyncLRUCache(miss_fn, max_size)
             return c
 
+    def make_cache(self, cache_name, miss_fn, config_name=None,
+                   default_size=None):
+        """
+        Create a new synchronous L{LRUCache} with the given name, replacing
+        any existing cache of that name.  This is for caches that belong to
+        objects which may be re-created, such as builder status objects, so
+        that a new object does not inherit the values of its predecessor.
+
+        @param cache_name: name of the cache
+        @param miss_fn: miss function for the cache; see L{LRUCache}
+        constructor.
+        @param config_name: key in the caches configuration giving the size of
+        this cache, if different from C{cache_name}; several caches can share
+        a size this way
+        @param default_size: size to use if the configuration does not give
+        one; defaults to C{DEFAULT_CACHE_SIZE}
+        @returns: L{LRUCache} instance
+        """
+        if default_size is None:
+            default_size = self.DEFAULT_CACHE_SIZE
+        self._sizes[cache_name] = (config_name or cache_name, default_size)
+        max_size = self._get_max_size(cache_name)
+        assert max_size >= 1
+        c = self._caches[cache_name] = lru.LRUCache(miss_fn, max_size)
+        return c
+
+    def remove_cache(self, cache_name):
+        """
+        Forget the cache with the given name, if it exists.
+
+        @param cache_name: name of the cache
+        """
+        self._caches.pop(cache_name, None)
+        self._sizes.pop(cache_name, None)
+
     def load_config(self, new_config):
         self.config = new_config
         for name, cache in self._caches.iteritems():
-            cache.set_max_size(new_config.get(name, self.DEFAULT_CACHE_SIZE))
+            cache.set_max_size(self._get_max_size(name))
 
     def get_metrics(self):
         return dict([
@@ -65,6 +65,18 @@ class MetricTimeEvent(MetricEvent):
         self.timer = timer
         self.elapsed = elapsed
 
+class MetricQueryEvent(MetricEvent):
+    def __init__(self, query, elapsed, rows=0):
+        self.query = query
+        self.elapsed = elapsed
+        self.rows = rows
+
+class MetricTransferEvent(MetricEvent):
+    def __init__(self, transfer, outputBytes, wireBytes):
+        self.transfer = transfer
+        self.outputBytes = outputBytes
+        self.wireBytes = wireBytes
+
 ALARM_OK, ALARM_WARN, ALARM_CRIT = range(3)
 ALARM_TEXT = ["OK", "WARN", "CRIT"]
 
@@ -240,6 +252,122 @@ class MetricTimeHandler(MetricHandler):
             retval[timer] = self.get(timer)
         return dict(timers=retval)
 
+class QueryStats(object):
+    """Running statistics for one kind of database query; percentiles are
+    calculated from the most recent C{SAMPLES} queries."""
+    SAMPLES = 100
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.recent = FiniteList(self.SAMPLES)
+
+    def add(self, elapsed, rows):
+        self.count += 1
+        self.total += elapsed
+        self.rows += rows
+        if elapsed > self.max:
+            self.max = elapsed
+        self.recent.append(elapsed)
+
+    def percentile(self, pct):
+        if not self.recent:
+            return 0
+        recent = sorted(self.recent)
+        return recent[min(len(recent) - 1, int(len(recent) * pct / 100))]
+
+    def asDict(self):
+        return dict(count=self.count, total=self.total, max=self.max,
+                    p50=self.percentile(50), p95=self.percentile(95),
+                    rows=self.rows)
+
+class MetricQueryHandler(MetricHandler):
+    _queries = None
+    def reset(self):
+        self._queries = defaultdict(QueryStats)
+
+    def handle(self, eventDict, metric):
+        self._queries[metric.query].add(metric.elapsed, metric.rows)
+
+    def keys(self):
+        return self._queries.keys()
+
+    def get(self, query):
+        return self._queries.get(query)
+
+    def report(self):
+        retval = []
+        # most expensive first
+        for query, stats in sorted(self._queries.items(),
+                                   key=lambda (q, s) : -s.total):
+            retval.append("Query %s: count %i total %.3g p50 %.3g p95 %.3g "
+                          "max %.3g rows %i" % (query, stats.count,
+                              stats.total, stats.percentile(50),
+                              stats.percentile(95), stats.max, stats.rows))
+        return "\n".join(retval)
+
+    def asDict(self):
+        retval = {}
+        for query in sorted(self.keys()):
+            retval[query] = self.get(query).asDict()
+        return dict(queries=retval)
+
+class TransferStats(object):
+    """Running totals for one kind of transfer of output, such as the
+    commands of one build step."""
+
+    def __init__(self):
+        self.count = 0
+        self.outputBytes = 0
+        self.wireBytes = 0
+
+    def add(self, outputBytes, wireBytes):
+        self.count += 1
+        self.outputBytes += outputBytes
+        self.wireBytes += wireBytes
+
+    def ratio(self):
+        if not self.wireBytes:
+            return 0
+        return float(self.outputBytes) / self.wireBytes
+
+    def asDict(self):
+        return dict(count=self.count, outputBytes=self.outputBytes,
+                    wireBytes=self.wireBytes, ratio=self.ratio())
+
+class MetricTransferHandler(MetricHandler):
+    _transfers = None
+    def reset(self):
+        self._transfers = defaultdict(TransferStats)
+
+    def handle(self, eventDict, metric):
+        self._transfers[metric.transfer].add(metric.outputBytes,
+                                             metric.wireBytes)
+
+    def keys(self):
+        return self._transfers.keys()
+
+    def get(self, transfer):
+        return self._transfers.get(transfer)
+
+    def report(self):
+        retval = []
+        for transfer in sorted(self.keys()):
+            stats = self.get(transfer)
+            retval.append("Transfer %s: count %i output %i wire %i "
+                          "ratio %.3g" % (transfer, stats.count,
+                              stats.outputBytes, stats.wireBytes,
+                              stats.ratio()))
+        return "\n".join(retval)
+
+    def asDict(self):
+        retval = {}
+        for transfer in sorted(self.keys()):
+            retval[transfer] = self.get(transfer).asDict()
+        return dict(transfers=retval)
+
 class MetricAlarmHandler(MetricHandler):
     _alarms = None
     def reset(self):
@@ -376,6 +504,8 @@ class MetricLogObserver(service.MultiService):
         self.registerHandler(MetricCountEvent, MetricCountHandler(self))
         self.registerHandler(MetricTimeEvent, MetricTimeHandler(self))
         self.registerHandler(MetricAlarmEvent, MetricAlarmHandler(self))
+        self.registerHandler(MetricQueryEvent, MetricQueryHandler(self))
+        self.registerHandler(MetricTransferEvent, MetricTransferHandler(self))
 
         # Make sure our changes poller is behaving
         self.getHandler(MetricTimeEvent).addWatcher(PollerWatcher(self))
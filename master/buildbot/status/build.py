@@ -14,7 +14,6 @@
 # Copyright Buildbot Team Members
 
 import os, shutil, re
-from cPickle import dump
 from zope.interface import implements
 from twisted.python import log, runtime, components
 from twisted.persisted import styles
@@ -22,6 +21,7 @@ from twisted.internet import reactor, defer
 from buildbot import interfaces, util, sourcestamp
 from buildbot.process import properties
 from buildbot.status.buildstep import BuildStepStatus
+from buildbot.status import buildstore
 
 class BuildStatus(styles.Versioned, properties.PropertiesMixin):
     implements(interfaces.IBuildStatus, interfaces.IStatusEvent)
@@ -51,6 +51,11 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
     finishedWatchers = []
     testResults = {}
 
+    # (filename, text2) while the steps of a build loaded from the 'records'
+    # format have not been read yet, in which case self.steps is None until
+    # getSteps loads them; see L{buildbot.status.buildstore}
+    lazySteps = None
+
     def __init__(self, parent, number):
         """
         @type  parent: L{BuilderStatus}
@@ -109,6 +114,14 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
         complete list, however some of the steps may not have started yet
         (step.getTimes()[0] will be None). For variant builds, this may not
         be complete (asking again later may give you more of them)."""
+        if self.lazySteps:
+            # builds stored in the 'records' format load their steps on first
+            # use
+            steps = buildstore.loadSteps(self)
+            for s in steps:
+                s.checkLogfiles()
+            self.steps = steps
+            self.lazySteps = None
         return self.steps
 
     def getTimes(self):
@@ -124,7 +137,7 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
         """
         step_stats_list = [
                 st.getStatistic(name)
-                for st in self.steps
+                for st in self.getSteps()
                 if st.hasStatistic(name) ]
         if initial_value is self._sentinel:
             return reduce(summary_fn, step_stats_list)
@@ -164,7 +177,12 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
     def getText(self):
         text = []
         text.extend(self.text)
-        for s in self.steps:
+        if self.lazySteps:
+            # the steps' text is kept with the build, so there is no need to
+            # load the steps themselves
+            text.extend(self.lazySteps[1])
+            return text
+        for s in self.getSteps():
             text.extend(s.text2)
         return text
 
@@ -188,7 +206,7 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
         # hack, which returns every log from every step. The logs should get
         # names like "compile" and "test" instead of "compile.output"
         logs = []
-        for s in self.steps:
+        for s in self.getSteps():
             for loog in s.getLogs():
                 logs.append(loog)
         return logs
@@ -306,6 +324,7 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
     def pruneSteps(self):
         # this build is very old: remove the build steps too
         self.steps = []
+        self.lazySteps = None
 
     # persistence stuff
 
@@ -338,6 +357,8 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
 
     def __getstate__(self):
         d = styles.Versioned.__getstate__(self)
+        d['steps'] = self.getSteps()
+        if 'lazySteps' in d: del d['lazySteps']
         # for now, a serialized Build is always "finished". We will never
         # save unfinished builds.
         if not self.finished:
@@ -353,7 +374,7 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
     def __setstate__(self, d):
         styles.Versioned.__setstate__(self, d)
         # self.builder must be filled in by our parent when loading
-        for step in self.steps:
+        for step in self.__dict__.get('steps', []):
             step.build = self
         self.watchers = []
         self.updates = {}
@@ -386,7 +407,10 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
 
     def checkLogfiles(self):
         # check that all logfiles exist, and remove references to any that
-        # have been deleted (e.g., by purge())
+        # have been deleted (e.g., by purge()); steps that have not been loaded
+        # yet are checked when they are loaded
+        if self.lazySteps:
+            return
         for s in self.steps:
             s.checkLogfiles()
 
@@ -397,7 +421,12 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
             shutil.rmtree(filename, ignore_errors=True)
         tmpfilename = filename + ".tmp"
         try:
-            dump(self, open(tmpfilename, "wb"), -1)
+            f = open(tmpfilename, "wb")
+            try:
+                buildstore.dumpBuild(self, f,
+                        getattr(self.builder, 'buildStatusFormat', 'pickle'))
+            finally:
+                f.close()
             if runtime.platformType  == 'win32':
                 # windows cannot rename a file on top of an existing one, so
                 # fall back to delete-first. There are ways this can fail and
@@ -431,7 +460,7 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
         result['logs'] = [[l.getName(),
             self.builder.status.getURLForThing(l)] for l in self.getLogs()]
         result['eta'] = self.getETA()
-        result['steps'] = [bss.asDict() for bss in self.steps]
+        result['steps'] = [bss.asDict() for bss in self.getSteps()]
         if self.getCurrentStep():
             result['currentStep'] = self.getCurrentStep().asDict()
         else:
@@ -14,17 +14,19 @@
 # Copyright Buildbot Team Members
 
 
-import weakref
 import os, re, itertools
-from cPickle import load, dump
+from cPickle import dump
 
 from zope.interface import implements
 from twisted.python import log, runtime
+from twisted.internet import defer, threads
 from twisted.persisted import styles
-from buildbot.process import metrics
 from buildbot import interfaces, util
+from buildbot.util import lru
 from buildbot.status.event import Event
 from buildbot.status.build import BuildStatus
+from buildbot.status import buildstore
+from buildbot.status.buildindex import BuildIndex
 from buildbot.status.buildrequest import BuildRequestStatus
 
 # user modules expect these symbols to be present here
@@ -67,6 +69,9 @@ class BuilderStatus(styles.Versioned):
     logHorizon = 40 # forget logs in steps in builds beyond this
     buildHorizon = 100 # forget builds beyond this
 
+    # the on-disk format for newly finished builds; see buildstore.FORMATS
+    buildStatusFormat = "pickle"
+
     category = None
     currentBigState = "offline" # or idle/waiting/interlocked/building
     basedir = None # filled in by our parent
@@ -85,8 +90,10 @@ class BuilderStatus(styles.Versioned):
         self.currentBuilds = []
         self.nextBuild = None
         self.watchers = []
-        self.buildCache = weakref.WeakValueDictionary()
-        self.buildCache_LRU = []
+        self.buildCache = lru.LRUCache(self._loadBuild, self.buildCacheSize)
+        self.buildIndex = None
+        self.pendingBuildLoads = {}
+        self._initPruneState()
         self.logCompressionLimit = False # default to no compression for tests
         self.logCompressionMethod = "bz2"
         self.logMaxSize = None # No default limit
@@ -102,7 +109,11 @@ class BuilderStatus(styles.Versioned):
         d = styles.Versioned.__getstate__(self)
         d['watchers'] = []
         del d['buildCache']
-        del d['buildCache_LRU']
+        d.pop('pendingBuildLoads', None)
+        d.pop('buildIndex', None)
+        for k in ('prunedBelow', 'pruneSkipped', 'logFiles',
+                  'pruneFilesInvocation'):
+            d.pop(k, None)
         for b in self.currentBuilds:
             b.saveYourself()
             # TODO: push a 'hey, build was interrupted' event
@@ -118,8 +129,10 @@ class BuilderStatus(styles.Versioned):
         # when loading, re-initialize the transient stuff. Remember that
         # upgradeToVersion1 and such will be called after this finishes.
         styles.Versioned.__setstate__(self, d)
-        self.buildCache = weakref.WeakValueDictionary()
-        self.buildCache_LRU = []
+        self.buildCache = lru.LRUCache(self._loadBuild, self.buildCacheSize)
+        self.buildIndex = None
+        self.pendingBuildLoads = {}
+        self._initPruneState()
         self.currentBuilds = []
         self.watchers = []
         self.slavenames = []
@@ -130,7 +143,19 @@ class BuilderStatus(styles.Versioned):
         # Note that we do not hang onto the buildmaster, since this object
         # gets pickled and unpickled.
         if buildmaster.buildCacheSize is not None:
-            self.buildCacheSize = buildmaster.buildCacheSize
+            self.buildCache.set_max_size(buildmaster.buildCacheSize)
+        # the size may also have been set by the caches configuration
+        self.buildCacheSize = self.buildCache.max_size
+
+    def setCacheManager(self, caches):
+        """Replace the build cache with one managed by the given
+        L{buildbot.process.cache.CacheManager}.  Its size is then given by the
+        C{builds} entry of the C{caches} configuration, and its statistics
+        are reported along with those of the other caches."""
+        self.buildCache = caches.make_cache("builds/%s" % self.name,
+                self._loadBuild, config_name="builds",
+                default_size=self.buildCacheSize)
+        self.buildCacheSize = self.buildCache.max_size
 
     def upgradeToVersion1(self):
         if hasattr(self, 'slavename'):
@@ -161,6 +186,10 @@ class BuilderStatus(styles.Versioned):
         assert method in ("bz2", "gz")
         self.logCompressionMethod = method
 
+    def setBuildStatusFormat(self, format):
+        assert format in buildstore.FORMATS
+        self.buildStatusFormat = format
+
     def setLogMaxSize(self, upperLimit):
         self.logMaxSize = upperLimit
 
@@ -192,60 +221,107 @@ class BuilderStatus(styles.Versioned):
     def makeBuildFilename(self, number):
         return os.path.join(self.basedir, "%d" % number)
 
-    def touchBuildCache(self, build):
-        self.buildCache[build.number] = build
-        if build in self.buildCache_LRU:
-            self.buildCache_LRU.remove(build)
-        self.buildCache_LRU = self.buildCache_LRU[-(self.buildCacheSize-1):] + [ build ]
-        return build
-
     def getBuildByNumber(self, number):
-        # first look in currentBuilds
-        for b in self.currentBuilds:
-            if b.number == number:
-                return self.touchBuildCache(b)
+        return self.buildCache.get(number)
 
-        # then in the buildCache
-        if number in self.buildCache:
-            metrics.MetricCountEvent.log("buildCache.hits", 1)
-            return self.touchBuildCache(self.buildCache[number])
-        metrics.MetricCountEvent.log("buildCache.misses", 1)
+    def getBuildByNumberAsync(self, number):
+        """Like L{getBuildByNumber}, but load the build pickle in a thread,
+        so that a cold disk or a large pickle does not block the reactor.
+        Concurrent calls for the same build share a single load, and the
+        result is added to the build cache.
+
+        @returns: L{BuildStatus} via Deferred; errbacks with IndexError if
+        the build does not exist
+        """
+        if self.buildCache.contains(number):
+            return defer.succeed(self.buildCache.get(number))
+
+        d = defer.Deferred()
+        if number in self.pendingBuildLoads:
+            self.pendingBuildLoads[number].append(d)
+            return d
+        self.pendingBuildLoads[number] = [ d ]
+
+        load_d = threads.deferToThread(self._loadBuild, number)
+        def loaded(build):
+            # a synchronous load may have won the race; if so, use the build
+            # it cached so that there is only one object for this build
+            if self.buildCache.contains(number):
+                build = self.buildCache.get(number)
+            else:
+                self.buildCache.add(number, build)
+            for waiter in self.pendingBuildLoads.pop(number):
+                waiter.callback(build)
+        def failed(f):
+            for waiter in self.pendingBuildLoads.pop(number):
+                waiter.errback(f)
+        load_d.addCallbacks(loaded, failed)
+        load_d.addErrback(log.err)
+        return d
 
-        # then fall back to loading it from disk
+    def _loadBuild(self, number):
         filename = self.makeBuildFilename(number)
         try:
-            log.msg("Loading builder %s's build %d from on-disk pickle"
+            log.msg("Loading builder %s's build %d from disk"
                 % (self.name, number))
-            build = load(open(filename, "rb"))
+            build = buildstore.loadBuild(filename)
             build.builder = self
 
             # (bug #1068) if we need to upgrade, we probably need to rewrite
             # this pickle, too.  We determine this by looking at the list of
-            # Versioned objects that have been unpickled, and (after doUpgrade)
-            # checking to see if any of them set wasUpgraded.  The Versioneds'
-            # upgradeToVersionNN methods all set this.
-            versioneds = styles.versionedsToUpgrade
-            styles.doUpgrade()
-            if True in [ hasattr(o, 'wasUpgraded') for o in versioneds.values() ]:
+            # Versioned objects that have been unpickled, and (after the
+            # upgrade) checking to see if any of them set wasUpgraded.  The
+            # Versioneds' upgradeToVersionNN methods all set this.
+            versioneds = buildstore.upgradeLoaded()
+            if True in [ hasattr(o, 'wasUpgraded') for o in versioneds ]:
                 log.msg("re-writing upgraded build pickle")
                 build.saveYourself()
 
             # check that logfiles exist
             build.checkLogfiles()
-            return self.touchBuildCache(build)
+            return build
         except IOError:
             raise IndexError("no such build %d" % number)
         except EOFError:
             raise IndexError("corrupted build pickle %d" % number)
 
-    def prune(self, events_only=False):
-        # begin by pruning our own events
-        self.events = self.events[-self.eventHorizon:]
+    # build summary index
 
-        if events_only:
-            return
+    def getBuildIndex(self):
+        """Return the L{BuildIndex} for this builder, loading it from disk
+        on first use."""
+        if self.buildIndex is None:
+            self.buildIndex = BuildIndex(self.basedir)
+        return self.buildIndex
 
-        # get the horizons straight
+    def getBuildSummary(self, number):
+        if number < 0:
+            number = self.nextBuildNumber + number
+        if number < 0 or number >= self.nextBuildNumber:
+            return None
+
+        index = self.getBuildIndex()
+        summary = index.get(number)
+        if summary is not None:
+            return summary
+
+        # builds finished before the index existed are indexed on demand
+        build = self.getBuild(number)
+        if build is None or not build.isFinished():
+            return None
+        return index.add(build)
+
+    def _initPruneState(self):
+        # the lowest build number whose pickle may still be on disk, or None
+        # if the directory has not been scanned yet
+        self.prunedBelow = None
+        # build numbers that were not pruned because they were in use
+        self.pruneSkipped = set()
+        # build number -> names of log files that may still be on disk
+        self.logFiles = {}
+        self.pruneFilesInvocation = util.SerializedInvocation(self._pruneFiles)
+
+    def _getPruneHorizons(self):
         if self.buildHorizon is not None:
             earliest_build = self.nextBuildNumber - self.buildHorizon
         else:
@@ -258,37 +334,123 @@ class BuilderStatus(styles.Versioned):
 
         if earliest_log < earliest_build:
             earliest_log = earliest_build
+        return earliest_build, earliest_log
 
-        if earliest_build == 0:
-            return
+    def prune(self, events_only=False):
+        """Forget old events and delete the files of builds that are beyond
+        the horizons.  The first time builds are pruned, the builder
+        directory is scanned for old files; after that, only the builds that
+        have crossed a horizon since the last prune are considered.  Files
+        are deleted in a thread.
+
+        @returns: Deferred that fires when files have been deleted
+        """
+        # begin by pruning our own events
+        self.events = self.events[-self.eventHorizon:]
+
+        if events_only:
+            return defer.succeed(None)
+
+        earliest_build, earliest_log = self._getPruneHorizons()
+        if earliest_build <= 0:
+            if self.buildHorizon is None:
+                # nothing is being tracked, so rescan if a horizon is set later
+                self._initPruneState()
+            return defer.succeed(None)
+
+        if self.buildIndex is not None:
+            self.buildIndex.remove([ n
+                    for n in self.buildIndex.summaries.keys()
+                    if n < earliest_build and not self.buildCache.contains(n) ])
+
+        return self.pruneFilesInvocation()
+
+    def _pruneFiles(self):
+        d = defer.succeed(None)
+        if self.prunedBelow is None:
+            d.addCallback(lambda _ :
+                    threads.deferToThread(self._scanBuildFiles))
+            d.addCallback(self._addScannedFiles)
+        def remove(_):
+            filenames = self._getPrunableFiles()
+            if filenames:
+                return threads.deferToThread(self._removeFiles, filenames)
+        d.addCallback(remove)
+        return d
 
-        # skim the directory and delete anything that shouldn't be there anymore
+    def _scanBuildFiles(self):
+        # runs in a thread
         build_re = re.compile(r"^([0-9]+)$")
         build_log_re = re.compile(r"^([0-9]+)-.*$")
-        # if the directory doesn't exist, bail out here
-        if not os.path.exists(self.basedir):
-            return
-
-        for filename in os.listdir(self.basedir):
-            num = None
+        builds = []
+        logs = {}
+        try:
+            filenames = os.listdir(self.basedir)
+        except OSError:
+            # if the directory doesn't exist, there is nothing to prune
+            filenames = []
+        for filename in filenames:
             mo = build_re.match(filename)
-            is_logfile = False
             if mo:
-                num = int(mo.group(1))
-            else:
-                mo = build_log_re.match(filename)
-                if mo:
-                    num = int(mo.group(1))
-                    is_logfile = True
-
-            if num is None: continue
-            if num in self.buildCache: continue
+                builds.append(int(mo.group(1)))
+                continue
+            mo = build_log_re.match(filename)
+            if mo:
+                logs.setdefault(int(mo.group(1)), []).append(filename)
+        return builds, logs
+
+    def _addScannedFiles(self, scanned):
+        builds, logs = scanned
+        numbers = builds + logs.keys()
+        if numbers:
+            self.prunedBelow = min(numbers)
+        else:
+            self.prunedBelow = self.nextBuildNumber
+        for num, filenames in logs.iteritems():
+            known = self.logFiles.setdefault(num, [])
+            known.extend([ f for f in filenames if f not in known ])
+
+    def _getPrunableFiles(self):
+        earliest_build, earliest_log = self._getPruneHorizons()
+        if earliest_build <= 0:
+            return []
+        filenames = []
+
+        # builds that crossed the build horizon since the last prune, and
+        # those that were in use then
+        numbers = self.pruneSkipped
+        numbers.update(range(self.prunedBelow, earliest_build))
+        self.pruneSkipped = set()
+        self.prunedBelow = max(self.prunedBelow, earliest_build)
+        for num in sorted(numbers):
+            if num >= earliest_build or self.buildCache.contains(num):
+                self.pruneSkipped.add(num)
+                continue
+            filenames.append("%d" % num)
 
-            if (is_logfile and num < earliest_log) or num < earliest_build:
-                pathname = os.path.join(self.basedir, filename)
-                log.msg("pruning '%s'" % pathname)
-                try: os.unlink(pathname)
-                except OSError: pass
+        # log files are tracked per build until they are deleted
+        for num in sorted(self.logFiles.keys()):
+            if num >= earliest_log:
+                break
+            if self.buildCache.contains(num):
+                continue
+            for filename in self.logFiles.pop(num):
+                filenames.append(filename)
+                # the log may have been compressed, and has an index
+                for ext in ".bz2", ".gz", ".idx", ".blocks":
+                    if not filename.endswith(ext):
+                        filenames.append(filename + ext)
+        return filenames
+
+    def _removeFiles(self, filenames):
+        # runs in a thread
+        for filename in filenames:
+            pathname = os.path.join(self.basedir, filename)
+            try:
+                os.unlink(pathname)
+            except OSError:
+                continue
+            log.msg("pruning '%s'" % pathname)
 
     # IBuilderStatus methods
     def getName(self):
@@ -303,7 +465,7 @@ class BuilderStatus(styles.Versioned):
     def getPendingBuildRequestStatuses(self):
         db = self.status.master.db
         d = db.buildrequests.getBuildRequests(claimed=False,
-                                              buildername=self.name)
+                                        buildername=self.name, fresh=False)
         def make_statuses(brdicts):
             return [BuildRequestStatus(self.name, brdict['brid'],
                                        self.status)
@@ -334,6 +496,19 @@ class BuilderStatus(styles.Versioned):
         except IndexError:
             return None
 
+    def getBuildAsync(self, number):
+        if number < 0:
+            number = self.nextBuildNumber + number
+        if number < 0 or number >= self.nextBuildNumber:
+            return defer.succeed(None)
+
+        d = self.getBuildByNumberAsync(number)
+        def missing(f):
+            f.trap(IndexError)
+            return None
+        d.addErrback(missing)
+        return d
+
     def getEvent(self, number):
         try:
             return self.events[number]
@@ -344,6 +519,7 @@ class BuilderStatus(styles.Versioned):
                                num_builds=None,
                                max_buildnum=None,
                                finished_before=None,
+                               results=None,
                                max_search=200):
         got = 0
         for Nb in itertools.count(1):
@@ -351,21 +527,25 @@ class BuilderStatus(styles.Versioned):
                 break
             if Nb > max_search:
                 break
-            build = self.getBuild(-Nb)
-            if build is None:
+            # filter on the summary, and only load the builds we will produce
+            summary = self.getBuildSummary(-Nb)
+            if summary is None:
                 continue
             if max_buildnum is not None:
-                if build.getNumber() > max_buildnum:
+                if summary['number'] > max_buildnum:
                     continue
-            if not build.isFinished():
-                continue
             if finished_before is not None:
-                start, end = build.getTimes()
-                if end >= finished_before:
+                if summary['end'] >= finished_before:
                     continue
             if branches:
-                if build.getSourceStamp().branch not in branches:
+                if summary['branch'] not in branches:
                     continue
+            if results is not None:
+                if summary['results'] not in results:
+                    continue
+            build = self.getBuild(summary['number'])
+            if build is None:
+                continue
             got += 1
             yield build
             if num_builds is not None:
@@ -388,7 +568,20 @@ class BuilderStatus(styles.Versioned):
 
         eventIndex = -1
         e = self.getEvent(eventIndex)
+        index = self.getBuildIndex()
         for Nb in range(1, self.nextBuildNumber+1):
+            # use the summary, if any, to skip builds without loading them
+            summary = index.get(self.nextBuildNumber - Nb)
+            if summary is not None:
+                if summary['start'] < minTime:
+                    break
+                if branches and not summary['branch'] in branches:
+                    continue
+                if categories and not self.getCategory() in categories:
+                    continue
+                if committers and not [True for c in summary['committers']
+                                       if c in committers]:
+                    continue
             b = self.getBuild(-Nb)
             if not b:
                 # HACK: If this is the first build we are looking at, it is
@@ -504,7 +697,7 @@ class BuilderStatus(styles.Versioned):
         assert s.builder is self # paranoia
         assert s not in self.currentBuilds
         self.currentBuilds.append(s)
-        self.touchBuildCache(s)
+        self.buildCache.add(s.number, s, fetched=False)
 
         # now that the BuildStatus is prepared to answer queries, we can
         # announce the new build to all our watchers
@@ -527,6 +720,13 @@ class BuilderStatus(styles.Versioned):
         assert s in self.currentBuilds
         s.saveYourself()
         self.currentBuilds.remove(s)
+        self.getBuildIndex().add(s)
+        if self.buildHorizon is not None:
+            # remember the build's log files, so that pruning them later does
+            # not require a directory scan
+            self.logFiles[s.getNumber()] = [ l.filename
+                    for step in s.getSteps()
+                    for l in step.getLogs() if l.filename ]
 
         name = self.getName()
         results = s.getResults()
@@ -0,0 +1,184 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import cPickle as pickle
+from twisted.python import log, runtime
+
+def summarizeBuild(build):
+    """
+    Extract the summary of a finished build that is kept in the index.
+
+    @param build: a finished L{buildbot.status.build.BuildStatus}
+    @returns: summary dictionary
+    """
+    ss = build.getSourceStamp()
+    start, end = build.getTimes()
+    return dict(
+        number=build.getNumber(),
+        start=start,
+        end=end,
+        results=build.getResults(),
+        branch=ss and ss.branch,
+        revision=ss and ss.revision,
+        slavename=build.getSlavename(),
+        blamelist=list(build.getResponsibleUsers() or []),
+        committers=[ c.who for c in (build.getChanges() or []) ])
+
+class BuildIndex(object):
+    """
+    A compact index of the finished builds of a single builder, keyed by build
+    number.  Each entry is a small dictionary as returned by
+    L{summarizeBuild}, so history queries can be answered without unpickling
+    the builds themselves.
+
+    The index is stored as an append-only sequence of pickled records in
+    C{basedir/buildindex}, next to the build pickles.  Each record is a tuple
+    C{(number, summary)}; a summary of C{None} records the removal of that
+    build.  The file is rewritten once removals outnumber live entries.  If
+    C{basedir} is C{None}, the index is kept in memory only.
+
+    @ivar summaries: dictionary mapping build number to summary
+    """
+
+    filename = "buildindex"
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.summaries = {}
+        self.garbage = 0
+        self.load()
+
+    def _path(self):
+        if self.basedir is None:
+            return None
+        return os.path.join(self.basedir, self.filename)
+
+    def load(self):
+        self.summaries = {}
+        self.garbage = 0
+        path = self._path()
+        if path is None or not os.path.exists(path):
+            return
+        damaged = False
+        records = 0
+        f = open(path, "rb")
+        try:
+            while True:
+                try:
+                    number, summary = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # a partially-written record; keep what we have, and
+                    # rewrite the file without it
+                    log.msg("build index %s is damaged; truncating" % path)
+                    damaged = True
+                    break
+                records += 1
+                if summary is None:
+                    self.summaries.pop(number, None)
+                else:
+                    self.summaries[number] = summary
+        finally:
+            f.close()
+        self.garbage = records - len(self.summaries)
+        if damaged:
+            self.compact()
+
+    def _append(self, records):
+        path = self._path()
+        if path is None:
+            return
+        try:
+            f = open(path, "ab")
+            try:
+                for rec in records:
+                    pickle.dump(rec, f, -1)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            log.msg("unable to update build index %s" % path)
+            log.err()
+
+    def compact(self):
+        """Rewrite the index file to contain only the live entries."""
+        self.garbage = 0
+        path = self._path()
+        if path is None:
+            return
+        tmppath = path + ".tmp"
+        try:
+            f = open(tmppath, "wb")
+            try:
+                for number in sorted(self.summaries):
+                    pickle.dump((number, self.summaries[number]), f, -1)
+            finally:
+                f.close()
+            if runtime.platformType == 'win32':
+                # windows cannot rename a file on top of an existing one
+                if os.path.exists(path):
+                    os.unlink(path)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            log.msg("unable to rewrite build index %s" % path)
+            log.err()
+
+    def add(self, build):
+        """
+        Add or replace the entry for a finished build.
+
+        @param build: a finished L{buildbot.status.build.BuildStatus}
+        @returns: the new summary
+        """
+        summary = summarizeBuild(build)
+        number = summary['number']
+        if number in self.summaries:
+            self.garbage += 1
+        self.summaries[number] = summary
+        self._append([ (number, summary) ])
+        return summary
+
+    def remove(self, numbers):
+        """
+        Forget the entries for the given build numbers, e.g., after their
+        pickles have been pruned.
+
+        @param numbers: iterable of build numbers
+        """
+        removed = [ n for n in numbers if n in self.summaries ]
+        if not removed:
+            return
+        for n in removed:
+            del self.summaries[n]
+        self.garbage += 2 * len(removed)
+        if self.garbage > len(self.summaries):
+            self.compact()
+        else:
+            self._append([ (n, None) for n in removed ])
+
+    def get(self, number):
+        """
+        Get the summary for the given build number.
+
+        @returns: summary dictionary, or None if the build is not indexed
+        """
+        return self.summaries.get(number)
+
+    def __contains__(self, number):
+        return number in self.summaries
+
+    def __len__(self):
+        return len(self.summaries)
@@ -43,7 +43,8 @@ class BuildSetStatus:
     def getBuilderNamesAndBuildRequests(self):
         # returns a Deferred; undocumented method that may be removed
         # without warning
-        d = self.master.db.buildrequests.getBuildRequests(bsid=self.id)
+        d = self.master.db.buildrequests.getBuildRequests(bsid=self.id,
+                                                          fresh=False)
         def get_objects(brdicts):
             return dict([
                 (brd['buildername'], BuildRequestStatus(brd['buildername'],
@@ -53,7 +54,8 @@ class BuildSetStatus:
         return d
 
     def getBuilderNames(self):
-        d = self.master.db.buildrequests.getBuildRequests(bsid=self.id)
+        d = self.master.db.buildrequests.getBuildRequests(bsid=self.id,
+                                                          fresh=False)
         def get_names(brdicts):
             return sorted([ brd['buildername'] for brd in brdicts ])
         d.addCallback(get_names)
@@ -0,0 +1,248 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+On-disk formats for finished builds.
+
+Builds are stored in C{basedir/<number>}, in one of two formats:
+
+ - C{pickle}: a pickle of the whole L{BuildStatus} object graph
+ - C{records}: a magic string and version followed by two length-prefixed
+   pickles.  The first holds the build's state without its steps, along with
+   the text of those steps; the second, compressed with zlib, holds the steps
+   themselves, and is only read when the steps are first needed.
+
+The format of a file is determined from its first bytes, so the two can be
+mixed freely in a builder directory, and the format used for new builds can be
+changed at any time.
+"""
+
+import os
+import struct
+import thread
+import threading
+import types
+import zlib
+import cPickle as pickle
+from twisted.python import log, runtime
+from twisted.persisted import styles
+
+FORMATS = ('pickle', 'records')
+
+MAGIC = "BBSTATUS"
+RECORDS_VERSION = 3
+
+# unpickling Versioned objects registers them in a global dictionary,
+# styles.versionedsToUpgrade, that styles.doUpgrade drains.  Builds are loaded
+# both in threads and in the reactor, so that dictionary is replaced by a
+# _VersionedRegistry, which also records the thread that unpickled each
+# object, and each load upgrades only its own objects, with upgradeLoaded.
+# load_lock protects that bookkeeping; it is not held while a build is read
+# or unpickled.
+load_lock = threading.RLock()
+
+class _VersionedRegistry(dict):
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.byThread = {}
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.byThread.setdefault(thread.get_ident(), []).append(value)
+
+    def forget(self, ident):
+        objs = self.byThread.pop(ident, [])
+        for obj in objs:
+            self.pop(id(obj), None)
+        return objs
+
+def beginLoad():
+    """
+    Prepare to unpickle Versioned objects in the calling thread, to be
+    upgraded by L{upgradeLoaded}.  Anything this thread unpickled earlier
+    without calling L{upgradeLoaded}, e.g., because the load failed, is
+    forgotten.
+    """
+    load_lock.acquire()
+    try:
+        registry = styles.versionedsToUpgrade
+        if not isinstance(registry, _VersionedRegistry):
+            registry = _VersionedRegistry(registry)
+            styles.versionedsToUpgrade = registry
+        registry.forget(thread.get_ident())
+    finally:
+        load_lock.release()
+
+def upgradeLoaded():
+    """
+    Upgrade the Versioned objects unpickled by the calling thread since
+    L{beginLoad}, as C{styles.doUpgrade} does for all unpickled objects.
+
+    @returns: list of those objects
+    """
+    load_lock.acquire()
+    try:
+        registry = styles.versionedsToUpgrade
+        if not isinstance(registry, _VersionedRegistry):
+            # styles.doUpgrade has been called since, and upgraded them
+            return []
+        objs = registry.byThread.get(thread.get_ident(), [])
+        for obj in objs:
+            styles.requireUpgrade(obj)
+        registry.forget(thread.get_ident())
+        for obj in objs:
+            styles.upgraded.pop(id(obj), None)
+        return objs
+    finally:
+        load_lock.release()
+
+_length = struct.Struct(">I")
+
+# record files
+
+def _writeRecord(f, obj, compress=False):
+    data = pickle.dumps(obj, -1)
+    if compress:
+        data = zlib.compress(data)
+    f.write(_length.pack(len(data)))
+    f.write(data)
+
+def _readRecord(f, compressed=False):
+    hdr = f.read(_length.size)
+    if len(hdr) < _length.size:
+        raise EOFError("truncated build record")
+    length, = _length.unpack(hdr)
+    data = f.read(length)
+    if len(data) < length:
+        raise EOFError("truncated build record")
+    try:
+        if compressed:
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+    except (pickle.UnpicklingError, zlib.error, ValueError, TypeError), e:
+        raise EOFError("damaged build record: %s" % (e,))
+
+def _readHeader(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise EOFError("not a build record file")
+    hdr = f.read(_length.size)
+    if len(hdr) < _length.size:
+        raise EOFError("truncated build record")
+    version, = _length.unpack(hdr)
+    if version != RECORDS_VERSION:
+        raise EOFError("unknown build record version %r" % (version,))
+    return _readRecord(f)
+
+def dumpBuild(build, f, format='pickle'):
+    """
+    Write a finished build to the open file C{f} in the given format.
+    """
+    assert format in FORMATS
+    if format == 'records':
+        state = build.__getstate__()
+        steps = state.pop('steps', [])
+        text2 = [ t for s in steps for t in s.text2 ]
+        f.write(MAGIC)
+        f.write(_length.pack(RECORDS_VERSION))
+        _writeRecord(f, (build.__class__, state, text2))
+        _writeRecord(f, steps, compress=True)
+        return
+    pickle.dump(build, f, -1)
+
+def loadBuild(filename):
+    """
+    Load a build from C{filename}, in either format.  The caller must call
+    L{upgradeLoaded} afterward, in the same thread.  The steps of builds in
+    the C{records} format are loaded when first used.
+
+    @raises IOError: if the file cannot be read
+    @raises EOFError: if the file is truncated or damaged
+    """
+    beginLoad()
+    f = open(filename, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        f.seek(0)
+        cls, state, text2 = _readHeader(f)
+        build = types.InstanceType(cls)
+        build.__setstate__(state)
+        build.steps = None
+        build.lazySteps = (filename, text2)
+        return build
+    finally:
+        f.close()
+
+def loadSteps(build):
+    """
+    Load the steps of a build that was loaded from the C{records} format.  The
+    steps' logfiles are not checked.
+
+    @returns: list of L{BuildStepStatus} instances
+    """
+    filename = build.lazySteps[0]
+    steps = []
+    beginLoad()
+    try:
+        f = open(filename, "rb")
+        try:
+            _readHeader(f)
+            steps = _readRecord(f, compressed=True)
+        finally:
+            f.close()
+    except Exception:
+        log.msg("unable to load steps of build %r from %s"
+                % (build, filename))
+        log.err()
+        steps = []
+    upgradeLoaded()
+
+    for s in steps:
+        s.build = build
+    return steps
+
+def convertBuild(filename, format):
+    """
+    Rewrite the build in C{filename} in the given format, if it is not already
+    in that format.
+
+    @returns: True if the build was rewritten
+    """
+    f = open(filename, "rb")
+    try:
+        is_records = f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.close()
+    if is_records == (format == 'records'):
+        return False
+
+    build = loadBuild(filename)
+    upgradeLoaded()
+    # make sure that all of the steps are loaded before rewriting the file
+    build.getSteps()
+
+    tmpfilename = filename + ".tmp"
+    f = open(tmpfilename, "wb")
+    try:
+        dumpBuild(build, f, format)
+    finally:
+        f.close()
+    if runtime.platformType == 'win32':
+        # windows cannot rename a file on top of an existing one
+        os.unlink(filename)
+    os.rename(tmpfilename, filename)
+    return True
@@ -14,8 +14,10 @@
 # Copyright Buildbot Team Members
 
 import os
-from cStringIO import StringIO
-from bz2 import BZ2File
+import bz2
+import zlib
+import struct
+from bisect import bisect_left, bisect_right
 from gzip import GzipFile
 
 from zope.interface import implements
@@ -29,6 +31,7 @@ STDOUT = interfaces.LOG_CHANNEL_STDOUT
 STDERR = interfaces.LOG_CHANNEL_STDERR
 HEADER = interfaces.LOG_CHANNEL_HEADER
 ChunkTypes = ["stdout", "stderr", "header"]
+NCHANNELS = len(ChunkTypes)
 
 class LogFileScanner(netstrings.NetstringParser):
     def __init__(self, chunk_cb, channels=[]):
@@ -41,6 +44,321 @@ class LogFileScanner(netstrings.NetstringParser):
         if not self.channels or (channel in self.channels):
             self.chunk_cb((channel, line[1:]))
 
+class LogFileIndex:
+    """
+    An index of the chunks of a log file, used to read part of a log without
+    scanning everything that precedes it.
+
+    For each chunk, the index records its offset in the file, its channel, and
+    the number of bytes and of newlines of each channel that precede it.
+    Positions within a set of channels are thus the sum of the counts for
+    those channels.  The index is stored next to the log file, with a
+    '.idx' suffix, as a sequence of fixed-size records; a final record with
+    channel END holds the totals, and marks the index as complete.
+    """
+
+    recordFormat = "!QB%dQ" % (2 * NCHANNELS)
+    recordSize = struct.calcsize(recordFormat)
+    END = 255
+
+    def __init__(self):
+        self.offsets = []
+        self.channels = []
+        self.counts = [] # tuples of bytes and lines per channel
+        self.totals = [0] * (2 * NCHANNELS)
+        self.complete = False
+        self._keys = {}
+
+    def addChunk(self, offset, channel, text):
+        """Adds a chunk written at C{offset} in the log file.
+
+        @returns: the record to append to the index file"""
+        counts = tuple(self.totals)
+        self.offsets.append(offset)
+        self.channels.append(channel)
+        self.counts.append(counts)
+        if channel < NCHANNELS:
+            self.totals[channel] += len(text)
+            self.totals[NCHANNELS + channel] += text.count("\n")
+        return struct.pack(self.recordFormat, offset, channel, *counts)
+
+    def finish(self, offset):
+        """Marks the index as complete; C{offset} is the size of the log file.
+
+        @returns: the record to append to the index file"""
+        self.complete = True
+        return struct.pack(self.recordFormat, offset, self.END, *self.totals)
+
+    def load(cls, data):
+        """Loads the contents of an index file.
+
+        @returns: a L{LogFileIndex}, which is not complete if the index file
+        was truncated"""
+        index = cls()
+        for pos in range(0, len(data) - cls.recordSize + 1, cls.recordSize):
+            record = struct.unpack(cls.recordFormat,
+                                   data[pos:pos + cls.recordSize])
+            if record[1] == cls.END:
+                index.totals = list(record[2:])
+                index.complete = True
+                break
+            index.offsets.append(record[0])
+            index.channels.append(record[1])
+            index.counts.append(record[2:])
+        return index
+    load = classmethod(load)
+
+    def scan(cls, f):
+        """Builds the index of an existing log file, by reading all of it.
+
+        @returns: a complete L{LogFileIndex}"""
+        index = cls()
+        f.seek(0)
+        offset = 0
+        while True:
+            header = f.read(1)
+            while header and header[-1] != ":":
+                c = f.read(1)
+                if not c:
+                    break
+                header += c
+            if not header.endswith(":"):
+                break
+            size = int(header[:-1])
+            data = f.read(size + 1)
+            if len(data) < size + 1:
+                break
+            index.addChunk(offset, int(data[0]), data[1:size])
+            offset += len(header) + size + 1
+        index.finish(offset)
+        return index
+    scan = classmethod(scan)
+
+    def _getKeys(self, channels, lines):
+        # positions before each chunk in the given channels, extended as
+        # chunks are added
+        base = lines and NCHANNELS or 0
+        columns = [ base + c for c in channels if c < NCHANNELS ]
+        keys = self._keys.setdefault((tuple(columns)), [])
+        for counts in self.counts[len(keys):]:
+            keys.append(sum([ counts[c] for c in columns ]))
+        return keys
+
+    def getTotal(self, channels, lines=False):
+        """Returns the number of bytes, or of newlines, in the given
+        channels."""
+        base = lines and NCHANNELS or 0
+        return sum([ self.totals[base + c] for c in channels
+                     if c < NCHANNELS ])
+
+    def findChunk(self, position, channels, lines=False):
+        """Finds where to start reading to reach the given byte position, or
+        the end of the given line, in the given channels.
+
+        @returns: tuple (file offset, position, number of newlines) at the
+        start of the chunk found"""
+        keys = self._getKeys(channels, lines)
+        if lines:
+            # the last chunk that starts before the end of that line
+            i = bisect_left(keys, position) - 1
+        else:
+            # the last chunk that starts at or before that position
+            i = bisect_right(keys, position) - 1
+        if i < 0:
+            return (0, 0, 0)
+        counts = self.counts[i]
+        return (self.offsets[i],
+                sum([ counts[c] for c in channels if c < NCHANNELS ]),
+                sum([ counts[NCHANNELS + c] for c in channels
+                      if c < NCHANNELS ]))
+
+class BlockCompressedFile:
+    """
+    A read-only file object for a log compressed as a sequence of blocks of
+    C{blocksize} bytes, each compressed independently, so that seeking only
+    decompresses the block containing the new position rather than
+    everything before it.  Each block is a complete bz2 stream or gzip
+    member, so the file as a whole can still be decompressed by the usual
+    tools.
+
+    The compressed offset of each block is stored in a table next to the
+    log, with a '.blocks' suffix: the block size, then the offset of each
+    block, then the size of the compressed file, as 64-bit integers.
+    """
+
+    recordFormat = "!Q"
+    recordSize = struct.calcsize(recordFormat)
+
+    def __init__(self, f, method, blocksize, offsets):
+        self.f = f
+        self.method = method
+        self.blocksize = blocksize
+        self.offsets = offsets # start of each block, and end of the last
+        self.pos = 0
+        self.block = None
+        self.data = ""
+
+    def compress(cls, method, data):
+        """Compresses one block of data with the given method."""
+        if method == "bz2":
+            return bz2.compress(data)
+        c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+    compress = classmethod(compress)
+
+    def packOffsets(cls, blocksize, offsets):
+        """Returns the contents of the table of blocks."""
+        return struct.pack("!%dQ" % (len(offsets) + 1), blocksize, *offsets)
+    packOffsets = classmethod(packOffsets)
+
+    def load(cls, f, method, blocksfilename):
+        """Opens the compressed file C{f}, seekable if it has a table of
+        blocks that matches its size.
+
+        @returns: L{BlockCompressedFile} instance, or None if the table is
+        missing or does not match"""
+        try:
+            bf = open(blocksfilename, "rb")
+            try:
+                data = bf.read()
+            finally:
+                bf.close()
+        except IOError:
+            return None
+        count = len(data) // cls.recordSize
+        if count < 2 or len(data) % cls.recordSize:
+            return None
+        records = struct.unpack("!%dQ" % count, data)
+        f.seek(0, 2)
+        if records[0] == 0 or records[-1] != f.tell():
+            return None
+        return cls(f, method, records[0], list(records[1:]))
+    load = classmethod(load)
+
+    def _loadBlock(self, i):
+        self.f.seek(self.offsets[i])
+        data = self.f.read(self.offsets[i + 1] - self.offsets[i])
+        if self.method == "bz2":
+            self.data = bz2.decompress(data)
+        else:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.data = d.decompress(data)
+        self.block = i
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self._getSize()
+        self.pos = max(offset, 0)
+
+    def _getSize(self):
+        last = len(self.offsets) - 2
+        if last < 0:
+            return 0
+        if self.block != last:
+            self._loadBlock(last)
+        return last * self.blocksize + len(self.data)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        data = []
+        while size != 0:
+            i = self.pos // self.blocksize
+            if i >= len(self.offsets) - 1:
+                break
+            if self.block != i:
+                self._loadBlock(i)
+            start = self.pos - i * self.blocksize
+            if size < 0:
+                text = self.data[start:]
+            else:
+                text = self.data[start:start + size]
+                size -= len(text)
+            if not text:
+                break
+            data.append(text)
+            self.pos += len(text)
+        return "".join(data)
+
+    def close(self):
+        self.f.close()
+
+class MultiStreamBZ2File:
+    """
+    A read-only file object for a bz2 file made of one or more concatenated
+    streams, which L{bz2.BZ2File} does not read past the first of.  Like
+    L{bz2.BZ2File}, it decompresses everything before a new position when
+    seeking forward, and starts over when seeking backward.
+    """
+
+    readSize = 64*1024
+
+    def __init__(self, f):
+        self.f = f
+        self._rewind()
+
+    def _rewind(self):
+        self.f.seek(0)
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # decompress more data into the buffer; returns False at the end of
+        # the file
+        while not self.buffer:
+            data = self.f.read(self.readSize)
+            if not data:
+                self.eof = True
+                return False
+            while data:
+                try:
+                    self.buffer += self.decompressor.decompress(data)
+                except EOFError:
+                    # the previous stream ended exactly at the end of the
+                    # last read, so this data starts the next one
+                    self.decompressor = bz2.BZ2Decompressor()
+                    continue
+                data = self.decompressor.unused_data
+                if data:
+                    self.decompressor = bz2.BZ2Decompressor()
+        return True
+
+    def read(self, size=-1):
+        data = []
+        while size != 0 and (self.buffer or (not self.eof and self._fill())):
+            if size < 0:
+                text, self.buffer = self.buffer, ""
+            else:
+                text, self.buffer = self.buffer[:size], self.buffer[size:]
+                size -= len(text)
+            data.append(text)
+            self.pos += len(text)
+        return "".join(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            while self.read(self.readSize):
+                pass
+            offset += self.pos
+        if offset < self.pos:
+            self._rewind()
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, self.readSize)):
+                break
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
 class LogFileProducer:
     """What's the plan?
 
@@ -204,7 +522,10 @@ class LogFile:
     BUFFERSIZE = 2048
     filename = None # relative to the Builder's basedir
     openfile = None
+    index = None
+    indexfile = None
     compressMethod = "bz2"
+    compressBlockSize = 256*1024
 
     def __init__(self, parent, name, logfilename):
         """
@@ -229,6 +550,8 @@ class LogFile:
         if not os.path.exists(dirname):
             os.makedirs(dirname)
         self.openfile = open(fn, "w+")
+        self.index = LogFileIndex()
+        self.indexfile = open(fn + ".idx", "wb")
         self.runEntries = []
         self.watchers = []
         self.finishedWatchers = []
@@ -307,15 +630,24 @@ class LogFile:
             # don't close it!
             return self.openfile
         # otherwise they get their own read-only handle
-        # try a compressed log first
-        try:
-            return BZ2File(self.getFilename() + ".bz2", "r")
-        except IOError:
-            pass
-        try:
-            return GzipFile(self.getFilename() + ".gz", "r")
-        except IOError:
-            pass
+        # try a compressed log first, seeking by blocks if it was compressed
+        # in blocks
+        for method in "bz2", "gz":
+            filename = self.getFilename() + "." + method
+            try:
+                f = open(filename, "rb")
+            except IOError:
+                continue
+            blockfile = BlockCompressedFile.load(f, method,
+                                        self.getFilename() + ".blocks")
+            if blockfile:
+                return blockfile
+            # otherwise read it from the start; it may still be made of
+            # several blocks, if the table of blocks was lost
+            f.seek(0)
+            if method == "bz2":
+                return MultiStreamBZ2File(f)
+            return GzipFile(fileobj=f, mode="rb")
         return open(self.getFilename(), "r")
 
     def getText(self):
@@ -325,12 +657,16 @@ class LogFile:
     def getTextWithHeaders(self):
         return "".join(self.getChunks(onlyText=True))
 
-    def getChunks(self, channels=[], onlyText=False):
+    def getChunks(self, channels=[], onlyText=False, start=None, end=None):
         # generate chunks for everything that was logged at the time we were
         # first called, so remember how long the file was when we started.
         # Don't read beyond that point. The current contents of
         # self.runEntries will follow.
 
+        # If start or end are given, only the text between those byte
+        # positions within the given channels is generated, and the file is
+        # read from the chunk containing start, found in the index.
+
         # this returns an iterator, which means arbitrary things could happen
         # while we're yielding. This will faithfully deliver the log as it
         # existed when it was started, and not return anything after that
@@ -338,6 +674,9 @@ class LogFile:
         # data, you must insure that nothing will be added to the log during
         # yield() calls.
 
+        if start is not None or end is not None:
+            return self._getChunkRange(channels, onlyText, start, end)
+
         f = self.getFile()
         if not self.finished:
             offset = 0
@@ -347,17 +686,140 @@ class LogFile:
             offset = 0
             remaining = None
 
-        leftover = None
-        if self.runEntries and (not channels or
-                                (self.runEntries[0][0] in channels)):
-            leftover = (self.runEntries[0][0],
-                        "".join([c[1] for c in self.runEntries]))
+        leftover = self._getLeftover(channels)
 
         # freeze the state of the LogFile by passing a lot of parameters into
         # a generator
         return self._generateChunks(f, offset, remaining, leftover,
                                     channels, onlyText)
 
+    def _getLeftover(self, channels):
+        # the text that is not yet in the file, if it is in one of the given
+        # channels
+        if self.runEntries and (not channels or
+                                (self.runEntries[0][0] in channels)):
+            return (self.runEntries[0][0],
+                    "".join([c[1] for c in self.runEntries]))
+        return None
+
+    def _getChunkRange(self, channels, onlyText, start, end):
+        channels = channels or range(NCHANNELS)
+        index = self.getIndex()
+        if start is None or start < 0:
+            start = 0
+        offset, position, lines = index.findChunk(start, channels)
+        f = self.getFile()
+        if not self.finished:
+            f.seek(0, 2)
+            remaining = f.tell() - offset
+        else:
+            remaining = None
+        chunks = self._generateChunks(f, offset, remaining,
+                        self._getLeftover(channels), channels, False)
+        return self._trimChunks(chunks, position, start, end, onlyText)
+
+    def _trimChunks(self, chunks, position, start, end, onlyText):
+        for channel, text in chunks:
+            if end is not None and position >= end:
+                break
+            size = len(text)
+            if position + size > start:
+                if position < start or (end is not None and
+                                        position + size > end):
+                    first = max(start - position, 0)
+                    last = size
+                    if end is not None:
+                        last = min(end - position, size)
+                    text = text[first:last]
+                if onlyText:
+                    yield text
+                else:
+                    yield (channel, text)
+            position += size
+
+    def getIndex(self):
+        """
+        Get the L{LogFileIndex} of this log, loading it from the index file,
+        or building it by reading the log if the index file is missing or
+        incomplete.
+
+        @returns: L{LogFileIndex} instance
+        """
+        if self.index is None:
+            index = None
+            try:
+                f = open(self.getFilename() + ".idx", "rb")
+                try:
+                    index = LogFileIndex.load(f.read())
+                finally:
+                    f.close()
+            except IOError:
+                pass
+            if index is None or not index.complete:
+                index = LogFileIndex.scan(self.getFile())
+            self.index = index
+        return self.index
+
+    def getLength(self, channels=[]):
+        """
+        Get the number of bytes in the given channels of this log, or in all
+        channels.
+
+        @returns: integer
+        """
+        channels = channels or range(NCHANNELS)
+        length = self.getIndex().getTotal(channels)
+        leftover = self._getLeftover(channels)
+        if leftover:
+            length += len(leftover[1])
+        return length
+
+    def getLineCount(self, channels=[]):
+        """
+        Get the number of newlines in the given channels of this log, or in
+        all channels.
+
+        @returns: integer
+        """
+        channels = channels or range(NCHANNELS)
+        count = self.getIndex().getTotal(channels, lines=True)
+        leftover = self._getLeftover(channels)
+        if leftover:
+            count += leftover[1].count("\n")
+        return count
+
+    def getLinePosition(self, line, channels=[]):
+        """
+        Get the byte position at which the given line (counting from 0)
+        starts, within the given channels of this log, or within all
+        channels.  The positions of lines beyond the end of the log are that
+        of the end of the log.
+
+        @returns: integer, suitable as the C{start} of L{getChunks}
+        """
+        if line <= 0:
+            return 0
+        channels = channels or range(NCHANNELS)
+        offset, position, lines = self.getIndex().findChunk(line, channels,
+                                                            lines=True)
+        f = self.getFile()
+        if not self.finished:
+            f.seek(0, 2)
+            remaining = f.tell() - offset
+        else:
+            remaining = None
+        for text in self._generateChunks(f, offset, remaining,
+                        self._getLeftover(channels), channels, True):
+            count = text.count("\n")
+            if lines + count >= line:
+                pos = -1
+                for i in range(line - lines):
+                    pos = text.index("\n", pos + 1)
+                return position + pos + 1
+            lines += count
+            position += len(text)
+        return position
+
     def _generateChunks(self, f, offset, remaining, leftover,
                         channels, onlyText):
         chunks = []
@@ -393,15 +855,39 @@ class LogFile:
             else:
                 yield leftover
 
-    def readlines(self, channel=STDOUT):
+    def readlines(self, channel=STDOUT, channels=None):
         """Return an iterator that produces newline-terminated lines,
-        excluding header chunks."""
-        # TODO: make this memory-efficient, by turning it into a generator
-        # that retrieves chunks as necessary, like a pull-driven version of
-        # twisted.protocols.basic.LineReceiver
-        alltext = "".join(self.getChunks([channel], onlyText=True))
-        io = StringIO(alltext)
-        return io.readlines()
+        excluding header chunks.
+
+        The lines are read from the log as they are consumed, so that only
+        one chunk, and the current line, are kept in memory.
+
+        @param channel: the channel to read
+        @param channels: a list of channels to read instead, whose text is
+        merged as in L{getText}
+        """
+        if channels is None:
+            channels = [channel]
+        return self._generateLines(self.getChunks(channels, onlyText=True))
+
+    def _generateLines(self, chunks):
+        partial = []
+        for text in chunks:
+            if "\n" not in text:
+                partial.append(text)
+                continue
+            lines = text.split("\n")
+            if partial:
+                partial.append(lines[0])
+                lines[0] = "".join(partial)
+                partial = []
+            last = lines.pop()
+            for line in lines:
+                yield line + "\n"
+            if last:
+                partial.append(last)
+        if partial:
+            yield "".join(partial)
 
     def subscribe(self, receiver, catchup):
         if self.finished:
@@ -436,6 +922,9 @@ class LogFile:
         offset = 0
         while offset < len(text):
             size = min(len(text)-offset, self.chunkSize)
+            if self.indexfile:
+                self.indexfile.write(self.index.addChunk(f.tell(), channel,
+                                            text[offset:offset+size]))
             f.write("%d:%d" % (1 + size, channel))
             f.write(text[offset:offset+size])
             f.write(",")
@@ -557,8 +1046,14 @@ class LogFile:
             # we don't do an explicit close, because there might be readers
             # shareing the filehandle. As soon as they stop reading, the
             # filehandle will be released and automatically closed.
+            self.openfile.seek(0, 2)
+            if self.indexfile:
+                self.indexfile.write(self.index.finish(self.openfile.tell()))
             self.openfile.flush()
             self.openfile = None
+        if self.indexfile:
+            self.indexfile.close()
+            self.indexfile = None
         self.finished = True
         watchers = self.finishedWatchers
         self.finishedWatchers = []
@@ -576,26 +1071,32 @@ class LogFile:
         else:
             return defer.succeed(None)
 
+        blocks = self.getFilename() + ".blocks.tmp"
+
         def _compressLog():
+            # compress the log in independent blocks, recording where each
+            # one starts, so that it can be read from any position cheaply;
+            # see BlockCompressedFile
             infile = self.getFile()
-            if self.compressMethod == "bz2":
-                cf = BZ2File(compressed, 'w')
-            elif self.compressMethod == "gz":
-                cf = GzipFile(compressed, 'w')
-            bufsize = 1024*1024
+            cf = open(compressed, 'wb')
+            offsets = []
+            bufsize = self.compressBlockSize
             while True:
                 buf = infile.read(bufsize)
-                cf.write(buf)
+                if buf or not offsets:
+                    offsets.append(cf.tell())
+                    cf.write(BlockCompressedFile.compress(
+                                        self.compressMethod, buf))
                 if len(buf) < bufsize:
                     break
+            offsets.append(cf.tell())
             cf.close()
+            bf = open(blocks, 'wb')
+            bf.write(BlockCompressedFile.packOffsets(bufsize, offsets))
+            bf.close()
         d = threads.deferToThread(_compressLog)
 
-        def _renameCompressedLog(rv):
-            if self.compressMethod == "bz2":
-                filename = self.getFilename() + '.bz2'
-            else:
-                filename = self.getFilename() + '.gz'
+        def _rename(tmpfilename, filename):
             if runtime.platformType  == 'win32':
                 # windows cannot rename a file on top of an existing one, so
                 # fall back to delete-first. There are ways this can fail and
@@ -603,14 +1104,25 @@ class LogFile:
                 # general (non-windows) case
                 if os.path.exists(filename):
                     os.unlink(filename)
-            os.rename(compressed, filename)
+            os.rename(tmpfilename, filename)
+
+        def _renameCompressedLog(rv):
+            if self.compressMethod == "bz2":
+                filename = self.getFilename() + '.bz2'
+            else:
+                filename = self.getFilename() + '.gz'
+            # the table of blocks goes first, so that it is in place whenever
+            # the compressed log is
+            _rename(blocks, self.getFilename() + '.blocks')
+            _rename(compressed, filename)
             _tryremove(self.getFilename(), 1, 5)
         d.addCallback(_renameCompressedLog)
 
         def _cleanupFailedCompress(failure):
             log.msg("failed to compress %s" % self.getFilename())
-            if os.path.exists(compressed):
-                _tryremove(compressed, 1, 5)
+            for filename in compressed, blocks:
+                if os.path.exists(filename):
+                    _tryremove(filename, 1, 5)
             failure.trap() # reraise the failure
         d.addErrback(_cleanupFailedCompress)
         return d
@@ -627,6 +1139,9 @@ class LogFile:
             del d['finished']
         if d.has_key('openfile'):
             del d['openfile']
+        for k in ('index', 'indexfile'):
+            if k in d:
+                del d[k]
         return d
 
     def __setstate__(self, d):
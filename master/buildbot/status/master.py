@@ -16,14 +16,13 @@
 import os, urllib
 from cPickle import load
 from twisted.python import log
-from twisted.persisted import styles
 from twisted.internet import defer
 from zope.interface import implements
 from buildbot import interfaces
 from buildbot.util import bbcollections
 from buildbot.util.eventual import eventually
 from buildbot.changes import changes
-from buildbot.status import buildset, builder, buildrequest
+from buildbot.status import buildset, builder, buildrequest, buildstore
 
 class Status:
     """
@@ -40,6 +39,8 @@ class Status:
         # compress logs bigger than 4k, a good default on linux
         self.logCompressionLimit = 4*1024
         self.logCompressionMethod = "bz2"
+        # store finished builds as pickles, by default
+        self.buildStatusFormat = "pickle"
         # No default limit to the log size
         self.logMaxSize = None
         self.logMaxTailSize = None
@@ -175,7 +176,8 @@ class Status:
         return self.botmaster.slaves[slavename].slave_status
 
     def getBuildSets(self):
-        d = self.master.db.buildsets.getBuildsets(complete=False)
+        d = self.master.db.buildsets.getBuildsets(complete=False,
+                                                  fresh=False)
         def make_status_objects(bsdicts):
             return [ buildset.BuildSetStatus(bsdict, self)
                     for bsdict in bsdicts ]
@@ -184,7 +186,7 @@ class Status:
 
     def generateFinishedBuilds(self, builders=[], branches=[],
                                num_builds=None, finished_before=None,
-                               max_search=200):
+                               results=None, max_search=200):
 
         def want_builder(bn):
             if builders:
@@ -202,6 +204,7 @@ class Status:
             b = self.getBuilder(bn)
             g = b.generateFinishedBuilds(branches,
                                          finished_before=finished_before,
+                                         results=results,
                                          max_search=max_search)
             sources.append(g)
 
@@ -265,16 +268,18 @@ class Status:
         log.msg("trying to load status pickle from %s" % filename)
         builder_status = None
         try:
+            # builds may be being loaded in threads meanwhile, so only this
+            # pickle's objects are upgraded; see buildbot.status.buildstore
+            buildstore.beginLoad()
             builder_status = load(open(filename, "rb"))
             
             # (bug #1068) if we need to upgrade, we probably need to rewrite
             # this pickle, too.  We determine this by looking at the list of
-            # Versioned objects that have been unpickled, and (after doUpgrade)
-            # checking to see if any of them set wasUpgraded.  The Versioneds'
-            # upgradeToVersionNN methods all set this.
-            versioneds = styles.versionedsToUpgrade
-            styles.doUpgrade()
-            if True in [ hasattr(o, 'wasUpgraded') for o in versioneds.values() ]:
+            # Versioned objects that have been unpickled, and (after the
+            # upgrade) checking to see if any of them set wasUpgraded.  The
+            # Versioneds' upgradeToVersionNN methods all set this.
+            versioneds = buildstore.upgradeLoaded()
+            if True in [ hasattr(o, 'wasUpgraded') for o in versioneds ]:
                 log.msg("re-writing upgraded builder pickle")
                 builder_status.saveYourself()
 
@@ -294,6 +299,7 @@ class Status:
         builder_status.basedir = os.path.join(self.basedir, basedir)
         builder_status.name = name # it might have been updated
         builder_status.status = self
+        builder_status.setCacheManager(self.master.caches)
 
         if not os.path.isdir(builder_status.basedir):
             os.makedirs(builder_status.basedir)
@@ -302,6 +308,7 @@ class Status:
         builder_status.setBigState("offline")
         builder_status.setLogCompressionLimit(self.logCompressionLimit)
         builder_status.setLogCompressionMethod(self.logCompressionMethod)
+        builder_status.setBuildStatusFormat(self.buildStatusFormat)
         builder_status.setLogMaxSize(self.logMaxSize)
         builder_status.setLogMaxTailSize(self.logMaxTailSize)
 
@@ -311,6 +318,7 @@ class Status:
         return builder_status
 
     def builderRemoved(self, name):
+        self.master.caches.remove_cache("builds/%s" % name)
         for t in self.watchers:
             if hasattr(t, 'builderRemoved'):
                 t.builderRemoved(name)
@@ -16,9 +16,12 @@
 
 from collections import deque
 import os
+import re
+import struct
 import cPickle as pickle
 
 from zope.interface import implements, Interface
+from twisted.python import log, runtime
 
 
 def ReadFile(path):
@@ -251,6 +254,286 @@ class DiskQueue(object):
             self.lastItemId = files[-1]
 
 
+class SegmentedDiskQueue(object):
+    """Keeps a list of abstract items on disk, many items per file.
+
+    Items are appended to segment files named segment-<N>, each holding up to
+    segmentItems length-prefixed records.  A small checkpoint file records the
+    first segment and the offset of the first unread record in each partially
+    read segment, so popChunk() and insertBackChunk() only read or write the
+    items they return or insert, sequentially.  Segments are deleted once all
+    of their items have been popped.
+
+    Items left in the directory by L{DiskQueue}, one file per item, are
+    migrated into segments when the queue is created."""
+    implements(IQueue)
+
+    checkpointName = 'checkpoint'
+    _segment_re = re.compile(r'^segment-(-?[0-9]+)$')
+    _length = struct.Struct('>I')
+
+    def __init__(self, path, maxItems=None, pickleFn=pickle.dumps,
+                 unpickleFn=pickle.loads, segmentItems=1000):
+        """
+        @path: directory to save the items.
+        @maxItems: maximum number of items to keep on disk, flush the
+        older ones.
+        @pickleFn: function used to pack the items to disk.
+        @unpickleFn: function used to unpack items from disk.
+        @segmentItems: number of items to append to a segment file before
+        starting a new one.
+        """
+        self.path = path
+        self._maxItems = maxItems
+        if self._maxItems is None:
+            self._maxItems = 100000
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        self.pickleFn = pickleFn
+        self.unpickleFn = unpickleFn
+        self.segmentItems = segmentItems
+
+        # [number, offset of the first unread record, number of unread
+        # records] for each segment, oldest first.
+        self._segments = deque()
+        # Number of records in the last segment, read or not.
+        self._tailRecords = 0
+        # Highest segment number used so far.
+        self._lastNumber = -1
+        self._nbItems = 0
+        self._loadFromDisk()
+
+    def pushItem(self, item):
+        ret = None
+        if self._nbItems >= self._maxItems:
+            ret = self.popChunk(1)[0]
+        data = self.pickleFn(item)
+        if not self._segments or self._tailRecords >= self.segmentItems:
+            self._lastNumber += 1
+            self._segments.append([self._lastNumber, 0, 0])
+            self._tailRecords = 0
+        segment = self._segments[-1]
+        self._writeRecords(segment[0], [data], 'ab')
+        segment[2] += 1
+        self._tailRecords += 1
+        self._nbItems += 1
+        return ret
+
+    def insertBackChunk(self, chunk):
+        ret = None
+        excess = self._nbItems + len(chunk) - self._maxItems
+        if excess > 0:
+            ret = chunk[0:excess]
+            chunk = chunk[excess:]
+        if chunk:
+            self._insertRecords([ self.pickleFn(i) for i in chunk ])
+        return ret
+
+    def popChunk(self, nbItems=None):
+        if nbItems is None:
+            nbItems = self._maxItems
+        ret = []
+        exhausted = []
+        while len(ret) < nbItems and self._segments:
+            segment = self._segments[0]
+            if segment[2]:
+                records, segment[1] = self._readRecords(segment[0],
+                        segment[1], min(nbItems - len(ret), segment[2]))
+                segment[2] -= len(records)
+                ret.extend([ self.unpickleFn(data) for data in records ])
+            if not segment[2]:
+                self._segments.popleft()
+                exhausted.append(segment[0])
+        self._nbItems -= len(ret)
+        if not self._segments:
+            self._tailRecords = 0
+        if ret or exhausted:
+            self._saveCheckpoint()
+        # The checkpoint no longer refers to these, so they can go.
+        for number in exhausted:
+            os.remove(self._segmentPath(number))
+        return ret
+
+    def save(self):
+        self._saveCheckpoint()
+
+    def items(self):
+        """Reads all the segments."""
+        ret = []
+        for number, offset, count in self._segments:
+            records, _ = self._readRecords(number, offset, count)
+            ret.extend([ self.unpickleFn(data) for data in records ])
+        return ret
+
+    def nbItems(self):
+        return self._nbItems
+
+    def maxItems(self):
+        return self._maxItems
+
+    #### Protected functions
+
+    def _segmentPath(self, number):
+        return os.path.join(self.path, 'segment-%d' % number)
+
+    def _writeRecords(self, number, records, mode):
+        f = open(self._segmentPath(number), mode)
+        try:
+            for data in records:
+                f.write(self._length.pack(len(data)))
+                f.write(data)
+        finally:
+            f.close()
+
+    def _readRecords(self, number, offset, count):
+        """Returns up to count records from the given offset, and the offset
+        following them."""
+        records = []
+        f = open(self._segmentPath(number), 'rb')
+        try:
+            f.seek(offset)
+            for i in range(count):
+                header = f.read(self._length.size)
+                if len(header) < self._length.size:
+                    raise IOError('%s is truncated.' %
+                                  self._segmentPath(number))
+                length, = self._length.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    raise IOError('%s is truncated.' %
+                                  self._segmentPath(number))
+                records.append(data)
+            return records, f.tell()
+        finally:
+            f.close()
+
+    def _insertRecords(self, records):
+        """Writes already pickled items to a new segment before all the
+        others."""
+        if self._segments:
+            number = self._segments[0][0] - 1
+        else:
+            self._lastNumber += 1
+            number = self._lastNumber
+        path = self._segmentPath(number)
+        if os.path.exists(path):
+            raise IOError('%s already exists.' % path)
+        self._writeRecords(number, records, 'wb')
+        if not self._segments:
+            self._tailRecords = len(records)
+        self._segments.appendleft([number, 0, len(records)])
+        self._nbItems += len(records)
+        self._saveCheckpoint()
+
+    def _saveCheckpoint(self):
+        path = os.path.join(self.path, self.checkpointName)
+        if not self._segments:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        checkpoint = dict(first=self._segments[0][0],
+                offsets=dict([ (number, offset)
+                               for number, offset, count in self._segments
+                               if offset ]))
+        WriteFile(path + '.tmp', pickle.dumps(checkpoint, -1))
+        if runtime.platformType == 'win32':
+            # windows cannot rename a file on top of an existing one
+            if os.path.exists(path):
+                os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def _scanSegment(self, number, offset):
+        """Counts the records of a segment, in total and from the given
+        offset.  A partially written last record is removed."""
+        path = self._segmentPath(number)
+        size = os.path.getsize(path)
+        total = count = pos = 0
+        f = open(path, 'rb')
+        try:
+            while pos < size:
+                header = f.read(self._length.size)
+                if len(header) < self._length.size:
+                    break
+                length, = self._length.unpack(header)
+                end = pos + self._length.size + length
+                if end > size:
+                    break
+                f.seek(end)
+                if pos >= offset:
+                    count += 1
+                total += 1
+                pos = end
+        finally:
+            f.close()
+        if pos < size:
+            log.msg('truncating partially written item in %s' % path)
+            f = open(path, 'r+b')
+            try:
+                f.truncate(pos)
+            finally:
+                f.close()
+        return count, total
+
+    def _loadFromDisk(self):
+        """Finds the segments and their unread items, and migrates any items
+        saved by L{DiskQueue}."""
+        numbers = []
+        legacy = []
+        for name in os.listdir(self.path):
+            mo = self._segment_re.match(name)
+            if mo:
+                numbers.append(int(mo.group(1)))
+                continue
+            try:
+                legacy.append(int(name))
+            except ValueError:
+                pass
+        numbers.sort()
+
+        checkpoint = {}
+        path = os.path.join(self.path, self.checkpointName)
+        if os.path.exists(path):
+            try:
+                checkpoint = pickle.loads(ReadFile(path))
+            except Exception:
+                log.msg('ignoring damaged queue checkpoint %s' % path)
+        first = checkpoint.get('first', numbers and numbers[0] or 0)
+        offsets = checkpoint.get('offsets', {})
+
+        if numbers:
+            self._lastNumber = max(numbers[-1], first - 1)
+        for number in numbers:
+            if number >= first:
+                count, total = self._scanSegment(number,
+                                                 offsets.get(number, 0))
+                if count:
+                    self._segments.append(
+                            [number, offsets.get(number, 0), count])
+                    self._nbItems += count
+                    self._tailRecords = total
+                    continue
+            # already read
+            os.remove(self._segmentPath(number))
+        self._saveCheckpoint()
+
+        if legacy:
+            self._migrate(sorted(legacy))
+
+    def _migrate(self, ids):
+        # The items are already pickled, so they are copied as they are.
+        excess = self._nbItems + len(ids) - self._maxItems
+        if excess > 0:
+            log.msg('dropping the %d oldest items of %s' % (excess, self.path))
+        records = [ ReadFile(os.path.join(self.path, str(id)))
+                    for id in ids[max(excess, 0):] ]
+        if records:
+            self._insertRecords(records)
+        for id in ids:
+            os.remove(os.path.join(self.path, str(id)))
+        log.msg('migrated %d queued items in %s to segments'
+                % (len(records), self.path))
+
+
 class PersistentQueue(object):
     """Keeps a list of abstract items and serializes it to the disk.
 
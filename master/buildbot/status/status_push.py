@@ -19,10 +19,12 @@
 Implements the HTTP receiver."""
 
 import datetime
+import gzip
 import logging
 import os
 import urllib
 import urlparse
+from cStringIO import StringIO
 
 try:
     import simplejson as json
@@ -31,12 +33,15 @@ except ImportError:
     import json
 
 from buildbot.status.base import StatusReceiverMultiService
-from buildbot.status.persistent_queue import DiskQueue, IndexedQueue, \
-        MemoryQueue, PersistentQueue
+from buildbot.status.persistent_queue import IndexedQueue, \
+        MemoryQueue, PersistentQueue, SegmentedDiskQueue
 from buildbot.status.web.status_json import FilterOut
-from twisted.internet import defer, reactor
+from buildbot.process import metrics
+from buildbot import util
+from twisted.internet import defer, reactor, protocol
 from twisted.python import log
-from twisted.web import client
+from twisted.web import client, error, http
+from twisted.web.http_headers import Headers
 
 
 
@@ -49,8 +54,13 @@ class StatusPush(StatusReceiverMultiService):
     shutdown so they can be pushed back when the master is restarted.
     """
 
+    # Events that are superseded by a later event of the same kind for the same
+    # build or step, when coalescing.
+    coalescedEvents = ('buildETAUpdate', 'stepETAUpdate', 'stepTextChanged',
+                       'stepText2Changed')
+
     def __init__(self, serverPushCb, queue=None, path=None, filter=True,
-                 bufferDelay=1, retryDelay=5, blackList=None):
+                 bufferDelay=1, retryDelay=5, blackList=None, coalesce=False):
         """
         @serverPushCb: callback to be used. It receives 'self' as parameter. It
         should call self.queueNextServerPush() when it's done to queue the next
@@ -66,6 +76,9 @@ class StatusPush(StatusReceiverMultiService):
         @retryDelay: amount of time between retries when no items were pushed on
         last serverPushCb call.
         @blackList: events that shouldn't be sent.
+        @coalesce: when True, events listed in coalescedEvents are held back
+        until the next push, and only the latest one for each build or step is
+        sent.
         """
         StatusReceiverMultiService.__init__(self)
 
@@ -78,9 +91,15 @@ class StatusPush(StatusReceiverMultiService):
         self.filter = filter
         self.bufferDelay = bufferDelay
         self.retryDelay = retryDelay
+        self.coalesce = coalesce
+        # Coalesced packets waiting for the next push, and the order in which
+        # their keys were first seen.
+        self.pendingPackets = {}
+        self.pendingKeys = []
         if not callable(serverPushCb):
             raise NotImplementedError('Please pass serverPushCb parameter.')
         def hookPushCb():
+            self.flushPendingPackets()
             # Update the index so we know if the next push succeed or not, don't
             # update the value when the queue is empty.
             if not self.queue.nbItems():
@@ -185,6 +204,7 @@ class StatusPush(StatusReceiverMultiService):
     def stopService(self):
         """Shutting down."""
         self.finalPush()
+        self.flushPendingPackets()
         self.stopped = True
         if (self.task and self.task.active()):
             # We don't have time to wait, force an immediate call.
@@ -216,10 +236,11 @@ class StatusPush(StatusReceiverMultiService):
         """
         if self.blackList and event in self.blackList:
             return
+        key = None
+        if self.coalesce and event in self.coalescedEvents:
+            key = self.getCoalesceKey(event, objs)
         # First, generate the packet.
         packet = {}
-        packet['id'] = self.state['next_id']
-        self.state['next_id'] += 1
         packet['timestamp'] = str(datetime.datetime.utcnow())
         packet['project'] = self.status.getTitle()
         packet['started'] = self.state['started']
@@ -231,11 +252,45 @@ class StatusPush(StatusReceiverMultiService):
             if self.filter:
                 obj = FilterOut(obj)
             packet['payload'][obj_name] = obj
-        self.queue.pushItem(packet)
+        if key is not None:
+            if key in self.pendingPackets:
+                metrics.MetricCountEvent.log('StatusPush.events_coalesced', 1)
+            else:
+                self.pendingKeys.append(key)
+            self.pendingPackets[key] = packet
+        else:
+            # Keep the coalesced events ahead of this one.
+            self.flushPendingPackets()
+            self.queuePacket(packet)
         if self.task is None or not self.task.active():
             # No task queued since it was probably idle, let's queue a task.
             return self.queueNextServerPush()
 
+    def queuePacket(self, packet):
+        """Number a packet and add it to the queue."""
+        packet['id'] = self.state['next_id']
+        self.state['next_id'] += 1
+        self.queue.pushItem(packet)
+
+    def flushPendingPackets(self):
+        """Queue the coalesced packets held back since the last push."""
+        keys = self.pendingKeys
+        self.pendingKeys = []
+        for key in keys:
+            self.queuePacket(self.pendingPackets.pop(key))
+
+    def getCoalesceKey(self, event, objs):
+        """Returns the key identifying the build or step an event is about;
+        only the latest event with a given key is sent."""
+        step = objs.get('step')
+        build = objs.get('build')
+        if build is None and step is not None:
+            build = step.getBuild()
+        if build is None:
+            return None
+        return (event, build.getBuilder().getName(), build.getNumber(),
+                step and step.getName())
+
     #### Events
 
     def initialPush(self):
@@ -323,12 +378,28 @@ class StatusPush(StatusReceiverMultiService):
         self.push('slaveDisconnected', slavename=slavename)
 
 
+class DiscardBody(protocol.Protocol):
+    """Reads and ignores a response body, then fires a Deferred."""
+
+    def __init__(self, finished):
+        self.finished = finished
+
+    def dataReceived(self, data):
+        pass
+
+    def connectionLost(self, reason):
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+
 class HttpStatusPush(StatusPush):
     """Event streamer to a HTTP server."""
 
     def __init__(self, serverUrl, debug=None, maxMemoryItems=None,
                  maxDiskItems=None, chunkSize=200, maxHttpRequestSize=2**20,
-                 **kwargs):
+                 compress=False, maxInFlight=1, persistent=False, **kwargs):
         """
         @serverUrl: Base URL to be used to push events notifications.
         @maxMemoryItems: Maximum number of items to keep queued in memory.
@@ -338,6 +409,11 @@ class HttpStatusPush(StatusPush):
         @chunkSize: maximum number of items to send in each at each HTTP POST.
         @maxHttpRequestSize: limits the size of encoded data for AE, the default
         is 1MB.
+        @compress: gzip the request bodies, and send them with a
+        "Content-Encoding: gzip" header.
+        @maxInFlight: maximum number of HTTP POSTs to send at once.
+        @persistent: reuse HTTP connections between requests; requires a
+        version of Twisted providing twisted.web.client.HTTPConnectionPool.
         """
         # Parameters.
         self.serverUrl = serverUrl
@@ -345,13 +421,26 @@ class HttpStatusPush(StatusPush):
         self.chunkSize = chunkSize
         self.lastPushWasSuccessful = True
         self.maxHttpRequestSize = maxHttpRequestSize
+        self.compress = compress
+        self.maxInFlight = max(1, maxInFlight)
+        self.agent = None
+        if persistent:
+            if hasattr(client, 'HTTPConnectionPool'):
+                pool = client.HTTPConnectionPool(reactor, persistent=True)
+                pool.maxPersistentPerHost = self.maxInFlight
+                self.agent = client.Agent(reactor, pool=pool)
+            else:
+                log.msg("HttpStatusPush: this version of Twisted cannot "
+                        "keep HTTP connections open; not using persistent "
+                        "connections")
         if maxDiskItems != 0:
             # The queue directory is determined by the server url.
             path = ('events_' +
                     urlparse.urlparse(self.serverUrl)[1].split(':')[0])
             queue = PersistentQueue(
                         primaryQueue=MemoryQueue(maxItems=maxMemoryItems),
-                        secondaryQueue=DiskQueue(path, maxItems=maxDiskItems))
+                        secondaryQueue=SegmentedDiskQueue(path,
+                                                          maxItems=maxDiskItems))
         else:
             path = None
             queue = MemoryQueue(maxItems=maxMemoryItems)
@@ -363,6 +452,21 @@ class HttpStatusPush(StatusPush):
     def wasLastPushSuccessful(self):
         return self.lastPushWasSuccessful
 
+    def encodeItems(self, items):
+        """Encodes items as the body of a POST."""
+        if self.debug:
+            packets = json.dumps(items, indent=2, sort_keys=True)
+        else:
+            packets = json.dumps(items, separators=(',',':'))
+        data = urllib.urlencode({'packets': packets})
+        if self.compress:
+            buf = StringIO()
+            f = gzip.GzipFile(mode='wb', fileobj=buf)
+            f.write(data)
+            f.close()
+            data = buf.getvalue()
+        return data
+
     def popChunk(self):
         """Pops items from the pending list.
 
@@ -374,11 +478,7 @@ class HttpStatusPush(StatusPush):
 
         while True:
             items = self.queue.popChunk(chunkSize)
-            if self.debug:
-                packets = json.dumps(items, indent=2, sort_keys=True)
-            else:
-                packets = json.dumps(items, separators=(',',':'))
-            data = urllib.urlencode({'packets': packets})
+            data = self.encodeItems(items)
             if (not self.maxHttpRequestSize or
                 len(data) < self.maxHttpRequestSize):
                 return (data, items)
@@ -394,37 +494,94 @@ class HttpStatusPush(StatusPush):
                 self.queue.insertBackChunk(items)
 
     def pushHttp(self):
-        """Do the HTTP POST to the server."""
-        (encoded_packets, items) = self.popChunk()
-
-        def Success(result):
-            """Queue up next push."""
+        """Do the HTTP POSTs to the server.
+
+        Up to maxInFlight chunks are sent at once, or a single item while the
+        server is failing.  Chunks that could not be sent are queued back, in
+        order, although they may then be delivered after later chunks that
+        were sent successfully."""
+        chunks = []
+        while len(chunks) < self.maxInFlight and self.queue.nbItems():
+            if chunks and not self.wasLastPushSuccessful():
+                break
+            chunks.append(self.popChunk())
+
+        failed = []
+        def Success(result, data, items, started):
             log.msg('Sent %d events to %s' % (len(items), self.serverUrl))
-            self.lastPushWasSuccessful = True
-            return self.queueNextServerPush()
-
-        def Failure(result):
-            """Insert back items not sent and queue up next push."""
+            metrics.MetricCountEvent.log('HttpStatusPush.events_sent',
+                                         len(items))
+            metrics.MetricCountEvent.log('HttpStatusPush.bytes_sent',
+                                         len(data))
+            metrics.MetricTimeEvent.log('HttpStatusPush.request_time',
+                                        util.now() - started)
+
+        def Failure(result, index, items):
             # Server is now down.
             log.msg('Failed to push %d events to %s: %s' %
                     (len(items), self.serverUrl, str(result)))
-            self.queue.insertBackChunk(items)
-            if self.stopped:
-                # Bad timing, was being called on shutdown and the server died
-                # on us. Make sure the queue is saved since we just queued back
-                # items.
-                self.queue.save()
-            self.lastPushWasSuccessful = False
+            metrics.MetricCountEvent.log('HttpStatusPush.failed_requests', 1)
+            failed.append((index, items))
+
+        dl = []
+        for index, (data, items) in enumerate(chunks):
+            d = self.postData(data)
+            d.addCallbacks(Success, Failure,
+                           callbackArgs=(data, items, util.now()),
+                           errbackArgs=(index, items))
+            dl.append(d)
+
+        def Done(_):
+            """Insert back items not sent and queue up next push."""
+            if failed:
+                # The oldest chunk is inserted last, so it ends up first.
+                failed.sort()
+                for index, items in reversed(failed):
+                    self.queue.insertBackChunk(items)
+                if self.stopped:
+                    # Bad timing, was being called on shutdown and the server
+                    # died on us. Make sure the queue is saved since we just
+                    # queued back items.
+                    self.queue.save()
+                self.lastPushWasSuccessful = False
+            else:
+                self.lastPushWasSuccessful = True
+            metrics.MetricCountEvent.log('HttpStatusPush.backlog',
+                    self.queue.nbItems(), absolute=True)
             return self.queueNextServerPush()
+        d = defer.gatherResults(dl)
+        d.addCallback(Done)
+        return d
+
+    def postData(self, data):
+        """POST one encoded chunk to the server.
 
-        # Trigger the HTTP POST request.
+        @returns: Deferred that fails if the server did not accept it"""
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        connection = client.getPage(self.serverUrl,
-                                    method='POST',
-                                    postdata=encoded_packets,
-                                    headers=headers,
-                                    agent='buildbot')
-        connection.addCallbacks(Success, Failure)
-        return connection
+        if self.compress:
+            headers['Content-Encoding'] = 'gzip'
+        if self.agent is None:
+            return client.getPage(self.serverUrl,
+                                  method='POST',
+                                  postdata=data,
+                                  headers=headers,
+                                  agent='buildbot')
+
+        headers['User-Agent'] = 'buildbot'
+        d = self.agent.request('POST', self.serverUrl,
+                Headers(dict([ (k, [v]) for k, v in headers.items() ])),
+                client.FileBodyProducer(StringIO(data)))
+        def gotResponse(response):
+            # The body must be read for the connection to be reused.
+            finished = defer.Deferred()
+            response.deliverBody(DiscardBody(finished))
+            def checkCode(_):
+                if response.code >= 400:
+                    # as getPage reports it
+                    raise error.Error(str(response.code), response.phrase)
+            finished.addCallback(checkCode)
+            return finished
+        d.addCallback(gotResponse)
+        return d
 
 # vim: set ts=4 sts=4 sw=4 et:
@@ -246,9 +246,14 @@ class BuildsResource(HtmlResource):
         except ValueError:
             num = None
         if num is not None:
-            build_status = self.builder_status.getBuild(num)
-            if build_status:
-                return StatusResourceBuild(build_status)
+            # load the build without blocking, and then render it
+            d = self.builder_status.getBuildAsync(num)
+            def make_child(build_status):
+                if build_status:
+                    return StatusResourceBuild(build_status)
+                return HtmlResource.getChild(self, path, req)
+            d.addCallback(make_child)
+            return DeferredResource(d)
 
         return HtmlResource.getChild(self, path, req)
 
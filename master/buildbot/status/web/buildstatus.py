@@ -13,12 +13,14 @@
 #
 # Copyright Buildbot Team Members
 
+from twisted.internet import defer
 from buildbot.status.web.base import HtmlResource, IBox
 
 class BuildStatusStatusResource(HtmlResource):
     def __init__(self, categories=None):
         HtmlResource.__init__(self)
 
+    @defer.deferredGenerator
     def content(self, request, ctx):
         """Display a build in the same format as the waterfall page.
         The HTTP GET parameters are the builder name and the build
@@ -31,19 +33,25 @@ class BuildStatusStatusResource(HtmlResource):
         name = request.args.get("builder", [None])[0]
         number = request.args.get("number", [None])[0]
         if not name or not number:
-            return "builder and number parameter missing"
+            yield "builder and number parameter missing"
+            return
         number = int(number)
 
         # Check if the builder in parameter exists.
         try:
             builder = status.getBuilder(name)
         except:
-            return "unknown builder"
+            yield "unknown builder"
+            return
 
         # Check if the build in parameter exists.
-        build = builder.getBuild(int(number))
+        wfd = defer.waitForDeferred(
+                builder.getBuildAsync(int(number)))
+        yield wfd
+        build = wfd.getResult()
         if not build:
-            return "unknown build %s" % number
+            yield "unknown build %s" % number
+            return
 
         rows = ctx['rows'] = []
 
@@ -63,4 +71,4 @@ class BuildStatusStatusResource(HtmlResource):
         # current one.
         # TODO: Move to template
         data = data.replace('<a ', '<a target="_blank"')
-        return data
+        yield data
@@ -167,7 +167,7 @@ class ConsoleStatusResource(HtmlResource):
         master = request.site.buildbot_service.master
 
         wfd = defer.waitForDeferred(
-                master.db.changes.getRecentChanges(25))
+                master.db.changes.getRecentChanges(25, fresh=False))
         yield wfd
         chdicts = wfd.getResult()
 
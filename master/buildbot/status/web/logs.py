@@ -14,10 +14,13 @@
 # Copyright Buildbot Team Members
 
 
+import re
+import urllib
 from zope.interface import implements
 from twisted.python import components
 from twisted.spread import pb
-from twisted.web import server
+from twisted.internet.interfaces import IPullProducer
+from twisted.web import server, http
 from twisted.web.resource import Resource
 from twisted.web.error import NoResource
 
@@ -47,6 +50,32 @@ class ChunkConsumer:
     def finish(self):
         self.textlog.finished()
 
+class ChunkRangeProducer:
+    """Writes a range of a log, given as a chunk generator, to a
+    L{ChunkConsumer} one chunk at a time, as the request's transport is
+    ready for more data."""
+    implements(IPullProducer)
+
+    def __init__(self, chunks, consumer):
+        self.chunks = chunks
+        self.consumer = consumer
+        consumer.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self.consumer:
+            return
+        try:
+            chunk = self.chunks.next()
+        except StopIteration:
+            consumer, self.consumer = self.consumer, None
+            consumer.unregisterProducer()
+            consumer.finish()
+            return
+        self.consumer.writeChunk(chunk)
+
+    def stopProducing(self):
+        self.consumer = None
+
 
 # /builders/$builder/builds/$buildnum/steps/$stepname/logs/$logname
 class TextLog(Resource):
@@ -56,6 +85,8 @@ class TextLog(Resource):
 
     asText = False
     subscribed = False
+    # logs longer than this are shown a page at a time in HTML
+    pageSize = 256*1024
 
     def __init__(self, original):
         Resource.__init__(self)
@@ -103,6 +134,17 @@ class TextLog(Resource):
         self._setContentType(req)
         self.req = req
 
+        try:
+            span = self._getRange(req)
+        except ValueError, e:
+            self.req = None
+            req.setResponseCode(http.BAD_REQUEST)
+            return str(e)
+        if span is not None:
+            start, end, length = span
+            end = min(end, length)
+            start = min(start, end)
+
         if not self.asText:
             self.template = req.site.buildbot_service.templates.get_template("logs.html")                
             
@@ -110,12 +152,136 @@ class TextLog(Resource):
                     pageTitle = "Log File contents",
                     texturl = req.childLink("text"),
                     path_to_root = path_to_root(req))
+            if span is not None:
+                data += self.template.module.page_links(
+                        **self._getPageLinks(start, end, length))
             data = data.encode('utf-8')                   
             req.write(data)
+        elif span is not None:
+            req.setHeader("content-length", end - start)
 
-        self.original.subscribeConsumer(ChunkConsumer(req, self))
+        consumer = ChunkConsumer(req, self)
+        if span is None:
+            self.original.subscribeConsumer(consumer)
+        else:
+            chunks = self.original.getChunks(self._getChannels(), start=start,
+                                             end=end)
+            ChunkRangeProducer(chunks, consumer)
         return server.NOT_DONE_YET
 
+    def _getChannels(self):
+        # the channels shown; positions in the log are counted in those
+        if self.asText:
+            return [logfile.STDOUT, logfile.STDERR]
+        return [logfile.STDOUT, logfile.STDERR, logfile.HEADER]
+
+    def _getArg(self, req, name):
+        value = req.args.get(name, [None])[0]
+        if value is None or value == '':
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise ValueError("invalid value for %s" % name)
+        return value
+
+    def _getRange(self, req):
+        """Returns the (start, end, length) of the part of the log to send, or
+        None to send all of it and follow the log until it finishes.  Raises
+        ValueError if the request is malformed."""
+        tail = self._getArg(req, 'tail')
+        offset = self._getArg(req, 'offset')
+        size = self._getArg(req, 'length')
+        byteRange = None
+        if self.asText and tail is None and offset is None and size is None:
+            byteRange = self._parseRangeHeader(req.getHeader("range"))
+            if byteRange is None:
+                req.setHeader("accept-ranges", "bytes")
+                return None
+
+        if not hasattr(self.original, 'getLength'):
+            # not a LogFile
+            return None
+        channels = self._getChannels()
+        length = self.original.getLength(channels)
+
+        if tail is not None:
+            lines = self.original.getLineCount(channels)
+            if length and not self._endsWithNewline(channels, length):
+                lines += 1 # the last, unfinished line
+            start = self.original.getLinePosition(lines - tail, channels)
+            end = length
+        elif offset is not None or size is not None:
+            start = offset or 0
+            if size is None:
+                size = self.pageSize
+                if self.asText:
+                    size = length
+            end = start + size
+        elif byteRange is not None:
+            start, end = byteRange
+            if start is None:
+                # last bytes of the log
+                start = max(length - end, 0)
+                end = length
+            elif end is None:
+                end = length
+            if start >= length:
+                req.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+                req.setHeader("content-range", "bytes */%d" % length)
+                return length, length, length
+            req.setResponseCode(http.PARTIAL_CONTENT)
+            req.setHeader("content-range", "bytes %d-%d/%d"
+                    % (start, min(end, length) - 1, length))
+        elif length > self.pageSize:
+            # show the last page of long logs
+            start = length - self.pageSize
+            end = length
+        else:
+            return None
+        return start, end, length
+
+    def _parseRangeHeader(self, header):
+        """Parses a Range header asking for a single range of bytes, returning
+        (start, end), with a None start for a suffix range.  Other requests
+        are answered with the whole log, as allowed by RFC 2616."""
+        if not header:
+            return None
+        mo = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+        if not mo or not (mo.group(1) or mo.group(2)):
+            return None
+        if not mo.group(1):
+            return None, int(mo.group(2))
+        start = int(mo.group(1))
+        if not mo.group(2):
+            return start, None
+        end = int(mo.group(2)) + 1
+        if end <= start:
+            return None
+        return start, end
+
+    def _endsWithNewline(self, channels, length):
+        last = "".join(self.original.getChunks(channels, onlyText=True,
+                                               start=length - 1))
+        return last.endswith("\n")
+
+    def _getPageLinks(self, start, end, length):
+        def link(offset):
+            return "?" + urllib.urlencode(dict(offset=offset,
+                                               length=self.pageSize))
+        links = dict(start=start, end=end, length=length,
+                     first_url=None, prev_url=None, next_url=None,
+                     last_url=None)
+        if start > 0:
+            links['first_url'] = link(0)
+            links['prev_url'] = link(max(start - self.pageSize, 0))
+        if end < length:
+            links['next_url'] = link(end)
+            links['last_url'] = link(max(length - self.pageSize, 0))
+        return links
+
     def _setContentType(self, req):
         if self.asText:
             req.setHeader("content-type", "text/plain; charset=utf-8")
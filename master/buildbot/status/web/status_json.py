@@ -23,6 +23,7 @@ import re
 from twisted.internet import defer
 from twisted.web import html, resource, server
 
+from buildbot.process import metrics
 from buildbot.status.web.base import HtmlResource
 from buildbot.util import json
 
@@ -449,32 +450,88 @@ class AllBuildsJsonResource(JsonResource):
     def getChild(self, path, request):
         # Dynamic childs.
         if isinstance(path, int) or _IS_INT.match(path):
-            build_status = self.builder_status.getBuild(int(path))
-            if build_status:
-                build_status_number = str(build_status.getNumber())
-                # Happens with negative numbers.
-                child = self.children.get(build_status_number)
-                if child:
-                    return child
-                # Create it on-demand.
-                child = BuildJsonResource(self.status, build_status)
-                # Cache it. Never cache negative numbers.
-                # TODO(maruel): Cleanup the cache once it's too heavy!
-                self.putChild(build_status_number, child)
-                return child
+            # The build is loaded when the child is rendered.
+            return LazyBuildJsonResource(self.status, self, int(path))
         return JsonResource.getChild(self, path, request)
 
+    def getBuildChild(self, build_status):
+        """Return the BuildJsonResource for a loaded build."""
+        build_status_number = str(build_status.getNumber())
+        # Happens with negative numbers.
+        child = self.children.get(build_status_number)
+        if child:
+            return child
+        # Create it on-demand.
+        child = BuildJsonResource(self.status, build_status)
+        # Cache it. Never cache negative numbers.
+        # TODO(maruel): Cleanup the cache once it's too heavy!
+        self.putChild(build_status_number, child)
+        return child
+
+    @defer.deferredGenerator
     def asDict(self, request):
         results = {}
         # If max > buildCacheSize, it'll trash the cache...
         max = int(RequestArg(request, 'max',
                              self.builder_status.buildCacheSize))
-        for i in range(0, max):
-            child = self.getChildWithDefault(-i, request)
-            if not isinstance(child, BuildJsonResource):
+        wfd = defer.waitForDeferred(
+                defer.gatherResults([ self.builder_status.getBuildAsync(-i)
+                                      for i in range(0, max) ]))
+        yield wfd
+        for build_status in wfd.getResult():
+            if not build_status:
                 continue
-            results[child.build_status.getNumber()] = child.asDict(request)
-        return results
+            child = self.getBuildChild(build_status)
+            results[build_status.getNumber()] = child.asDict(request)
+        yield results
+
+
+class LazyBuildJsonResource(JsonResource):
+    """Stands in for a build which may not be loaded yet.  When rendered, the
+    build is loaded without blocking the reactor; children of the build are
+    looked up synchronously."""
+
+    def __init__(self, status, builds, number):
+        JsonResource.__init__(self, status)
+        self.builds = builds
+        self.number = number
+
+    def _getBuildChild(self):
+        d = self.builds.builder_status.getBuildAsync(self.number)
+        def make_child(build_status):
+            if build_status:
+                return self.builds.getBuildChild(build_status)
+            return None
+        d.addCallback(make_child)
+        return d
+
+    def getChildWithDefault(self, path, request):
+        if path == "" and len(request.postpath) == 0:
+            return self
+        build_status = self.builds.builder_status.getBuild(self.number)
+        if not build_status:
+            return resource.NoResource("No such build")
+        child = self.builds.getBuildChild(build_status)
+        return child.getChildWithDefault(path, request)
+
+    def render(self, request):
+        d = self._getBuildChild()
+        def render_child(child):
+            if child is None:
+                child = resource.NoResource("No such build")
+            request.render(child)
+        d.addCallback(render_child)
+        d.addErrback(request.processingFailed)
+        return server.NOT_DONE_YET
+
+    def asDict(self, request):
+        d = self._getBuildChild()
+        def child_dict(child):
+            if child is None:
+                return { 'error' : 'Not available' }
+            return child.asDict(request)
+        d.addCallback(child_dict)
+        return d
 
 
 class BuildsJsonResource(AllBuildsJsonResource):
@@ -649,12 +706,12 @@ class SlaveJsonResource(JsonResource):
             builds = []
             builder_status = self.status.getBuilder(builderName)
             for i in range(1, builder_status.buildCacheSize - 1):
-                build_status = builder_status.getBuild(-i)
-                if not build_status or not build_status.isFinished():
+                summary = builder_status.getBuildSummary(-i)
+                if not summary:
                     # If not finished, it will appear in runningBuilds.
                     break
-                if build_status.getSlavename() == self.name:
-                    builds.append(build_status.getNumber())
+                if summary['slavename'] == self.name:
+                    builds.append(summary['number'])
             results['builders'][builderName] = builds
         return results
 
@@ -690,11 +747,30 @@ class SourceStampJsonResource(JsonResource):
     def asDict(self, request):
         return self.source_stamp.asDict()
 
+class MetricsQueriesJsonResource(JsonResource):
+    help = """Database query statistics, by the method making the query: count,
+total/p50/p95/max time, and rows returned.
+"""
+    title = "Database Queries"
+
+    def asDict(self, request):
+        metrics_observer = self.status.getMetrics()
+        if metrics_observer:
+            handler = metrics_observer.getHandler(metrics.MetricQueryEvent)
+            if handler:
+                return handler.asDict()['queries']
+        # Metrics are disabled
+        return None
+
 class MetricsJsonResource(JsonResource):
     help = """Master metrics.
 """
     title = "Metrics"
 
+    def __init__(self, status):
+        JsonResource.__init__(self, status)
+        self.putChild('queries', MetricsQueriesJsonResource(status))
+
     def asDict(self, request):
         metrics = self.status.getMetrics()
         if metrics:
@@ -397,7 +397,7 @@ class WaterfallStatusResource(HtmlResource):
         results = {}
 
         # recent changes
-        changes_d = master.db.changes.getRecentChanges(40)
+        changes_d = master.db.changes.getRecentChanges(40, fresh=False)
         def to_changes(chdicts):
             return defer.gatherResults([
                 changes.Change.fromChdict(master, chdict)
@@ -517,9 +517,9 @@ class WarningCountingShellCommand(ShellCommand):
         # warnings regular expressions. If did, bump the warnings count and
         # add the line to the collection of lines with warnings
         warnings = []
-        # TODO: use log.readlines(), except we need to decide about stdout vs
-        # stderr
-        for line in log.getText().split("\n"):
+        for line in log.readlines(channels=[STDOUT, STDERR]):
+            if line.endswith("\n"):
+                line = line[:-1]
             if directoryEnterRe:
                 match = directoryEnterRe.search(line)
                 if match:
@@ -618,7 +618,7 @@ class PerlModuleTest(Test):
         # Get stdio, stripping pesky newlines etc.
         lines = map(
             lambda line : line.replace('\r\n','').replace('\r','').replace('\n',''),
-            self.getLog('stdio').readlines()
+            list(self.getLog('stdio').readlines())
             )
 
         total = 0
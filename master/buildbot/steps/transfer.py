@@ -14,22 +14,56 @@
 # Copyright Buildbot Team Members
 
 
-import os.path, tarfile, tempfile
+import os.path, tarfile, tempfile, threading
 try:
     from cStringIO import StringIO
     assert StringIO
 except ImportError:
     from StringIO import StringIO
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.spread import pb
-from twisted.python import log
+from twisted.python import log, failure
 from buildbot.process.buildstep import RemoteCommand, BuildStep
 from buildbot.process.buildstep import SUCCESS, FAILURE, SKIPPED
 from buildbot.interfaces import BuildSlaveTooOldError
+from buildbot import util
 from buildbot.util import json
 
 
-class _FileWriter(pb.Referenceable):
+class _TransferMeter:
+    """
+    Mixin for the helpers below, which measures how much data they have
+    transferred, and how fast.
+    """
+
+    nbytes = 0
+    firstBlock = None
+    lastBlock = None
+
+    def countBlock(self, length):
+        now = util.now()
+        if self.firstBlock is None:
+            self.firstBlock = now
+        self.lastBlock = now
+        self.nbytes += length
+
+    def setStatistics(self, step_status):
+        """
+        Record the number of bytes transferred, the time between the first
+        and the last block, and the resulting rate in bytes per second, as
+        the 'transfer-bytes', 'transfer-time' and 'transfer-rate' statistics
+        of the step.
+        """
+        step_status.setStatistic('transfer-bytes', self.nbytes)
+        if self.firstBlock is None:
+            return
+        elapsed = self.lastBlock - self.firstBlock
+        step_status.setStatistic('transfer-time', elapsed)
+        if elapsed > 0:
+            step_status.setStatistic('transfer-rate', self.nbytes / elapsed)
+
+
+class _FileWriter(pb.Referenceable, _TransferMeter):
     """
     Helper class that acts as a file-object with write access
     """
@@ -55,6 +89,7 @@ class _FileWriter(pb.Referenceable):
         @type  data: C{string}
         @param data: String of data to write
         """
+        self.countBlock(len(data))
         if self.remaining is not None:
             if len(data) > self.remaining:
                 data = data[:self.remaining]
@@ -126,45 +161,179 @@ def _extractall(self, path=".", members=None):
             else:
                 self._dbg(1, "tarfile: %s" % e)
 
-class _DirectoryWriter(_FileWriter):
+class _TarPipe:
+    """
+    A bounded buffer carrying a tar stream from the reactor thread, which
+    writes the blocks received from the slave into it, to the thread that
+    extracts the stream, which reads them back.  Writes return a Deferred
+    when the buffer is full, which fires once the reader has drained it.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+        self.finished = False
+        self.waiting = []
+
+    def write(self, data):
+        self.cond.acquire()
+        try:
+            if self.finished:
+                # nobody will read this any more
+                return None
+            self.chunks.append(data)
+            self.size += len(data)
+            self.cond.notify()
+            if self.size < self.limit:
+                return None
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+        finally:
+            self.cond.release()
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notify()
+        self.cond.release()
+
+    def read(self, size):
+        # called in the extraction thread
+        self.cond.acquire()
+        try:
+            while not self.chunks and not self.closed:
+                self.cond.wait()
+            pieces = []
+            length = 0
+            while self.chunks and length < size:
+                chunk = self.chunks.pop(0)
+                if length + len(chunk) > size:
+                    self.chunks.insert(0, chunk[size - length:])
+                    chunk = chunk[:size - length]
+                pieces.append(chunk)
+                length += len(chunk)
+            self.size -= length
+            if self.size < self.limit:
+                self._wakeWriters()
+            return ''.join(pieces)
+        finally:
+            self.cond.release()
+
+    def finish(self):
+        # called in the extraction thread once it stops reading, whether it
+        # reached the end of the archive or failed
+        self.cond.acquire()
+        self.finished = True
+        self.chunks = []
+        self.size = 0
+        self._wakeWriters()
+        self.cond.release()
+
+    def _wakeWriters(self):
+        if self.waiting:
+            waiting, self.waiting = self.waiting, []
+            reactor.callFromThread(self._fire, waiting)
+
+    def _fire(self, waiting):
+        for d in waiting:
+            d.callback(None)
+
+class _DirectoryWriter(pb.Referenceable, _TransferMeter):
     """
-    A DirectoryWriter is implemented as a FileWriter, with an added post-processing
-    step to unpack the archive, once the transfer has completed.
+    Helper class that unpacks the tar stream sent by the slave into a
+    directory as it arrives, without storing the archive first.  The stream
+    is extracted in a dedicated thread, through a bounded L{_TarPipe}:
+    remote_write does not return while the pipe is full, which holds back
+    the slave.
     """
 
+    bufferSize = 1024*1024
+
     def __init__(self, destroot, maxsize, compress, mode):
         self.destroot = destroot
+        self.remaining = maxsize
         self.compress = compress
+        self.mode = mode
+        self.pipe = _TarPipe(self.bufferSize)
+        self.extracted = None
+        self.unpacking = False
 
-        self.fd, self.tarname = tempfile.mkstemp()
-        os.close(self.fd)
-
-        _FileWriter.__init__(self, self.tarname, maxsize, mode)
-
-    def remote_unpack(self):
-        """
-        Called by remote slave to state that no more data will be transfered
-        """
-        # Make sure remote_close is called, otherwise atomic rename wont happen
-        self.remote_close()
-
-        # Map configured compression to a TarFile setting
-        if self.compress == 'bz2':
-            mode='r|bz2'
-        elif self.compress == 'gz':
-            mode='r|gz'
+    def _startExtracting(self):
+        if self.extracted is not None:
+            return
+        # the extraction blocks in _TarPipe.read for as long as the upload
+        # lasts, so it runs in a thread of its own rather than tying up one
+        # of the reactor's few pool threads, which others need
+        d = self.extracted = defer.Deferred()
+        def run():
+            try:
+                self._extract()
+            except:
+                reactor.callFromThread(d.errback, failure.Failure())
+            else:
+                reactor.callFromThread(d.callback, None)
+        thread = threading.Thread(target=run,
+                name="DirectoryUpload to %s" % (self.destroot,))
+        # don't hold up shutdown for an upload that never finished
+        thread.setDaemon(True)
+        thread.start()
+
+    def _extract(self):
+        # runs in a thread
+        if self.compress in ('bz2', 'gz'):
+            mode = 'r|' + self.compress
         else:
-            mode = 'r'
+            mode = 'r|'
 
         # Support old python
         if not hasattr(tarfile.TarFile, 'extractall'):
             tarfile.TarFile.extractall = _extractall
 
-        # Unpack archive and clean up after self
-        archive = tarfile.open(name=self.tarname, mode=mode)
-        archive.extractall(path=self.destroot)
-        archive.close()
-        os.remove(self.tarname)
+        try:
+            archive = tarfile.open(mode=mode, fileobj=self.pipe)
+            archive.extractall(path=self.destroot)
+            archive.close()
+        finally:
+            self.pipe.finish()
+
+    def remote_write(self, data):
+        """
+        Called from remote slave to write L{data} to the archive being
+        extracted; the result fires when there is room for more data
+        """
+        self.countBlock(len(data))
+        if self.remaining is not None:
+            if len(data) > self.remaining:
+                data = data[:self.remaining]
+            self.remaining = self.remaining - len(data)
+        self._startExtracting()
+        return self.pipe.write(data)
+
+    def remote_unpack(self):
+        """
+        Called by remote slave to state that no more data will be transfered;
+        the result fires once the whole archive has been extracted
+        """
+        self.unpacking = True
+        self._startExtracting()
+        self.pipe.close()
+        return self.extracted
+
+    def cancel(self):
+        # the upload stopped before the slave called remote_unpack, so stop
+        # the extraction thread, which will fail on the truncated archive
+        if self.unpacking:
+            return
+        self.pipe.close()
+        if self.extracted is not None:
+            def abandoned(f):
+                log.msg("upload of %s abandoned: %s"
+                        % (self.destroot, f.getErrorMessage()))
+            self.extracted.addErrback(abandoned)
 
 
 class StatusRemoteCommand(RemoteCommand):
@@ -193,6 +362,9 @@ class _TransferBuildStep(BuildStep):
     haltOnFailure = True
     flunkOnFailure = True
 
+    # the _FileWriter or _FileReader doing the transfer
+    transfer = None
+
     def setDefaultWorkdir(self, workdir):
         if self.workdir is None:
             self.workdir = workdir
@@ -218,6 +390,8 @@ class _TransferBuildStep(BuildStep):
             return BuildStep.finished(self, SKIPPED)
         if self.cmd.stderr != '':
             self.addCompleteLog('stderr', self.cmd.stderr)
+        if self.transfer:
+            self.transfer.setStatistics(self.step_status)
 
         if self.cmd.rc is None or self.cmd.rc == 0:
             return BuildStep.finished(self, SUCCESS)
@@ -240,6 +414,8 @@ class FileUpload(_TransferBuildStep):
                      The default (=None) is to leave it up to the umask of
                      the buildmaster process.
     - ['keepstamp']  whether to preserve file modified and accessed times
+    - ['pipeline']   number of blocks that may be in flight at once
+    - ['maxblocksize'] maximum size the blocks may grow to on a fast link
 
     """
 
@@ -249,6 +425,7 @@ class FileUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None, keepstamp=False,
+                 pipeline=4, maxblocksize=256*1024,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
@@ -258,6 +435,8 @@ class FileUpload(_TransferBuildStep):
                                  blocksize=blocksize,
                                  mode=mode,
                                  keepstamp=keepstamp,
+                                 pipeline=pipeline,
+                                 maxblocksize=maxblocksize,
                                  )
 
         self.slavesrc = slavesrc
@@ -268,6 +447,8 @@ class FileUpload(_TransferBuildStep):
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
         self.keepstamp = keepstamp
+        self.pipeline = pipeline
+        self.maxblocksize = maxblocksize
 
     def start(self):
         version = self.slaveVersion("uploadFile")
@@ -289,7 +470,8 @@ class FileUpload(_TransferBuildStep):
         self.step_status.setText(['uploading', os.path.basename(source)])
 
         # we use maxsize to limit the amount of data on both sides
-        fileWriter = _FileWriter(masterdest, self.maxsize, self.mode)
+        fileWriter = self.transfer = _FileWriter(masterdest, self.maxsize,
+                                                 self.mode)
 
         if self.keepstamp and self.slaveVersionIsOlderThan("uploadFile","2.13"):
             m = ("This buildslave (%s) does not support preserving timestamps. "
@@ -304,6 +486,8 @@ class FileUpload(_TransferBuildStep):
             'maxsize': self.maxsize,
             'blocksize': self.blocksize,
             'keepstamp': self.keepstamp,
+            'pipeline': self.pipeline,
+            'maxblocksize': self.maxblocksize,
             }
 
         self.cmd = StatusRemoteCommand('uploadFile', args)
@@ -325,6 +509,8 @@ class DirectoryUpload(BuildStep):
                      whole directory
     - ['blocksize']  maximum size of each block being transfered
     - ['compress']   compression type to use: one of [None, 'gz', 'bz2']
+    - ['pipeline']   number of blocks that may be in flight at once
+    - ['maxblocksize'] maximum size the blocks may grow to on a fast link
 
     """
 
@@ -334,7 +520,8 @@ class DirectoryUpload(BuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir="build", maxsize=None, blocksize=16*1024,
-                 compress=None, **buildstep_kwargs):
+                 compress=None, pipeline=4, maxblocksize=256*1024,
+                 **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
                                  masterdest=masterdest,
@@ -342,6 +529,8 @@ class DirectoryUpload(BuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  compress=compress,
+                                 pipeline=pipeline,
+                                 maxblocksize=maxblocksize,
                                  )
 
         self.slavesrc = slavesrc
@@ -351,6 +540,8 @@ class DirectoryUpload(BuildStep):
         self.blocksize = blocksize
         assert compress in (None, 'gz', 'bz2')
         self.compress = compress
+        self.pipeline = pipeline
+        self.maxblocksize = maxblocksize
 
     def start(self):
         version = self.slaveVersion("uploadDirectory")
@@ -372,7 +563,8 @@ class DirectoryUpload(BuildStep):
         self.step_status.setText(['uploading', os.path.basename(source)])
         
         # we use maxsize to limit the amount of data on both sides
-        dirWriter = _DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
+        dirWriter = self.transfer = _DirectoryWriter(masterdest, self.maxsize,
+                                                     self.compress, 0600)
 
         # default arguments
         args = {
@@ -381,11 +573,17 @@ class DirectoryUpload(BuildStep):
             'writer': dirWriter,
             'maxsize': self.maxsize,
             'blocksize': self.blocksize,
-            'compress': self.compress
+            'compress': self.compress,
+            'pipeline': self.pipeline,
+            'maxblocksize': self.maxblocksize,
             }
 
         self.cmd = StatusRemoteCommand('uploadDirectory', args)
         d = self.runCommand(self.cmd)
+        def cancel(res):
+            dirWriter.cancel()
+            return res
+        d.addBoth(cancel)
         d.addCallback(self.finished).addErrback(self.failed)
 
     def finished(self, result):
@@ -396,6 +594,7 @@ class DirectoryUpload(BuildStep):
             return BuildStep.finished(self, SKIPPED)
         if self.cmd.stderr != '':
             self.addCompleteLog('stderr', self.cmd.stderr)
+        self.transfer.setStatistics(self.step_status)
 
         if self.cmd.rc is None or self.cmd.rc == 0:
             return BuildStep.finished(self, SUCCESS)
@@ -404,7 +603,7 @@ class DirectoryUpload(BuildStep):
 
 
 
-class _FileReader(pb.Referenceable):
+class _FileReader(pb.Referenceable, _TransferMeter):
     """
     Helper class that acts as a file-object with read access
     """
@@ -426,6 +625,7 @@ class _FileReader(pb.Referenceable):
             return ''
 
         data = self.fp.read(maxlength)
+        self.countBlock(len(data))
         return data
 
     def remote_close(self):
@@ -457,6 +657,8 @@ class FileDownload(_TransferBuildStep):
                    the buildslave account, or 0755 to be world-executable.
                    The default (=None) is to leave it up to the umask of
                    the buildslave process.
+     ['pipeline']  number of blocks that may be in flight at once
+     ['maxblocksize'] maximum size the blocks may grow to on a fast link
 
     """
     name = 'download'
@@ -465,6 +667,7 @@ class FileDownload(_TransferBuildStep):
 
     def __init__(self, mastersrc, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 pipeline=4, maxblocksize=256*1024,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(mastersrc=mastersrc,
@@ -473,6 +676,8 @@ class FileDownload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 pipeline=pipeline,
+                                 maxblocksize=maxblocksize,
                                  )
 
         self.mastersrc = mastersrc
@@ -482,6 +687,8 @@ class FileDownload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.pipeline = pipeline
+        self.maxblocksize = maxblocksize
 
     def start(self):
         version = self.slaveVersion("downloadFile")
@@ -510,7 +717,7 @@ class FileDownload(_TransferBuildStep):
             # maybeDeferred, just re-raise the exception here.
             reactor.callLater(0, BuildStep.finished, self, FAILURE)
             return
-        fileReader = _FileReader(fp)
+        fileReader = self.transfer = _FileReader(fp)
 
         # default arguments
         args = {
@@ -520,6 +727,8 @@ class FileDownload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'workdir': self._getWorkdir(),
             'mode': self.mode,
+            'pipeline': self.pipeline,
+            'maxblocksize': self.maxblocksize,
             }
 
         self.cmd = StatusRemoteCommand('downloadFile', args)
@@ -546,6 +755,8 @@ class StringDownload(_TransferBuildStep):
                    the buildslave account, or 0755 to be world-executable.
                    The default (=None) is to leave it up to the umask of
                    the buildslave process.
+     ['pipeline']  number of blocks that may be in flight at once
+     ['maxblocksize'] maximum size the blocks may grow to on a fast link
     """
     name = 'string_download'
 
@@ -553,6 +764,7 @@ class StringDownload(_TransferBuildStep):
 
     def __init__(self, s, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
+                 pipeline=4, maxblocksize=256*1024,
                  **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(s=s,
@@ -561,6 +773,8 @@ class StringDownload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 pipeline=pipeline,
+                                 maxblocksize=maxblocksize,
                                  )
 
         self.s = s
@@ -570,6 +784,8 @@ class StringDownload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.pipeline = pipeline
+        self.maxblocksize = maxblocksize
 
     def start(self):
         version = self.slaveVersion("downloadFile")
@@ -587,7 +803,7 @@ class StringDownload(_TransferBuildStep):
 
         # setup structures for reading the file
         fp = StringIO(self.s)
-        fileReader = _FileReader(fp)
+        fileReader = self.transfer = _FileReader(fp)
 
         # default arguments
         args = {
@@ -597,6 +813,8 @@ class StringDownload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'workdir': self._getWorkdir(),
             'mode': self.mode,
+            'pipeline': self.pipeline,
+            'maxblocksize': self.maxblocksize,
             }
 
         self.cmd = StatusRemoteCommand('downloadFile', args)
@@ -360,6 +360,16 @@ class FakeChangesComponent(FakeDBComponent):
             ch = None
         return defer.succeed(self._ch2chdict(ch))
 
+    def getChangeidsAfter(self, changeid, count=None):
+        changeids = sorted([ id for id in self.changes if id > changeid ])
+        if count is not None:
+            changeids = changeids[:count]
+        return defer.succeed(changeids)
+
+    def getChanges(self, changeids):
+        return defer.gatherResults([ self.getChange(changeid)
+                                     for changeid in changeids ])
+
     # TODO: addChange
     # TODO: getRecentChanges
 
@@ -618,7 +628,7 @@ class FakeBuildsetsComponent(FakeDBComponent):
         row = self.buildsets[bsid]
         return defer.succeed(self._row2dict(row))
 
-    def getBuildsets(self, complete=None):
+    def getBuildsets(self, complete=None, fresh=True):
         rv = []
         for bs in self.buildsets.itervalues():
             if complete is not None:
@@ -824,10 +834,14 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             return defer.succeed(None)
 
     def getBuildRequests(self, buildername=None, complete=None, claimed=None,
-                         bsid=None):
+                         bsid=None, after_brid=None, fresh=True):
         rv = []
+        if isinstance(buildername, basestring):
+            buildername = [ buildername ]
         for br in self.reqs.itervalues():
-            if buildername and br.buildername != buildername:
+            if buildername is not None and br.buildername not in buildername:
+                continue
+            if after_brid is not None and br.id <= after_brid:
                 continue
             if complete is not None:
                 if complete and not br.complete:
@@ -851,6 +865,24 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             rv.append(self._brdictFromRow(br))
         return defer.succeed(rv)
 
+    def getLatestBuildRequestId(self):
+        if self.reqs:
+            return defer.succeed(max(self.reqs.iterkeys()))
+        return defer.succeed(None)
+
+    def unclaimExpiredRequests(self, old):
+        return defer.succeed(0)
+
+    def getMergeKeys(self, brids):
+        rv = {}
+        for brid in brids:
+            if brid not in self.reqs:
+                continue
+            bs = self.db.buildsets.buildsets[self.reqs[brid].buildsetid]
+            ss = self.db.sourcestamps.sourcestamps[bs['sourcestampid']]
+            rv[brid] = (ss['repository'], ss['branch'], ss['project'])
+        return defer.succeed(rv)
+
     def claimBuildRequests(self, brids):
         for brid in brids:
             if brid not in self.reqs or brid in self.claims:
@@ -862,6 +894,16 @@ class FakeBuildRequestsComponent(FakeDBComponent):
                 objectid=self.MASTER_ID, claimed_at=self._reactor.seconds())
         return defer.succeed(None)
 
+    def claimAnyBuildRequests(self, brids):
+        claimed = []
+        for brid in brids:
+            if brid not in self.reqs or brid in self.claims:
+                continue
+            self.claims[brid] = BuildRequestClaim(brid=brid,
+                objectid=self.MASTER_ID, claimed_at=self._reactor.seconds())
+            claimed.append(brid)
+        return defer.succeed(claimed)
+
     def reclaimBuildRequests(self, brids):
         for brid in brids:
             if brid not in self.claims:
@@ -874,6 +916,14 @@ class FakeBuildRequestsComponent(FakeDBComponent):
                 objectid=self.MASTER_ID, claimed_at=self._reactor.seconds())
         return defer.succeed(None)
 
+    def unclaimBuildRequests(self, brids):
+        # only this master's claims are released
+        for brid in brids:
+            if brid in self.claims and \
+                    self.claims[brid].objectid == self.MASTER_ID:
+                del self.claims[brid]
+        return defer.succeed(None)
+
     # Code copied from buildrequests.BuildRequestConnectorComponent
     def _brdictFromRow(self, row):
         claimed = mine = False
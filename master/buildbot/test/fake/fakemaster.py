@@ -34,6 +34,12 @@ class FakeCache(object):
         d.addCallback(mkref)
         return d
 
+    def contains(self, key):
+        return False
+
+    def add(self, key, value):
+        pass
+
 
 def make_master(master_id=fakedb.FakeBuildRequestsComponent.MASTER_ID):
     """
@@ -84,8 +84,11 @@ class FakeLogFile(object):
         self.stderr += data
         self.chunks.append((STDERR, data))
 
-    def readlines(self): # TODO: remove channel arg from logfile.py
-        return self.stdout.split('\n')
+    def readlines(self, channel=STDOUT, channels=None):
+        if channels is None:
+            channels = [channel]
+        text = ''.join(self.getChunks(channels, onlyText=True))
+        return iter(text.splitlines(True))
 
     def getText(self):
         return self.stdout
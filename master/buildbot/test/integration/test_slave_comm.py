@@ -23,7 +23,7 @@ import buildbot
 from buildbot.test.util import compat
 from buildbot.process import botmaster
 from buildbot import pbmanager, buildslave
-from buildbot.test.fake import fakemaster
+from buildbot.test.fake import fakemaster, fakedb
 
 class FakeSlaveBuilder(pb.Referenceable):
     """
@@ -88,10 +88,10 @@ class FakeBuilder(object):
     def setServiceParent(self, botmaster):
         pass
 
-    def getOldestRequestTime(self):
+    def getOldestRequestTime(self, unclaimed_requests=None):
         return 0
 
-    def maybeStartBuild(self):
+    def maybeStartBuild(self, unclaimed_requests=None):
         return defer.succeed(None)
 
 
@@ -115,6 +115,7 @@ class TestSlaveComm(unittest.TestCase):
 
     def setUp(self):
         self.master = fakemaster.make_master()
+        self.master.db = fakedb.FakeDBConnector(self)
         # set the slave port to a loopback address with unspecified
         # port
         self.master.slavePortnum = "tcp:0:interface=127.0.0.1"
@@ -184,6 +184,11 @@ class TestBuildsetsConnectorComponent(
                 buildername='dd',
                 expected=[])
 
+    def test_getBuildRequests_buildername_list(self):
+        return self.do_test_getBuildRequests_buildername_arg(
+                buildername=['bb', 'cc', 'dd'],
+                expected=[8, 9, 10])
+
     def do_test_getBuildRequests_complete_arg(self, **kwargs):
         expected = kwargs.pop('expected')
         d = self.insertTestData([
@@ -244,6 +249,89 @@ class TestBuildsetsConnectorComponent(
         d.addCallback(check)
         return d
 
+    def test_getBuildRequests_after_brid_arg(self):
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=70, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=71, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=72, buildsetid=self.BSID),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequests(after_brid=70))
+        def check(brlist):
+            self.assertEqual(sorted([ br['brid'] for br in brlist ]),
+                             sorted([71, 72]))
+        d.addCallback(check)
+        return d
+
+    def test_getLatestBuildRequestId(self):
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=70, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=72, buildsetid=self.BSID),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getLatestBuildRequestId())
+        def check(brid):
+            self.assertEqual(brid, 72)
+        d.addCallback(check)
+        return d
+
+    def test_getLatestBuildRequestId_empty(self):
+        d = self.db.buildrequests.getLatestBuildRequestId()
+        def check(brid):
+            self.assertEqual(brid, None)
+        d.addCallback(check)
+        return d
+
+    def test_getBuildRequests_read_pool(self):
+        # read_pool is the same as pool in tests, so substitute one that
+        # records its use
+        read_pool_calls = []
+        class ReadPool(object):
+            def do(pool, thd):
+                read_pool_calls.append(thd)
+                return self.db.pool.do(thd)
+        self.db.read_pool = ReadPool()
+
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=70, buildsetid=self.BSID),
+        ])
+        # the primary is used by default..
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequests())
+        def check_fresh(brlist):
+            self.assertEqual([ br['brid'] for br in brlist ], [ 70 ])
+            self.assertEqual(len(read_pool_calls), 0)
+        d.addCallback(check_fresh)
+        # ..and the read pool only on request
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequests(fresh=False))
+        def check_read(brlist):
+            self.assertEqual([ br['brid'] for br in brlist ], [ 70 ])
+            self.assertEqual(len(read_pool_calls), 1)
+        d.addCallback(check_read)
+        return d
+
+    def test_getMergeKeys(self):
+        d = self.insertTestData([
+            fakedb.Patch(id=99, patch_base64='aGVsbG8sIHdvcmxk',
+                patch_author='bar', patch_comment='foo', subdir='/foo',
+                patchlevel=3),
+            fakedb.SourceStamp(id=235, branch='br', repository='rep',
+                project='prj', patchid=99),
+            fakedb.Buildset(id=self.BSID2, sourcestampid=235),
+            fakedb.BuildRequest(id=70, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=71, buildsetid=self.BSID2),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getMergeKeys([70, 71, 72]))
+        def check(mergekeys):
+            self.assertEqual(mergekeys, {
+                70 : ('repo', 'master', 'proj'),
+                71 : ('rep', 'br', 'prj'),
+            })
+        d.addCallback(check)
+        return d
+
     def test_getBuildRequests_combo(self):
         d = self.insertTestData([
             # 44: everything we want
@@ -416,6 +504,79 @@ class TestBuildsetsConnectorComponent(
         d.addCallback(check)
         return d
 
+    def do_test_claimAnyBuildRequests(self, rows, now, brids, exp_claimed,
+                                      expected):
+        clock = task.Clock()
+        clock.advance(now)
+
+        d = self.insertTestData(rows)
+        d.addCallback(lambda _ :
+            self.db.buildrequests.claimAnyBuildRequests(brids=brids,
+                        _reactor=clock))
+        def check(claimed):
+            self.assertEqual(sorted(claimed), sorted(exp_claimed))
+            def thd(conn):
+                reqs_tbl = self.db.model.buildrequests
+                claims_tbl = self.db.model.buildrequest_claims
+                q = sa.select([ reqs_tbl.outerjoin(claims_tbl,
+                                        reqs_tbl.c.id == claims_tbl.c.brid) ])
+                results = conn.execute(q).fetchall()
+                self.assertEqual(
+                    sorted([ (r.id, r.claimed_at, r.objectid)
+                             for r in results ]),
+                    sorted(expected))
+            return self.db.pool.do(thd)
+        d.addCallback(check)
+        return d
+
+    def test_claimAnyBuildRequests_all(self):
+        return self.do_test_claimAnyBuildRequests([
+                fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+                fakedb.BuildRequest(id=45, buildsetid=self.BSID),
+                fakedb.BuildRequest(id=46, buildsetid=self.BSID),
+            ], 1300305712, [ 44, 46 ], [ 44, 46 ],
+            [
+                (44, 1300305712, self.MASTER_ID),
+                (45, None, None),
+                (46, 1300305712, self.MASTER_ID),
+            ])
+
+    def test_claimAnyBuildRequests_other_master_claim(self):
+        return self.do_test_claimAnyBuildRequests([
+                fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+                fakedb.BuildRequest(id=45, buildsetid=self.BSID),
+                fakedb.BuildRequestClaim(brid=44,
+                    objectid=self.OTHER_MASTER_ID,
+                    claimed_at=1300103810),
+            ], 1300305712, [ 44, 45 ], [ 45 ],
+            [
+                (44, 1300103810, self.OTHER_MASTER_ID),
+                (45, 1300305712, self.MASTER_ID),
+            ])
+
+    def test_claimAnyBuildRequests_none(self):
+        return self.do_test_claimAnyBuildRequests([
+                fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+                fakedb.BuildRequestClaim(brid=44,
+                    objectid=self.OTHER_MASTER_ID,
+                    claimed_at=1300103810),
+            ], 1300305712, [ 44 ], [],
+            [ (44, 1300103810, self.OTHER_MASTER_ID) ])
+
+    def test_claimAnyBuildRequests_stress(self):
+        return self.do_test_claimAnyBuildRequests(
+            [ fakedb.BuildRequest(id=id, buildsetid=self.BSID)
+              for id in range(1, 1001) ] +
+            [ fakedb.BuildRequestClaim(brid=id,
+                    objectid=self.OTHER_MASTER_ID, claimed_at=1300103810)
+              for id in range(1, 1001, 10) ],
+            1300305712, range(1, 1001),
+            [ id for id in range(1, 1001) if id % 10 != 1 ],
+            [ (id, 1300103810, self.OTHER_MASTER_ID)
+              for id in range(1, 1001, 10) ] +
+            [ (id, 1300305712, self.MASTER_ID)
+              for id in range(1, 1001) if id % 10 != 1 ])
+
     def do_test_reclaimBuildRequests(self, rows, now, brids, expected=None,
                                   expfailure=None):
         clock = task.Clock()
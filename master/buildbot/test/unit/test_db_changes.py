@@ -20,6 +20,7 @@ from twisted.trial import unittest
 from twisted.internet import defer, task
 from buildbot.changes.changes import Change
 from buildbot.db import changes
+from buildbot.process import cache
 from buildbot.test.util import connector_component
 from buildbot.test.fake import fakedb
 from buildbot.util import epoch2datetime
@@ -159,6 +160,82 @@ class TestChangesConnectorComponent(
         d.addCallback(check14)
         return d
 
+    def test_getChanges(self):
+        d = self.insertTestData(self.change13_rows + self.change14_rows)
+        def get(_):
+            return self.db.changes.getChanges([14, 99, 13])
+        d.addCallback(get)
+        def check(chdicts):
+            self.assertEqual([ c and c['changeid'] for c in chdicts ],
+                             [14, None, 13])
+            self.assertEqual(chdicts[0], self.change14_dict)
+            self.assertEqual(sorted(chdicts[2]['files']),
+                        sorted(['master/README.txt', 'slave/README.txt']))
+            self.assertEqual(sorted(chdicts[2]['links']),
+                        sorted(['http://buildbot.net',
+                                'http://sf.net/projects/buildbot']))
+            self.assertEqual(chdicts[2]['properties'],
+                        { 'notest' : ('no', 'Change') })
+        d.addCallback(check)
+        return d
+
+    def test_getChanges_fills_cache(self):
+        # use a real cache for this test
+        self.db.master.caches = cache.CacheManager()
+        self.db.changes = changes.ChangesConnectorComponent(self.db)
+        chcache = self.db.changes.getChange.cache
+
+        d = self.insertTestData(self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ : self.db.changes.getChange(13))
+        def get(_):
+            # with 13 already cached, only 14 should be fetched
+            self.db.changes._chdicts_from_change_rows_thd = mock.Mock(
+                wraps=self.db.changes._chdicts_from_change_rows_thd)
+            return self.db.changes.getChanges([13, 14])
+        d.addCallback(get)
+        def check(chdicts):
+            self.assertEqual([ c['changeid'] for c in chdicts ], [13, 14])
+            rows = self.db.changes._chdicts_from_change_rows_thd.call_args[0][1]
+            self.assertEqual([ r.changeid for r in rows ], [14])
+            self.assertTrue(chcache.contains(14))
+            self.assertEqual((chcache.hits, chcache.misses), (1, 2))
+            return self.db.changes.getChange(14)
+        d.addCallback(check)
+        def check_hit(chdict):
+            self.assertEqual(chdict, self.change14_dict)
+            self.assertEqual(chcache.hits, 2)
+        d.addCallback(check_hit)
+        return d
+
+    def test_getChanges_empty(self):
+        d = self.db.changes.getChanges([])
+        def check(chdicts):
+            self.assertEqual(chdicts, [])
+        d.addCallback(check)
+        return d
+
+    def test_getChangeidsAfter(self):
+        d = self.insertTestData([
+            fakedb.Change(changeid=8),
+            fakedb.Change(changeid=9),
+            fakedb.Change(changeid=11),
+            fakedb.Change(changeid=12),
+        ])
+        d.addCallback(lambda _ : self.db.changes.getChangeidsAfter(8))
+        def check(changeids):
+            self.assertEqual(changeids, [9, 11, 12])
+        d.addCallback(check)
+        d.addCallback(lambda _ :
+                self.db.changes.getChangeidsAfter(9, count=1))
+        def check_count(changeids):
+            self.assertEqual(changeids, [11])
+        d.addCallback(check_count)
+        d.addCallback(lambda _ : self.db.changes.getChangeidsAfter(12))
+        def check_empty(changeids):
+            self.assertEqual(changeids, [])
+        d.addCallback(check_empty)
+        return d
+
     def test_getLatestChangeid(self):
         d = self.insertTestData(self.change13_rows)
         def get(_):
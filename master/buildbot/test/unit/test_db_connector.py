@@ -39,6 +39,17 @@ class DBConnector(db.RealDatabaseMixin, unittest.TestCase):
     def tearDown(self):
         return self.tearDownRealDatabase()
 
+    def test_read_pool_default(self):
+        self.assertIdentical(self.dbc.read_pool, self.dbc.pool)
+
+    def test_read_pool_db_read_url(self):
+        dbc = connector.DBConnector(mock.Mock(), self.db_url,
+                    os.path.abspath('basedir'), db_read_url=self.db_url)
+        self.assertNotIdentical(dbc.read_pool, dbc.pool)
+        self.assertNotIdentical(dbc._read_engine, dbc._engine)
+        dbc.read_pool.shutdown()
+        dbc.pool.shutdown()
+
     def test_doCleanup(self):
         # patch out all of the cleanup tasks; note that we can't patch dbc.doCleanup
         # directly, since it's already been incorporated into the TimerService
@@ -168,9 +168,40 @@ class BuildbotEngineStrategy_special_cases(unittest.TestCase):
                   exp ])
 
 
+    def test_thread_pool_args(self):
+        u = url.make_url("mysql:///dbname?thread_pool_min=2&foo=bar"
+                         "&thread_pool_max=10&thread_pool_adaptive=1")
+        u, args = self.strat.get_thread_pool_args(u)
+        self.assertEqual([ str(u), args ],
+                [ "mysql:///dbname?foo=bar",
+                  dict(thread_pool_min=2, thread_pool_max=10,
+                       thread_pool_adaptive=True) ])
+
+    def test_thread_pool_args_none(self):
+        u = url.make_url("mysql:///dbname?foo=bar")
+        u, args = self.strat.get_thread_pool_args(u)
+        self.assertEqual([ str(u), args ], [ "mysql:///dbname?foo=bar", {} ])
+
+    def test_thread_pool_args_bad(self):
+        u = url.make_url("mysql:///dbname?thread_pool_max=lots")
+        self.assertRaises(TypeError,
+                lambda : self.strat.get_thread_pool_args(u))
+
+
 class BuildbotEngineStrategy(unittest.TestCase):
     "Test create_engine by creating a sqlite in-memory db"
 
     def test_create_engine(self):
         engine = enginestrategy.create_engine('sqlite://', basedir="/base")
         self.assertEqual(engine.scalar("SELECT 13 + 14"), 27)
+        self.assertEqual(engine.optimal_thread_pool_size, 1)
+        self.assertEqual(engine.min_thread_pool_size, 1)
+        self.assertEqual(engine.adaptive_thread_pool, False)
+
+    def test_create_engine_thread_pool_args(self):
+        engine = enginestrategy.create_engine(
+                'sqlite:///state.sqlite?thread_pool_min=2&thread_pool_max=4'
+                '&thread_pool_adaptive=true', basedir="/base")
+        self.assertEqual(engine.optimal_thread_pool_size, 4)
+        self.assertEqual(engine.min_thread_pool_size, 2)
+        self.assertEqual(engine.adaptive_thread_pool, True)
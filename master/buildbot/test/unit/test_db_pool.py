@@ -15,8 +15,10 @@
 
 import sqlalchemy as sa
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python import log
 from buildbot.db import pool
+from buildbot.process import metrics
 from buildbot.test.util import db
 
 class Basic(unittest.TestCase):
@@ -104,6 +106,88 @@ class Basic(unittest.TestCase):
         return d
 
 
+    def test_do_metrics(self):
+        events = []
+        def observer(eventDict):
+            metric = eventDict.get('metric')
+            if isinstance(metric, metrics.MetricTimeEvent):
+                events.append(metric.timer)
+            elif isinstance(metric, metrics.MetricQueryEvent):
+                events.append((metric.query, metric.rows))
+        log.addObserver(observer)
+        d = self.pool.do(lambda conn : [ 1, 2, 3 ])
+        def check(_):
+            log.removeObserver(observer)
+            self.assertEqual(events, [ 'DBThreadPool.wait',
+                                       'DBThreadPool.execute',
+                                       ('test_db_pool.test_do_metrics', 3) ])
+        d.addCallback(check)
+        return d
+
+
+class CountRows(unittest.TestCase):
+
+    def test_count_rows(self):
+        self.assertEqual(pool.count_rows(None), 0)
+        self.assertEqual(pool.count_rows([ 1, 2, 3 ]), 3)
+        self.assertEqual(pool.count_rows(set([ 1, 2 ])), 2)
+        # a single result dictionary is one row, however many keys it has
+        self.assertEqual(pool.count_rows(dict(changeid=1, author='me')), 1)
+        self.assertEqual(pool.count_rows(7), 1)
+
+
+class Sizing(unittest.TestCase):
+
+    def makePool(self, **attrs):
+        self.engine = sa.create_engine('sqlite://')
+        for k, v in attrs.iteritems():
+            setattr(self.engine, k, v)
+        self.pool = pool.DBThreadPool(self.engine)
+        def cleanup():
+            # the pool may not have started yet
+            if self.pool._start_evt:
+                reactor.removeSystemEventTrigger(self.pool._start_evt)
+            else:
+                self.pool.shutdown()
+        self.addCleanup(cleanup)
+
+    def test_default(self):
+        self.makePool()
+        self.assertEqual((self.pool.min, self.pool.max), (1, 5))
+
+    def test_min_max(self):
+        self.makePool(optimal_thread_pool_size=8, min_thread_pool_size=3)
+        self.assertEqual((self.pool.min, self.pool.max), (3, 8))
+
+    def test_min_limited_by_max(self):
+        self.makePool(optimal_thread_pool_size=1, min_thread_pool_size=3)
+        self.assertEqual((self.pool.min, self.pool.max), (1, 1))
+
+    def test_adaptive(self):
+        self.makePool(optimal_thread_pool_size=3, min_thread_pool_size=1,
+                      adaptive_thread_pool=True)
+        self.assertEqual((self.pool.min, self.pool.max), (1, 1))
+
+        def report(wait, times=pool.DBThreadPool.ADAPT_INTERVAL):
+            for i in range(times):
+                self.pool._reportTiming(wait, 0.001)
+            return self.pool.max
+
+        # grows only after a full interval, and only up to the maximum
+        self.assertEqual(report(1.0, times=1), 1)
+        self.assertEqual(report(1.0, times=19), 2)
+        self.assertEqual(report(1.0), 3)
+        self.assertEqual(report(1.0), 3)
+
+        # steady in between
+        self.assertEqual(report(0.01), 3)
+
+        # shrinks back down to the minimum
+        self.assertEqual(report(0.0), 2)
+        self.assertEqual(report(0.0), 1)
+        self.assertEqual(report(0.0), 1)
+
+
 class BasicWithDebug(Basic):
 
     # same thing, but with debug=True
@@ -15,7 +15,7 @@
 
 import os
 import mock
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 from buildbot import master
 from buildbot.util import subscription
@@ -285,6 +285,47 @@ class Polling(dirs.DirsMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pollDatabaseChanges_windowed(self):
+        self.master.CHANGE_POLL_WINDOW = 2
+        self.master.CHANGE_CHECKPOINT_INTERVAL = 3
+        self.db.insertTestData([
+            fakedb.Object(id=53, name='master',
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+        ] + [ fakedb.Change(changeid=i) for i in range(10, 18) ])
+        setState = mock.Mock(wraps=self.master._setState)
+        self.master._setState = setState
+        d = self.master.pollDatabaseChanges()
+        def check(_):
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             range(11, 18))
+            # checkpointed every three changes, plus once at the end
+            self.assertEqual([ c[0][1] for c in setState.call_args_list ],
+                             [ 13, 16, 17 ])
+            self.db.state.assertState(53, last_processed_change=17)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseChanges_gap(self):
+        self.db.insertTestData([
+            fakedb.Object(id=53, name='master',
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=11),
+            fakedb.Change(changeid=13),
+        ])
+        d = self.master.pollDatabaseChanges()
+        def check(_):
+            # 12 may not be committed yet, so 13 waits for the next poll
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             [ 11 ])
+            self.db.state.assertState(53, last_processed_change=11)
+        d.addCallback(check)
+        return d
+
     def test_pollDatabaseChanges_nothing_new(self):
         self.db.insertTestData([
             fakedb.Object(id=53, name='master',
@@ -362,3 +403,99 @@ class Polling(dirs.DirsMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pollDatabaseBuildRequests_reconcile_interval(self):
+        self.master.db_poll_reconcile_interval = 600
+        clock = task.Clock()
+        self.patch(master, 'reactor', clock)
+        getBuildRequests = mock.Mock(
+                wraps=self.db.buildrequests.getBuildRequests)
+        self.db.buildrequests.getBuildRequests = getBuildRequests
+
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def insert2_and_claim(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=20, buildsetid=9,
+                                        buildername='twenty'),
+            ])
+            self.db.buildrequests.fakeClaimBuildRequest(11)
+            clock.advance(10)
+        d.addCallback(insert2_and_claim)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def unclaim(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.buildrequests.fakeUnclaimBuildRequest(11)
+            clock.advance(10)
+        d.addCallback(unclaim)
+        # the unclaim is not seen by an incremental poll..
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def reconcile(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            clock.advance(600)
+        d.addCallback(reconcile)
+        # ..but is seen at the next reconciliation
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def check(_):
+            self.assertEqual(self.gotten_buildrequest_additions, [
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                'MARK',
+                dict(bsid=9, brid=20, buildername='twenty'),
+                'MARK',
+                'MARK',
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                dict(bsid=9, brid=20, buildername='twenty'),
+            ])
+            self.assertEqual(
+                [ c[1].get('after_brid') for c in getBuildRequests.call_args_list ],
+                [ None, 11, 20, None ])
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseBuildRequests_latest_brid_only_if_incremental(self):
+        getLatest = mock.Mock(
+                wraps=self.db.buildrequests.getLatestBuildRequestId)
+        self.db.buildrequests.getLatestBuildRequestId = getLatest
+        d = self.master.pollDatabaseBuildRequests()
+        def check(_):
+            self.assertFalse(getLatest.called)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseBuildRequests_reconcile_forgets_claimed(self):
+        self.master.db_poll_reconcile_interval = 600
+        clock = task.Clock()
+        self.patch(master, 'reactor', clock)
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+            fakedb.BuildRequest(id=12, buildsetid=9, buildername='twelve'),
+        ])
+        d = self.master.pollDatabaseBuildRequests()
+        def claim_and_insert(_):
+            self.db.buildrequests.fakeClaimBuildRequest(11)
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=20, buildsetid=9,
+                                        buildername='twenty'),
+            ])
+            clock.advance(10)
+        d.addCallback(claim_and_insert)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def check_incremental(_):
+            # an incremental poll only adds new requests
+            self.assertEqual(self.master._last_unclaimed_brids_set,
+                             set([ 11, 12, 20 ]))
+            clock.advance(600)
+        d.addCallback(check_incremental)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def check_reconciled(_):
+            # and the claimed request is forgotten at reconciliation
+            self.assertEqual(self.master._last_unclaimed_brids_set,
+                             set([ 12, 20 ]))
+        d.addCallback(check_reconciled)
+        return d
@@ -18,8 +18,8 @@ from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from twisted.python import failure
 from buildbot.test.util import compat
-from buildbot.process import botmaster
-from buildbot.util import epoch2datetime
+from buildbot.test.fake import fakedb
+from buildbot.process import botmaster, builder
 
 class Test(unittest.TestCase):
 
@@ -31,6 +31,7 @@ class Test(unittest.TestCase):
             return sorted(builders, lambda b1,b2 : cmp(b1.name, b2.name))
         self.botmaster.prioritizeBuilders = prioritizeBuilders
         self.master = self.botmaster.master = mock.Mock(name='master')
+        self.master.db = fakedb.FakeDBConnector(self)
         self.brd = botmaster.BuildRequestDistributor(self.botmaster)
         self.brd.startService()
 
@@ -58,12 +59,17 @@ class Test(unittest.TestCase):
             bldr = mock.Mock(name=name)
             self.botmaster.builders[name] = bldr
             self.builders[name] = bldr
-            def maybeStartBuild(n=name):
+            def maybeStartBuild(n=name, unclaimed_requests=None):
                 self.maybeStartBuild_calls.append(n)
                 d = defer.Deferred()
                 reactor.callLater(0, d.callback, None)
                 return d
             bldr.maybeStartBuild = maybeStartBuild
+            def getOldestRequestTime(b=bldr, unclaimed_requests=None):
+                return builder.Builder.getOldestRequestTime.im_func(b,
+                                unclaimed_requests=unclaimed_requests)
+            bldr.getOldestRequestTime = getOldestRequestTime
+            bldr.master = self.master
             bldr.name = name
 
     def removeBuilder(self, name):
@@ -80,6 +86,21 @@ class Test(unittest.TestCase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    def test_maybeStartBuildsOn_old_maybeStartBuild(self):
+        # overrides written before maybeStartBuild took the snapshot are still
+        # called
+        self.addBuilders(['bldr1'])
+        def maybeStartBuild():
+            self.maybeStartBuild_calls.append('bldr1')
+            return defer.succeed(None)
+        self.builders['bldr1'].maybeStartBuild = maybeStartBuild
+        d = self.quiet_deferred
+        self.brd.maybeStartBuildsOn(['bldr1'])
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls, ['bldr1'])
+        d.addCallback(check)
+        return d
+
     def test_maybeStartBuildsOn_parallel(self):
         # test 15 "parallel" invocations of maybeStartBuildsOn, with a
         # _sortBuilders that takes a while.  This is a regression test for bug
@@ -104,6 +125,60 @@ class Test(unittest.TestCase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    @compat.usesFlushLoggedErrors
+    def test_maybeStartBuildsOn_snapshot(self):
+        self.addBuilders(['bldr1', 'bldr2'])
+        self.master.db.insertTestData([
+            fakedb.BuildRequest(id=10, buildsetid=1, buildername='bldr1'),
+            fakedb.BuildRequest(id=11, buildsetid=1, buildername='bldr2'),
+            fakedb.BuildRequest(id=12, buildsetid=1, buildername='bldr2'),
+        ])
+        getBuildRequests = mock.Mock(
+                wraps=self.master.db.buildrequests.getBuildRequests)
+        self.master.db.buildrequests.getBuildRequests = getBuildRequests
+        requests = {}
+        for name in 'bldr1', 'bldr2':
+            def maybeStartBuild(n=name, unclaimed_requests=None):
+                requests[n] = sorted([ brd['brid']
+                                       for brd in unclaimed_requests ])
+                return defer.succeed(None)
+            self.builders[name].maybeStartBuild = maybeStartBuild
+
+        d = self.quiet_deferred
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2'])
+        def check(_):
+            self.assertEqual(requests, dict(bldr1=[10], bldr2=[11, 12]))
+            # one query served both builders
+            self.assertEqual(getBuildRequests.call_count, 1)
+            # and the snapshot entries were consumed
+            self.assertEqual(self.brd._unclaimed_requests, {})
+        d.addCallback(check)
+        return d
+
+    def test_snapshot_cleared_when_quiet(self):
+        self.addBuilders(['bldr1', 'bldr2'])
+        d = self.quiet_deferred
+        # bldr2 is sorted, so fetched, but is gone before it is called
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2'])
+        self.removeBuilder('bldr2')
+        def check(_):
+            self.assertEqual(self.brd._unclaimed_requests, {})
+        d.addCallback(check)
+        return d
+
+    def test_invalidate_during_fetch(self):
+        self.addBuilders(['bldr1', 'bldr2'])
+        fetch_d = defer.Deferred()
+        self.master.db.buildrequests.getBuildRequests = \
+                lambda **kw : fetch_d
+        d = self.brd._fetchUnclaimedRequests(['bldr1', 'bldr2'])
+        self.brd._invalidateUnclaimedRequests(['bldr2'])
+        fetch_d.callback([])
+        def check(_):
+            self.assertEqual(self.brd._unclaimed_requests, dict(bldr1=[]))
+        d.addCallback(check)
+        return d
+
     @compat.usesFlushLoggedErrors
     def test_maybeStartBuildsOn_exception(self):
         self.addBuilders(['bldr1'])
@@ -150,20 +225,21 @@ class Test(unittest.TestCase):
         return self.quiet_deferred
 
     def do_test_sortBuilders(self, prioritizeBuilders, oldestRequestTimes,
-            expected, returnDeferred=False):
+            expected):
         self.addBuilders(oldestRequestTimes.keys())
         self.botmaster.prioritizeBuilders = prioritizeBuilders
 
-        def mklambda(t): # work around variable-binding issues
-            if returnDeferred:
-                return lambda : defer.succeed(t)
-            else:
-                return lambda : t
-
-        for n, t in oldestRequestTimes.iteritems():
-            if t is not None:
-                t = epoch2datetime(t)
-            self.builders[n].getOldestRequestTime = mklambda(t)
+        brid = 1
+        for n, times in oldestRequestTimes.iteritems():
+            if not isinstance(times, list):
+                times = [ times ]
+            for t in times:
+                if t is not None:
+                    self.master.db.insertTestData([
+                        fakedb.BuildRequest(id=brid, buildsetid=1,
+                                            buildername=n, submitted_at=t),
+                    ])
+                    brid += 1
 
         d = self.brd._sortBuilders(oldestRequestTimes.keys())
         def check(result):
@@ -171,22 +247,73 @@ class Test(unittest.TestCase):
         d.addCallback(check)
         return d
 
-    def test_sortBuilders_default_sync(self):
+    def test_sortBuilders_default(self):
         return self.do_test_sortBuilders(None, # use the default sort
                 dict(bldr1=777, bldr2=999, bldr3=888),
                 ['bldr1', 'bldr3', 'bldr2'])
 
-    def test_sortBuilders_default_asyn(self):
+    def test_sortBuilders_default_multiple_requests(self):
         return self.do_test_sortBuilders(None, # use the default sort
-                dict(bldr1=777, bldr2=999, bldr3=888),
-                ['bldr1', 'bldr3', 'bldr2'],
-                returnDeferred=True)
+                dict(bldr1=[1000, 777], bldr2=[999, 555], bldr3=888),
+                ['bldr2', 'bldr1', 'bldr3'])
 
     def test_sortBuilders_default_None(self):
         return self.do_test_sortBuilders(None, # use the default sort
                 dict(bldr1=777, bldr2=None, bldr3=888),
                 ['bldr1', 'bldr3', 'bldr2'])
 
+    def test_sortBuilders_default_one_query(self):
+        getBuildRequests = mock.Mock(
+                wraps=self.master.db.buildrequests.getBuildRequests)
+        self.master.db.buildrequests.getBuildRequests = getBuildRequests
+        d = self.do_test_sortBuilders(None,
+                dict(bldr1=777, bldr2=999, bldr3=888),
+                ['bldr1', 'bldr3', 'bldr2'])
+        def check(_):
+            self.assertEqual(getBuildRequests.call_count, 1)
+            self.assertEqual(
+                sorted(getBuildRequests.call_args[1]['buildername']),
+                ['bldr1', 'bldr2', 'bldr3'])
+        d.addCallback(check)
+        return d
+
+    def test_sortBuilders_default_getOldestRequestTime_override(self):
+        # the snapshot is handed to the builders' getOldestRequestTime, and
+        # their answer is used
+        self.addBuilders(['bldr1', 'bldr2'])
+        self.master.db.insertTestData([
+            fakedb.BuildRequest(id=10, buildsetid=1, buildername='bldr1'),
+        ])
+        given = {}
+        for n, t in ('bldr1', 20), ('bldr2', 10):
+            def getOldestRequestTime(n=n, t=t, unclaimed_requests=None):
+                given[n] = [ brd['brid'] for brd in unclaimed_requests ]
+                return t
+            self.builders[n].getOldestRequestTime = getOldestRequestTime
+        self.botmaster.prioritizeBuilders = None
+        d = self.brd._sortBuilders(['bldr1', 'bldr2'])
+        def check(result):
+            self.assertEqual(result, ['bldr2', 'bldr1'])
+            self.assertEqual(given, dict(bldr1=[10], bldr2=[]))
+        d.addCallback(check)
+        return d
+
+    def test_sortBuilders_default_getOldestRequestTime_old_override(self):
+        # overrides written before getOldestRequestTime took the snapshot
+        # are still called
+        self.addBuilders(['bldr1', 'bldr2'])
+        for n, t in ('bldr1', 20), ('bldr2', 10):
+            @defer.deferredGenerator
+            def getOldestRequestTime(t=t):
+                yield t
+            self.builders[n].getOldestRequestTime = getOldestRequestTime
+        self.botmaster.prioritizeBuilders = None
+        d = self.brd._sortBuilders(['bldr1', 'bldr2'])
+        def check(result):
+            self.assertEqual(result, ['bldr2', 'bldr1'])
+        d.addCallback(check)
+        return d
+
     def test_sortBuilders_custom(self):
         def prioritizeBuilders(master, builders):
             self.assertIdentical(master, self.master)
@@ -230,7 +357,7 @@ class Test(unittest.TestCase):
 
         # patch the maybeStartBuild method for A to stop the service and wait a
         # beat, with some extra logging
-        def msb_stopNow():
+        def msb_stopNow(unclaimed_requests=None):
             self.maybeStartBuild_calls.append('A')
             stop_d = self.brd.stopService()
             stop_d.addCallback(lambda _ :
@@ -253,3 +380,64 @@ class Test(unittest.TestCase):
                     ['A', 'A-finished', '(stopped)'])
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
+
+    def addConcurrentBuilders(self, slavenames):
+        # add builders with the given slaves, logging the start and finish of
+        # each maybeStartBuild call
+        self.addBuilders(sorted(slavenames.keys()))
+        for name, slaves in slavenames.items():
+            self.builders[name].slavenames = slaves
+            def maybeStartBuild(n=name, unclaimed_requests=None):
+                self.maybeStartBuild_calls.append(n)
+                d = defer.Deferred()
+                def finished():
+                    self.maybeStartBuild_calls.append(n + '-finished')
+                    d.callback(None)
+                reactor.callLater(0, finished)
+                return d
+            self.builders[name].maybeStartBuild = maybeStartBuild
+
+    def test_maybeStartBuildsOn_concurrent(self):
+        self.brd.concurrency = 3
+        self.addConcurrentBuilders(dict(A=['s1'], B=['s2'], C=['s3']))
+        self.brd.maybeStartBuildsOn(['A', 'B', 'C'])
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls,
+                    ['A', 'B', 'C', 'A-finished', 'B-finished', 'C-finished'])
+        self.quiet_deferred.addCallback(check)
+        return self.quiet_deferred
+
+    def test_maybeStartBuildsOn_concurrent_shared_slaves(self):
+        # B shares a slave with A, so it must wait for A to finish, but C can
+        # go ahead of it
+        self.brd.concurrency = 3
+        self.addConcurrentBuilders(dict(A=['s1', 's2'], B=['s2'], C=['s3']))
+        self.brd.maybeStartBuildsOn(['A', 'B', 'C'])
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls,
+                    ['A', 'C', 'A-finished', 'B', 'C-finished', 'B-finished'])
+        self.quiet_deferred.addCallback(check)
+        return self.quiet_deferred
+
+    def test_maybeStartBuildsOn_concurrent_limit(self):
+        self.brd.concurrency = 2
+        self.addConcurrentBuilders(dict(A=['s1'], B=['s2'], C=['s3']))
+        self.brd.maybeStartBuildsOn(['A', 'B', 'C'])
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls,
+                    ['A', 'B', 'A-finished', 'C', 'B-finished', 'C-finished'])
+        self.quiet_deferred.addCallback(check)
+        return self.quiet_deferred
+
+    def test_maybeStartBuildsOn_concurrent_same_builder(self):
+        # a builder re-added while it is running is not run concurrently
+        # with itself
+        self.brd.concurrency = 3
+        self.addConcurrentBuilders(dict(A=['s1']))
+        self.brd.maybeStartBuildsOn(['A'])
+        self.brd.maybeStartBuildsOn(['A'])
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls,
+                    ['A', 'A-finished', 'A', 'A-finished'])
+        self.quiet_deferred.addCallback(check)
+        return self.quiet_deferred
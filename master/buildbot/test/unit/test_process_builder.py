@@ -16,11 +16,10 @@
 import mock
 import random
 from twisted.trial import unittest
-from twisted.python import failure
+from twisted.python import failure, log
 from twisted.internet import defer
 from buildbot.test.fake import fakedb, fakemaster
-from buildbot.process import builder
-from buildbot.db import buildrequests
+from buildbot.process import builder, metrics
 from buildbot.util import epoch2datetime
 
 class TestBuilderBuildCreation(unittest.TestCase):
@@ -176,6 +175,28 @@ class TestBuilderBuildCreation(unittest.TestCase):
                 exp_claims=[10, 11],
                 exp_builds=[('test-slave2', [10]), ('test-slave1', [11])])
 
+    def test_maybeStartBuild_request_to_build_start(self):
+        self.makeBuilder(mergeRequests=False)
+        self.setSlaveBuilders({'test-slave1':1})
+        self.patch(builder, 'now', lambda : 130100)
+        events = []
+        def observer(eventDict):
+            metric = eventDict.get('metric')
+            if isinstance(metric, metrics.MetricTimeEvent):
+                events.append((metric.timer, metric.elapsed))
+        log.addObserver(observer)
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr",
+                submitted_at=130000),
+        ]
+        d = self.do_test_maybeStartBuild(rows=rows,
+                exp_claims=[10], exp_builds=[('test-slave1', [10])])
+        def check(_):
+            log.removeObserver(observer)
+            self.assertIn(('Builder.request_to_build_start', 100), events)
+        d.addCallback(check)
+        return d
+
     def test_maybeStartBuild_limited_by_requests(self):
         self.makeBuilder(mergeRequests=False, patch_random=True)
         self.setSlaveBuilders({'test-slave1':1, 'test-slave2':1})
@@ -261,17 +282,18 @@ class TestBuilderBuildCreation(unittest.TestCase):
         self.makeBuilder(patch_random=True)
 
         # fake a race condition on the buildrequests table
-        old_claimBuildRequests = self.db.buildrequests.claimBuildRequests
-        def claimBuildRequests(brids):
+        old_claimAnyBuildRequests = self.db.buildrequests.claimAnyBuildRequests
+        def claimAnyBuildRequests(brids):
             # first, ensure this only happens the first time
-            self.db.buildrequests.claimBuildRequests = old_claimBuildRequests
+            self.db.buildrequests.claimAnyBuildRequests = \
+                    old_claimAnyBuildRequests
             # claim brid 10 for some other master
             assert 10 in brids
             self.db.buildrequests.fakeClaimBuildRequest(10, 136000,
                     objectid=9999) # some other objectid
-            # ..and fail
-            return defer.fail(buildrequests.AlreadyClaimedError())
-        self.db.buildrequests.claimBuildRequests = claimBuildRequests
+            # ..and claim the rest
+            return old_claimAnyBuildRequests(brids)
+        self.db.buildrequests.claimAnyBuildRequests = claimAnyBuildRequests
 
         self.setSlaveBuilders({'test-slave1':1, 'test-slave2':1})
         rows = self.base_rows + [
@@ -283,6 +305,104 @@ class TestBuilderBuildCreation(unittest.TestCase):
         return self.do_test_maybeStartBuild(rows=rows,
                 exp_claims=[11], exp_builds=[('test-slave2', [11])])
 
+    def test_maybeStartBuild_claim_race_merged(self):
+        self.makeBuilder(patch_random=True)
+
+        # another master claims one of the merged requests, but not the one
+        # that was chosen; the rest should still be built, without
+        # re-fetching the build requests
+        old_claimAnyBuildRequests = self.db.buildrequests.claimAnyBuildRequests
+        def claimAnyBuildRequests(brids):
+            self.db.buildrequests.claimAnyBuildRequests = \
+                    old_claimAnyBuildRequests
+            self.assertEqual(brids, [10, 11, 12])
+            self.db.buildrequests.fakeClaimBuildRequest(11, 136000,
+                    objectid=9999) # some other objectid
+            return old_claimAnyBuildRequests(brids)
+        self.db.buildrequests.claimAnyBuildRequests = claimAnyBuildRequests
+
+        self.setSlaveBuilders({'test-slave1':1, 'test-slave2':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="bldr",
+                submitted_at=135000), # will turn out to be claimed!
+            fakedb.BuildRequest(id=12, buildsetid=11, buildername="bldr",
+                submitted_at=140000),
+        ]
+        d = self.db.insertTestData(rows)
+        d.addCallback(lambda _ :
+            self.db.buildrequests.getBuildRequests(buildername='bldr',
+                                                   claimed=False))
+        def startBuilds(brdicts):
+            def getBuildRequests(**kwargs):
+                self.fail("should not re-fetch build requests")
+            self.db.buildrequests.getBuildRequests = getBuildRequests
+            return self.bldr.maybeStartBuild(unclaimed_requests=brdicts)
+        d.addCallback(startBuilds)
+        def check(_):
+            self.db.buildrequests.assertMyClaims([10, 12])
+            self.assertBuildsStarted([('test-slave2', [10, 12])])
+        d.addCallback(check)
+        return d
+
+    def do_test_maybeStartBuild_claim_race_lost(self, lost_brid):
+        # another master claims one of three merged requests; record what
+        # is unclaimed as a result
+        old_claimAnyBuildRequests = self.db.buildrequests.claimAnyBuildRequests
+        def claimAnyBuildRequests(brids):
+            self.db.buildrequests.claimAnyBuildRequests = \
+                    old_claimAnyBuildRequests
+            self.assertEqual(brids, [10, 11, 12])
+            self.db.buildrequests.fakeClaimBuildRequest(lost_brid, 136000,
+                    objectid=9999) # some other objectid
+            return old_claimAnyBuildRequests(brids)
+        self.db.buildrequests.claimAnyBuildRequests = claimAnyBuildRequests
+
+        self.unclaimed = []
+        old_unclaimBuildRequests = self.db.buildrequests.unclaimBuildRequests
+        def unclaimBuildRequests(brids):
+            self.unclaimed.append(sorted(brids))
+            return old_unclaimBuildRequests(brids)
+        self.db.buildrequests.unclaimBuildRequests = unclaimBuildRequests
+
+        self.setSlaveBuilders({'test-slave1':1, 'test-slave2':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="bldr",
+                submitted_at=135000),
+            fakedb.BuildRequest(id=12, buildsetid=11, buildername="bldr",
+                submitted_at=140000),
+        ]
+        d = self.db.insertTestData(rows)
+        d.addCallback(lambda _ : self.bldr.maybeStartBuild())
+        return d
+
+    def test_maybeStartBuild_claim_race_chosen_lost(self):
+        self.makeBuilder(patch_random=True)
+        d = self.do_test_maybeStartBuild_claim_race_lost(10)
+        def check(_):
+            # the chosen request was lost, so the others were released and
+            # then chosen and claimed again
+            self.assertEqual(self.unclaimed, [ [11, 12] ])
+            self.db.buildrequests.assertMyClaims([11, 12])
+            self.assertBuildsStarted([('test-slave2', [11, 12])])
+        d.addCallback(check)
+        return d
+
+    def test_maybeStartBuild_claim_race_last_lost(self):
+        self.makeBuilder(patch_random=True)
+        d = self.do_test_maybeStartBuild_claim_race_lost(12)
+        def check(_):
+            # the chosen request was claimed, so its build goes ahead without
+            # the lost request, and nothing is released
+            self.assertEqual(self.unclaimed, [])
+            self.db.buildrequests.assertMyClaims([10, 11])
+            self.assertBuildsStarted([('test-slave2', [10, 11])])
+        d.addCallback(check)
+        return d
+
     def test_maybeStartBuild_builder_stopped(self):
         self.makeBuilder()
 
@@ -503,6 +623,108 @@ class TestBuilderBuildCreation(unittest.TestCase):
         yield wfd
         self.assertEqual(wfd.getResult(), [ brdicts[1] ])
 
+    @defer.deferredGenerator
+    def test_mergeRequests_default(self):
+        self.makeBuilder()
+        wfd = defer.waitForDeferred(
+            self.db.insertTestData([
+                fakedb.SourceStamp(id=234, branch='a'),
+                fakedb.SourceStamp(id=235, branch='b'),
+                fakedb.Buildset(id=30, sourcestampid=234, reason='foo',
+                    submitted_at=1300305712, results=-1),
+                fakedb.Buildset(id=31, sourcestampid=235, reason='foo',
+                    submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=19, buildsetid=30, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=20, buildsetid=31, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=21, buildsetid=30, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+            ]))
+        yield wfd
+        wfd.getResult()
+
+        wfd = defer.waitForDeferred(
+            defer.gatherResults([
+                self.db.buildrequests.getBuildRequest(id)
+                for id in (19, 20, 21)
+            ]))
+        yield wfd
+        brdicts = wfd.getResult()
+
+        # only requests with the same merge key should become objects
+        converted = []
+        orig_brdictToBuildRequest = self.bldr._brdictToBuildRequest
+        def _brdictToBuildRequest(brdict):
+            converted.append(brdict['brid'])
+            return orig_brdictToBuildRequest(brdict)
+        self.bldr._brdictToBuildRequest = _brdictToBuildRequest
+
+        wfd = defer.waitForDeferred(
+            self.bldr._mergeRequests(brdicts[0], brdicts,
+                                     builder.Builder._defaultMergeRequestFn))
+        yield wfd
+        self.assertEqual(wfd.getResult(), [ brdicts[0], brdicts[2] ])
+        self.assertEqual(sorted(converted), [ 19, 21 ])
+
+        # a request alone in its bucket doesn't need any objects at all
+        del converted[:]
+        wfd = defer.waitForDeferred(
+            self.bldr._mergeRequests(brdicts[1], brdicts,
+                                     builder.Builder._defaultMergeRequestFn))
+        yield wfd
+        self.assertEqual(wfd.getResult(), [ brdicts[1] ])
+        self.assertEqual(converted, [])
+
+        self.bldr._breakBrdictRefloops(brdicts)
+
+    @defer.deferredGenerator
+    def test_mergeRequests_default_patched_changes(self):
+        # sourcestamps with changes are merged even if their patches differ,
+        # so the merge key must not separate them
+        self.makeBuilder()
+        wfd = defer.waitForDeferred(
+            self.db.insertTestData([
+                fakedb.Patch(id=1, patch_base64='aGVsbG8sIHdvcmxk',
+                    patch_author='bar', patch_comment='foo', subdir='/foo',
+                    patchlevel=3),
+                fakedb.Change(changeid=13, branch='a'),
+                fakedb.Change(changeid=14, branch='a'),
+                fakedb.SourceStamp(id=234, branch='a', patchid=1),
+                fakedb.SourceStampChange(sourcestampid=234, changeid=13),
+                fakedb.SourceStamp(id=235, branch='a'),
+                fakedb.SourceStampChange(sourcestampid=235, changeid=14),
+                fakedb.Buildset(id=30, sourcestampid=234, reason='foo',
+                    submitted_at=1300305712, results=-1),
+                fakedb.Buildset(id=31, sourcestampid=235, reason='foo',
+                    submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=19, buildsetid=30, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=20, buildsetid=31, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+            ]))
+        yield wfd
+        wfd.getResult()
+
+        wfd = defer.waitForDeferred(
+            defer.gatherResults([
+                self.db.buildrequests.getBuildRequest(id)
+                for id in (19, 20)
+            ]))
+        yield wfd
+        brdicts = wfd.getResult()
+
+        wfd = defer.waitForDeferred(
+            self.bldr._mergeRequests(brdicts[0], brdicts,
+                                     builder.Builder._defaultMergeRequestFn))
+        yield wfd
+        self.assertEqual(wfd.getResult(), [ brdicts[0], brdicts[1] ])
+        # and the caller's dictionaries are not given merge keys
+        self.assertFalse([ brdict for brdict in brdicts
+                           if 'mergekey' in brdict ])
+
+        self.bldr._breakBrdictRefloops(brdicts)
+
     def test_mergeRequests_no_merging(self):
         self.makeBuilder()
         breq = dict(dummy=1)
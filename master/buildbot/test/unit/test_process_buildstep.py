@@ -14,9 +14,11 @@
 # Copyright Buildbot Team Members
 
 import re
+import zlib
 import mock
 from twisted.trial import unittest
-from buildbot.process import buildstep
+from twisted.python import log
+from buildbot.process import buildstep, metrics
 from buildbot.process.buildstep import regex_log_evaluator
 from buildbot.status.results import FAILURE, SUCCESS, WARNINGS, EXCEPTION
 from buildbot.test.fake import fakebuild
@@ -109,3 +111,99 @@ class TestLoggingBuildStep(unittest.TestCase):
         lbs = buildstep.LoggingBuildStep(log_eval_func=eval)
         status = lbs.evaluateCommand(cmd)
         self.assertEqual(status, WARNINGS, "evaluateCommand didn't call log_eval_func or overrode its results")
+
+class TestLoggedRemoteCommand(unittest.TestCase):
+
+    def makeCommand(self):
+        cmd = buildstep.LoggedRemoteCommand('shell', {})
+        cmd.buildslave = mock.Mock()
+        cmd.active = True
+        cmd.updates = {}
+        cmd.logs['stdio'] = stdio = mock.Mock()
+        cmd.useLogDelayed('out', lambda cmd : other)
+        other = mock.Mock()
+        self.calls = calls = []
+        stdio.addStdout = lambda data : calls.append(('stdout', data))
+        stdio.addStderr = lambda data : calls.append(('stderr', data))
+        stdio.addHeader = lambda data : calls.append(('header', data))
+        other.addStdout = lambda data : calls.append(('out', data))
+        return cmd
+
+    def test_remote_update_dict(self):
+        cmd = self.makeCommand()
+        cmd.remote_update([[{'stdout' : 'a'}, 0], [{'rc' : 0}, 0]])
+        self.assertEqual(self.calls, [ ('stdout', 'a'),
+                ('header', 'program finished with exit code 0\n') ])
+        self.assertEqual(cmd.rc, 0)
+
+    def test_remote_update_entries(self):
+        cmd = self.makeCommand()
+        cmd.remote_update([
+                [[('stdout', 'a'), ('stderr', 'b'), ('log', ('out', 'c')),
+                  ('stdout', 'd')], 0],
+                [{'header' : 'e'}, 0]])
+        self.assertEqual(self.calls, [ ('stdout', 'a'), ('stderr', 'b'),
+                ('out', 'c'), ('stdout', 'd'), ('header', 'e') ])
+
+    def test_remote_update_compressed(self):
+        cmd = self.makeCommand()
+        out = zlib.compressobj()
+        outlog = zlib.compressobj()
+        def compress(c, data):
+            return c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+        first = compress(out, 'hello ' * 100)
+        cmd.remote_update([
+                [[('zlib', ('stdout', None, first)),
+                  ('zlib', ('log', 'out', compress(outlog, 'c')))], 0],
+                [[('zlib', ('stdout', None, compress(out, 'again'))),
+                  ('stderr', 'b')], 0]])
+        self.assertEqual(self.calls, [ ('stdout', 'hello ' * 100),
+                ('out', 'c'), ('stdout', 'again'), ('stderr', 'b') ])
+        self.assertEqual(cmd.outputBytes, 607)
+        self.assertTrue(cmd.wireBytes < 100)
+        self.assertTrue(cmd.getCompressionRatio() > 6)
+
+        # the sizes are exported as a metric for the step when the command
+        # completes
+        events = []
+        def observer(eventDict):
+            metric = eventDict.get('metric')
+            if isinstance(metric, metrics.MetricTransferEvent):
+                events.append((metric.transfer, metric.outputBytes,
+                               metric.wireBytes))
+        log.addObserver(observer)
+        try:
+            cmd.step = mock.Mock()
+            cmd.step.name = 'compile'
+            cmd._startTime = None
+            cmd._closeWhenFinished['stdio'] = False
+            cmd.remoteComplete(None)
+        finally:
+            log.removeObserver(observer)
+        self.assertEqual(events, [ ('compile', 607, cmd.wireBytes) ])
+
+    def startCommand(self, slave_version, compress_logs):
+        cmd = self.makeCommand()
+        cmd.buildslave.compress_logs = compress_logs
+        cmd.step = mock.Mock()
+        cmd.step.build.getSlaveCommandVersion.return_value = slave_version
+        cmd.step.slaveVersionIsOlderThan = lambda command, minversion : \
+                map(int, slave_version.split('.')) < \
+                map(int, minversion.split('.'))
+        cmd.remote = mock.Mock()
+        cmd.commandID = '1'
+        cmd.start()
+        return cmd.remote.callRemote.call_args[1]
+
+    def test_start_compressed(self):
+        self.assertEqual(self.startCommand("2.16", True),
+                dict(updateProtocol=2, updateCompression='zlib'))
+
+    def test_start_not_compressed(self):
+        self.assertEqual(self.startCommand("2.16", False),
+                dict(updateProtocol=2))
+
+    def test_start_old_slave(self):
+        self.assertEqual(self.startCommand("2.15", True),
+                dict(updateProtocol=2))
+        self.assertEqual(self.startCommand("2.14", True), {})
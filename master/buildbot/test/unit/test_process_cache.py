@@ -42,3 +42,31 @@ class CacheManager(unittest.TestCase):
         metric = self.caches.get_metrics()['foo']
         for k in 'hits', 'refhits', 'misses', 'max_size':
             self.assertIn(k, metric)
+
+    def test_make_cache(self):
+        cache1 = self.caches.make_cache("foo/x", None, config_name="foo",
+                                        default_size=15)
+        self.assertEqual(cache1.max_size, 15)
+        self.assertFalse(cache1.contains('a'))
+
+        # the cache is replaced on each call
+        cache2 = self.caches.make_cache("foo/x", None, config_name="foo")
+        self.assertNotIdentical(cache1, cache2)
+        self.assertIdentical(self.caches._caches["foo/x"], cache2)
+
+    def test_make_cache_shared_config(self):
+        x = self.caches.make_cache("foo/x", None, config_name="foo",
+                                   default_size=15)
+        y = self.caches.make_cache("foo/y", None, config_name="foo",
+                                   default_size=15)
+        self.caches.load_config({'foo' : 30})
+        self.assertEqual((x.max_size, y.max_size), (30, 30))
+        self.caches.load_config({})
+        self.assertEqual((x.max_size, y.max_size), (15, 15))
+        self.assertIn('foo/y', self.caches.get_metrics())
+
+    def test_remove_cache(self):
+        self.caches.make_cache("foo/x", None)
+        self.caches.remove_cache("foo/x")
+        self.caches.remove_cache("foo/y")
+        self.assertNotIn('foo/x', self.caches.get_metrics())
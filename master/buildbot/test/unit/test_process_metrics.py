@@ -206,6 +206,56 @@ class TestReports(unittest.TestCase):
         self.assertEquals("Timer time_foo: 1", handler.report())
         self.assertEquals({"timers": {"time_foo": 1}}, handler.asDict())
 
+    def testMetricQueryReport(self):
+        handler = metrics.MetricQueryHandler(None)
+        handler.handle({}, metrics.MetricQueryEvent('foo.getFoo', 1, 3))
+        handler.handle({}, metrics.MetricQueryEvent('foo.getFoo', 3, 2))
+        handler.handle({}, metrics.MetricQueryEvent('bar.getBar', 5, 0))
+
+        self.assertEquals(
+            "Query bar.getBar: count 1 total 5 p50 5 p95 5 max 5 rows 0\n"
+            "Query foo.getFoo: count 2 total 4 p50 3 p95 3 max 3 rows 5",
+            handler.report())
+        self.assertEquals({"queries": {
+            "bar.getBar": dict(count=1, total=5, max=5, p50=5, p95=5, rows=0),
+            "foo.getFoo": dict(count=2, total=4, max=3, p50=3, p95=3, rows=5),
+            }}, handler.asDict())
+
+        # looking up an unknown query does not add it
+        self.assertEquals(handler.get('baz.getBaz'), None)
+        self.assertEquals(sorted(handler.keys()),
+                          ['bar.getBar', 'foo.getFoo'])
+
+    def testQueryStatsPercentiles(self):
+        stats = metrics.QueryStats()
+        for i in range(1, 201):
+            stats.add(i, 1)
+        # percentiles use only the most recent samples
+        self.assertEquals((stats.percentile(50), stats.percentile(95)),
+                          (151, 196))
+        self.assertEquals((stats.count, stats.max, stats.rows),
+                          (200, 200, 200))
+
+    def testMetricTransferReport(self):
+        handler = metrics.MetricTransferHandler(None)
+        handler.handle({}, metrics.MetricTransferEvent('compile', 600, 100))
+        handler.handle({}, metrics.MetricTransferEvent('compile', 400, 100))
+        handler.handle({}, metrics.MetricTransferEvent('test', 50, 50))
+
+        self.assertEquals(
+            "Transfer compile: count 2 output 1000 wire 200 ratio 5\n"
+            "Transfer test: count 1 output 50 wire 50 ratio 1",
+            handler.report())
+        self.assertEquals({"transfers": {
+            "compile": dict(count=2, outputBytes=1000, wireBytes=200,
+                            ratio=5.0),
+            "test": dict(count=1, outputBytes=50, wireBytes=50, ratio=1.0),
+            }}, handler.asDict())
+
+        # looking up an unknown transfer does not add it
+        self.assertEquals(handler.get('upload'), None)
+        self.assertEquals(sorted(handler.keys()), ['compile', 'test'])
+
     def testMetricAlarmReport(self):
         handler = metrics.MetricAlarmHandler(None)
         handler.handle({}, metrics.MetricAlarmEvent('alarm_foo', msg='Uh oh', level=metrics.ALARM_WARN))
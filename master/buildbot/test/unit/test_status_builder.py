@@ -0,0 +1,297 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from buildbot.status import builder, buildindex
+from buildbot.process import cache
+from buildbot.status.results import SUCCESS, FAILURE
+from buildbot.test.unit.test_status_buildindex import makeBuild
+
+class TestBuildSummaries(unittest.TestCase):
+
+    def setUp(self):
+        self.bs = builder.BuilderStatus(buildername='bldr')
+        self.bs.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.bs.basedir)
+        self.bs.determineNextBuildNumber()
+
+        # index ten finished builds, alternating branch and result, and
+        # count the builds that are actually loaded
+        self.builds = {}
+        for n in range(10):
+            b = makeBuild(n, branch=['a', 'b'][n % 2],
+                    results=[SUCCESS, FAILURE][n / 5])
+            b.isFinished.return_value = True
+            self.builds[n] = b
+            self.bs.getBuildIndex().add(b)
+        self.bs.nextBuildNumber = 10
+        self.loaded = []
+        def getBuild(number):
+            if number < 0:
+                number += self.bs.nextBuildNumber
+            self.loaded.append(number)
+            return self.builds.get(number)
+        self.bs.getBuild = getBuild
+
+    def test_generateFinishedBuilds_filters_without_loading(self):
+        got = list(self.bs.generateFinishedBuilds(branches=['a'],
+                    results=[SUCCESS], num_builds=2))
+        self.assertEqual([ b.getNumber() for b in got ], [4, 2])
+        self.assertEqual(self.loaded, [4, 2])
+
+    def test_generateFinishedBuilds_finished_before(self):
+        got = list(self.bs.generateFinishedBuilds(finished_before=203))
+        self.assertEqual([ b.getNumber() for b in got ], [2, 1, 0])
+        self.assertEqual(self.loaded, [2, 1, 0])
+
+    def test_getBuildSummary_backfill(self):
+        del self.bs.getBuildIndex().summaries[7]
+        summary = self.bs.getBuildSummary(-3)
+        self.assertEqual(summary['number'], 7)
+        self.assertEqual(self.loaded, [7])
+        self.assertTrue(7 in self.bs.getBuildIndex())
+
+    def test_getBuildSummary_unfinished(self):
+        del self.bs.getBuildIndex().summaries[9]
+        self.builds[9].isFinished.return_value = False
+        self.assertEqual(self.bs.getBuildSummary(-1), None)
+        self.assertFalse(9 in self.bs.getBuildIndex())
+
+    def test_eventGenerator_skips_unmatched(self):
+        for b in self.builds.values():
+            b.getSteps.return_value = []
+        got = list(self.bs.eventGenerator(branches=['b'], minTime=104))
+        self.assertEqual([ b.getNumber() for b in got ], [9, 7, 5])
+        self.assertEqual(self.loaded, [9, 7, 5])
+
+    def test_prune_removes_index_entries(self):
+        self.bs.buildHorizon = 4
+        self.bs.logHorizon = 2
+        d = self.bs.prune()
+        self.assertEqual(sorted(self.bs.getBuildIndex().summaries.keys()),
+                         [6, 7, 8, 9])
+        return d
+
+    def test_buildFinished_indexes(self):
+        b = self.builds.pop(9)
+        b.getSteps.return_value = []
+        del self.bs.getBuildIndex().summaries[9]
+        self.bs.currentBuilds = [ b ]
+        self.bs.prune = mock.Mock()
+        self.bs._buildFinished(b)
+        self.assertEqual(self.bs.getBuildIndex().get(9)['revision'], 'rev9')
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.bs = builder.BuilderStatus(buildername='bldr')
+        self.bs.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.bs.basedir)
+        self.bs.determineNextBuildNumber()
+        self.loaded = []
+        def loadBuild(number):
+            if number > 20:
+                raise IndexError("no such build %d" % number)
+            self.loaded.append(number)
+            return makeBuild(number)
+        self.bs._loadBuild = self.bs.buildCache.miss_fn = loadBuild
+
+    def test_setCacheManager(self):
+        caches = cache.CacheManager()
+        caches.load_config({'builds' : 5})
+        self.bs.setCacheManager(caches)
+        self.assertEqual(self.bs.buildCacheSize, 5)
+
+        self.bs.getBuildByNumber(3)
+        self.bs.getBuildByNumber(3)
+        self.assertEqual(self.loaded, [3])
+        metrics = caches.get_metrics()['builds/bldr']
+        self.assertEqual((metrics['hits'], metrics['misses']), (1, 1))
+
+        caches.load_config({'builds' : 2})
+        self.assertEqual(self.bs.buildCache.max_size, 2)
+
+    def test_lru(self):
+        caches = cache.CacheManager()
+        caches.load_config({'builds' : 3})
+        self.bs.setCacheManager(caches)
+        for n in [1, 2, 3, 1, 4, 5, 1]:
+            self.bs.getBuildByNumber(n)
+        self.assertEqual(sorted(self.bs.buildCache.cache.keys()), [1, 4, 5])
+        self.assertEqual(self.loaded, [1, 2, 3, 4, 5])
+
+    def test_getBuild_missing(self):
+        self.bs.nextBuildNumber = 30
+        self.assertEqual(self.bs.getBuild(25), None)
+
+    def test_buildStarted_cached(self):
+        b = makeBuild(7)
+        b.number = 7
+        b.builder = self.bs
+        self.bs.buildStarted(b)
+        self.assertIdentical(self.bs.getBuildByNumber(7), b)
+        self.assertEqual(self.loaded, [])
+        # a new build is not a cache miss
+        self.assertEqual((self.bs.buildCache.hits, self.bs.buildCache.misses),
+                         (1, 0))
+
+class TestGetBuildAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.bs = builder.BuilderStatus(buildername='bldr')
+        self.bs.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.bs.basedir)
+        self.bs.determineNextBuildNumber()
+        self.bs.nextBuildNumber = 10
+        self.loaded = []
+        def loadBuild(number):
+            # called in a thread
+            self.loaded.append(number)
+            if number == 5:
+                raise IndexError("no such build %d" % number)
+            return makeBuild(number)
+        self.bs._loadBuild = loadBuild
+
+    def test_load_in_thread(self):
+        d = self.bs.getBuildByNumberAsync(3)
+        def check(b):
+            self.assertEqual(b.getNumber(), 3)
+            self.assertEqual(self.loaded, [3])
+            self.assertTrue(self.bs.buildCache.contains(3))
+            # subsequent loads come from the cache
+            return self.bs.getBuildByNumberAsync(3).addCallback(
+                    lambda b2 : self.assertIdentical(b2, b))
+        d.addCallback(check)
+        d.addCallback(lambda _ : self.assertEqual(self.loaded, [3]))
+        return d
+
+    def test_concurrent_loads_coalesced(self):
+        d = defer.gatherResults([ self.bs.getBuildByNumberAsync(3)
+                                  for i in range(3) ])
+        def check(builds):
+            self.assertEqual(self.loaded, [3])
+            self.assertIdentical(builds[0], builds[1])
+            self.assertIdentical(builds[0], builds[2])
+            self.assertEqual(self.bs.pendingBuildLoads, {})
+        d.addCallback(check)
+        return d
+
+    def test_sync_load_wins(self):
+        d = self.bs.getBuildByNumberAsync(3)
+        b = makeBuild(3)
+        self.bs.buildCache.add(3, b)
+        d.addCallback(lambda b2 : self.assertIdentical(b2, b))
+        return d
+
+    def test_missing(self):
+        d = self.bs.getBuildByNumberAsync(5)
+        self.assertFailure(d, IndexError)
+        d.addCallback(lambda _ : self.bs.getBuildAsync(5))
+        d.addCallback(self.assertEqual, None)
+        d.addCallback(lambda _ : self.bs.getBuildAsync(12))
+        d.addCallback(self.assertEqual, None)
+        return d
+
+    def test_getBuildAsync_negative(self):
+        d = self.bs.getBuildAsync(-1)
+        d.addCallback(lambda b : self.assertEqual(b.getNumber(), 9))
+        return d
+
+class TestPrune(unittest.TestCase):
+
+    def setUp(self):
+        self.bs = builder.BuilderStatus(buildername='bldr')
+        self.bs.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(self.bs.basedir)
+        self.bs.buildHorizon = 4
+        self.bs.logHorizon = 2
+
+    def makeFiles(self, numbers):
+        for n in numbers:
+            for filename in [ "%d" % n, "%d-log-compile-stdio" % n,
+                              "%d-log-compile-stdio.blocks" % n,
+                              "%d-log-test-stdio.bz2" % n ]:
+                open(os.path.join(self.bs.basedir, filename), "w").close()
+        self.bs.nextBuildNumber = max(numbers) + 1
+
+    def assertFiles(self, expected):
+        self.assertEqual(sorted(os.listdir(self.bs.basedir)), sorted(expected))
+
+    def test_startup_scan(self):
+        self.makeFiles(range(10))
+        self.bs.buildCache.add(1, makeBuild(1))
+        d = self.bs.prune()
+        def check(_):
+            self.assertFiles([ '1', '1-log-compile-stdio',
+                               '1-log-compile-stdio.blocks',
+                               '1-log-test-stdio.bz2',
+                               '6', '7', '8', '8-log-compile-stdio',
+                               '8-log-compile-stdio.blocks',
+                               '8-log-test-stdio.bz2', '9',
+                               '9-log-compile-stdio',
+                               '9-log-compile-stdio.blocks',
+                               '9-log-test-stdio.bz2'])
+            self.assertEqual(self.bs.prunedBelow, 6)
+            self.assertEqual(self.bs.pruneSkipped, set([1]))
+        d.addCallback(check)
+        return d
+
+    def test_incremental(self):
+        self.makeFiles(range(10))
+        scans = []
+        scan = self.bs._scanBuildFiles
+        def countScans():
+            scans.append(1)
+            return scan()
+        self.bs._scanBuildFiles = countScans
+
+        d = self.bs.prune()
+        def finishBuild(_):
+            # the build's logs are recorded when it finishes
+            self.makeFiles([10])
+            log = mock.Mock()
+            log.filename = '10-log-compile-stdio'
+            step = mock.Mock()
+            step.getLogs.return_value = [ log ]
+            b = makeBuild(10)
+            b.getSteps.return_value = [ step ]
+            self.bs.currentBuilds = [ b ]
+            self.bs.buildIndex = buildindex.BuildIndex(None)
+            self.bs._buildFinished(b)
+            # pretend three more builds have finished, without files
+            self.bs.nextBuildNumber = 14
+            return self.bs.prune()
+        d.addCallback(finishBuild)
+        def check(_):
+            self.assertEqual(scans, [1])
+            self.assertFiles([ '10', '10-log-test-stdio.bz2' ])
+            self.assertEqual(self.bs.prunedBelow, 10)
+            self.assertEqual(self.bs.logFiles, {})
+        d.addCallback(check)
+        return d
+
+    def test_no_buildHorizon(self):
+        self.makeFiles(range(10))
+        self.bs.buildHorizon = None
+        self.bs.prunedBelow = 3
+        d = self.bs.prune()
+        def check(_):
+            self.assertEqual(len(os.listdir(self.bs.basedir)), 40)
+            self.assertEqual(self.bs.prunedBelow, None)
+        d.addCallback(check)
+        return d
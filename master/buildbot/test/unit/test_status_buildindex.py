@@ -0,0 +1,106 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from buildbot.status import buildindex
+from buildbot.test.util import dirs
+
+def makeBuild(number, branch='br', results=0, slavename='sl'):
+    b = mock.Mock()
+    b.getNumber.return_value = number
+    b.getTimes.return_value = (100 + number, 200 + number)
+    b.getResults.return_value = results
+    b.getSlavename.return_value = slavename
+    b.getResponsibleUsers.return_value = [ 'dustin' ]
+    ch = mock.Mock()
+    ch.who = 'dustin'
+    b.getChanges.return_value = [ ch ]
+    ss = b.getSourceStamp.return_value
+    ss.branch = branch
+    ss.revision = 'rev%d' % number
+    return b
+
+class TestBuildIndex(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpDirs('bldr')
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def test_summarizeBuild(self):
+        self.assertEqual(buildindex.summarizeBuild(makeBuild(3)),
+            dict(number=3, start=103, end=203, results=0, branch='br',
+                 revision='rev3', slavename='sl', blamelist=['dustin'],
+                 committers=['dustin']))
+
+    def test_add_persists(self):
+        idx = buildindex.BuildIndex('bldr')
+        idx.add(makeBuild(1))
+        idx.add(makeBuild(2, branch='other'))
+        self.assertTrue(os.path.exists(os.path.join('bldr', 'buildindex')))
+
+        idx = buildindex.BuildIndex('bldr')
+        self.assertEqual(sorted(idx.summaries.keys()), [1, 2])
+        self.assertEqual(idx.get(2)['branch'], 'other')
+        self.assertEqual(idx.get(3), None)
+
+    def test_add_replace(self):
+        idx = buildindex.BuildIndex('bldr')
+        idx.add(makeBuild(1))
+        idx.add(makeBuild(1, results=2))
+        idx = buildindex.BuildIndex('bldr')
+        self.assertEqual(idx.get(1)['results'], 2)
+        self.assertEqual(idx.garbage, 1)
+
+    def test_remove_and_compact(self):
+        idx = buildindex.BuildIndex('bldr')
+        for n in range(10):
+            idx.add(makeBuild(n))
+        idx.remove([0, 1, 99])
+        self.assertEqual(idx.garbage, 4)
+        idx = buildindex.BuildIndex('bldr')
+        self.assertEqual(sorted(idx.summaries.keys()), range(2, 10))
+        self.assertEqual(idx.garbage, 4)
+
+        # removing more than half compacts the file
+        idx.remove(range(2, 7))
+        self.assertEqual(idx.garbage, 0)
+        idx = buildindex.BuildIndex('bldr')
+        self.assertEqual(sorted(idx.summaries.keys()), [7, 8, 9])
+        self.assertEqual(idx.garbage, 0)
+
+    def test_damaged(self):
+        idx = buildindex.BuildIndex('bldr')
+        idx.add(makeBuild(1))
+        idx.add(makeBuild(2))
+        path = os.path.join('bldr', 'buildindex')
+        data = open(path, 'rb').read()
+        open(path, 'wb').write(data[:-5])
+
+        idx = buildindex.BuildIndex('bldr')
+        self.assertEqual(sorted(idx.summaries.keys()), [1])
+        # the damaged record has been dropped from the file
+        idx.add(makeBuild(3))
+        idx = buildindex.BuildIndex('bldr')
+        self.assertEqual(sorted(idx.summaries.keys()), [1, 3])
+
+    def test_no_basedir(self):
+        idx = buildindex.BuildIndex(None)
+        idx.add(makeBuild(1))
+        idx.remove([1])
+        self.assertEqual(len(idx), 0)
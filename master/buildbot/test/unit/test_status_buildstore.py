@@ -0,0 +1,211 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import types
+import threading
+import zlib
+import cPickle
+from twisted.trial import unittest
+from twisted.persisted import styles
+from buildbot.status import buildstore, builder
+from buildbot.sourcestamp import SourceStamp
+from buildbot.test.util import dirs
+
+class Upgradable(styles.Versioned):
+    persistenceVersion = 1
+
+    def upgradeToVersion1(self):
+        self.wasUpgraded = True
+
+def unpickleOldUpgradable():
+    # what unpickling an Upgradable saved at version 0 does
+    obj = types.InstanceType(Upgradable)
+    obj.__setstate__({})
+    return obj
+
+class TestUpgradeLoaded(unittest.TestCase):
+
+    def test_per_thread(self):
+        unpickled = threading.Event()
+        upgrade = threading.Event()
+        result = []
+        def load():
+            buildstore.beginLoad()
+            obj = unpickleOldUpgradable()
+            unpickled.set()
+            upgrade.wait()
+            result.append((obj, buildstore.upgradeLoaded()))
+        t = threading.Thread(target=load)
+        t.start()
+
+        # upgrading this thread's objects leaves the other thread's alone
+        buildstore.beginLoad()
+        mine = unpickleOldUpgradable()
+        unpickled.wait()
+        self.assertEqual(buildstore.upgradeLoaded(), [ mine ])
+        self.assertTrue(mine.wasUpgraded)
+        upgrade.set()
+        t.join()
+        obj, upgraded = result[0]
+        self.assertEqual(upgraded, [ obj ])
+        self.assertTrue(obj.wasUpgraded)
+        self.assertNotIn(id(obj), styles.versionedsToUpgrade)
+
+    def test_beginLoad_forgets_failed_load(self):
+        buildstore.beginLoad()
+        unpickleOldUpgradable()
+        buildstore.beginLoad()
+        self.assertEqual(buildstore.upgradeLoaded(), [])
+
+class TestBuildStore(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpDirs('bldr')
+        self.bs = builder.BuilderStatus(buildername='bldr')
+        self.bs.basedir = 'bldr'
+        self.bs.master = None
+        self.bs.nextBuildNumber = 0
+        self.bs.setBuildStatusFormat('records')
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def makeBuild(self):
+        b = self.bs.newBuild()
+        b.setSourceStamp(SourceStamp(branch='br', revision='12'))
+        b.setReason('because')
+        b.setSlavename('sl')
+        b.setProperty('prop', 'value', 'test')
+        b.started = 100
+        for name in 'compile', 'test':
+            s = b.addStepWithName(name)
+            s.started = 100
+            s.setText([ name ])
+            s.setText2([ name + 'd' ])
+            s.stepFinished(0)
+        b.setText([ 'build', 'successful' ])
+        b.setResults(0)
+        b.finished = 200
+        b.saveYourself()
+        return b
+
+    def test_save_records(self):
+        self.makeBuild()
+        f = open(os.path.join('bldr', '0'), 'rb')
+        self.assertEqual(f.read(len(buildstore.MAGIC)), buildstore.MAGIC)
+        f.close()
+
+    def test_save_records_compressed(self):
+        self.makeBuild()
+        f = open(os.path.join('bldr', '0'), 'rb')
+        buildstore._readHeader(f)
+        hdr = f.read(buildstore._length.size)
+        length, = buildstore._length.unpack(hdr)
+        steps = cPickle.loads(zlib.decompress(f.read(length)))
+        f.close()
+        self.assertEqual([ s.getName() for s in steps ], [ 'compile', 'test' ])
+
+    def test_load_without_lock(self):
+        self.makeBuild()
+        # the lock is free for other threads while the build is unpickled
+        free = []
+        class CheckingPickle(object):
+            def __getattr__(self, name):
+                return getattr(cPickle, name)
+            def loads(self, data):
+                def check():
+                    free.append(buildstore.load_lock.acquire(False))
+                    if free[-1]:
+                        buildstore.load_lock.release()
+                t = threading.Thread(target=check)
+                t.start()
+                t.join()
+                return cPickle.loads(data)
+        self.patch(buildstore, 'pickle', CheckingPickle())
+        b = self.bs._loadBuild(0)
+        self.assertEqual(len(b.getSteps()), 2)
+        self.assertEqual(free, [ True ] * 3)
+
+    def test_load_lazy_steps(self):
+        self.makeBuild()
+        b = self.bs._loadBuild(0)
+        self.assertIdentical(b.builder, self.bs)
+        self.assertEqual(b.getReason(), 'because')
+        self.assertEqual(b.getSourceStamp().revision, '12')
+        self.assertEqual(b.getProperty('prop'), 'value')
+        self.assertEqual(b.getText(),
+                [ 'build', 'successful', 'compiled', 'testd' ])
+        # getText does not need the steps
+        self.assertEqual(b.steps, None)
+        steps = b.getSteps()
+        self.assertEqual([ s.getName() for s in steps ], [ 'compile', 'test' ])
+        self.assertIdentical(steps[0].getBuild(), b)
+        self.assertEqual(b.lazySteps, None)
+
+    def test_resave_lazy(self):
+        self.makeBuild()
+        b = self.bs._loadBuild(0)
+        b.saveYourself()
+        b = self.bs._loadBuild(0)
+        self.assertEqual(len(b.getSteps()), 2)
+
+    def test_damaged(self):
+        self.makeBuild()
+        filename = os.path.join('bldr', '0')
+        data = open(filename, 'rb').read()
+        open(filename, 'wb').write(data[:len(buildstore.MAGIC) + 10])
+        self.assertRaises(IndexError, lambda : self.bs._loadBuild(0))
+
+    def test_unknown_version(self):
+        self.makeBuild()
+        filename = os.path.join('bldr', '0')
+        data = open(filename, 'rb').read()
+        version = buildstore._length.pack(buildstore.RECORDS_VERSION + 1)
+        data = data[len(buildstore.MAGIC) + len(version):]
+        open(filename, 'wb').write(buildstore.MAGIC + version + data)
+        self.assertRaises(IndexError, lambda : self.bs._loadBuild(0))
+
+    def test_pruneSteps_lazy(self):
+        self.makeBuild()
+        b = self.bs._loadBuild(0)
+        b.pruneSteps()
+        self.assertEqual(b.getSteps(), [])
+
+    def test_damaged_steps(self):
+        self.makeBuild()
+        filename = os.path.join('bldr', '0')
+        data = open(filename, 'rb').read()
+        open(filename, 'wb').write(data[:-10])
+        b = self.bs._loadBuild(0)
+        self.assertEqual(b.getSteps(), [])
+        self.flushLoggedErrors(EOFError)
+
+    def test_convertBuild(self):
+        self.makeBuild()
+        filename = os.path.join('bldr', '0')
+        self.assertFalse(buildstore.convertBuild(filename, 'records'))
+        self.assertTrue(buildstore.convertBuild(filename, 'pickle'))
+        self.assertNotEqual(open(filename, 'rb').read(len(buildstore.MAGIC)),
+                            buildstore.MAGIC)
+        b = self.bs._loadBuild(0)
+        self.assertEqual(b.lazySteps, None)
+        self.assertEqual(len(b.getSteps()), 2)
+
+        self.assertTrue(buildstore.convertBuild(filename, 'records'))
+        b = self.bs._loadBuild(0)
+        self.assertEqual(b.getText(),
+                [ 'build', 'successful', 'compiled', 'testd' ])
+        self.assertEqual(len(b.getSteps()), 2)
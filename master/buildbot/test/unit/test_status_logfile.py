@@ -14,6 +14,8 @@
 # Copyright Buildbot Team Members
 
 import os
+import bz2
+import gzip
 import cStringIO, cPickle
 import mock
 from twisted.trial import unittest
@@ -325,3 +327,164 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         self.logfile.compressMethod = None
         return self.do_test_compressLog('', expect_comp=False)
 
+
+    def add_lines(self):
+        self.logfile.chunkSize = 10
+        for i in range(20):
+            self.logfile.addEntry(2, 'h%d\n' % i)
+            self.logfile.addEntry(0, 'line %02d\n' % i)
+        self.logfile.addEntry(1, 'err\n')
+
+    def check_ranges(self):
+        lf = self.logfile
+        text = lf.getText()
+        for start, end in [ (0, 5), (5, 30), (37, 38), (150, None),
+                            (None, 12), (180, 200) ]:
+            self.assertEqual(
+                    ''.join(lf.getChunks([0, 1], onlyText=True,
+                                         start=start, end=end)),
+                    text[start or 0:end])
+        stdout = ''.join(lf.getChunks([0], onlyText=True))
+        self.assertEqual(
+                ''.join(lf.getChunks([0], onlyText=True, start=45, end=63)),
+                stdout[45:63])
+        self.assertEqual(lf.getLength([0, 1]), len(text))
+        self.assertEqual(lf.getLength(), len(lf.getTextWithHeaders()))
+        self.assertEqual(lf.getLineCount([0, 1]), 21)
+        self.assertEqual(lf.getLineCount(), 41)
+        self.assertEqual(lf.getLinePosition(0, [0, 1]), 0)
+        self.assertEqual(lf.getLinePosition(7, [0, 1]), 7 * 8)
+        self.assertEqual(lf.getLinePosition(20, [0, 1]), 160)
+        self.assertEqual(lf.getLinePosition(21, [0, 1]), 164)
+        self.assertEqual(lf.getLinePosition(50, [0, 1]), 164)
+        self.assertEqual(lf.getLinePosition(3), 3 + 8 + 3)
+
+    def test_ranges_live(self):
+        self.add_lines()
+        # the stderr line has not been merged into the file yet
+        self.assertTrue(self.logfile.runEntries)
+        self.check_ranges()
+
+    def test_ranges_finished(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.pickle_and_restore()
+        self.assertEqual(self.logfile.index, None)
+        self.check_ranges()
+        self.assertTrue(self.logfile.getIndex().complete)
+
+    def test_ranges_compressed(self):
+        self.add_lines()
+        self.logfile.finish()
+        d = self.logfile.compressLog()
+        def check(_):
+            self.pickle_and_restore()
+            self.check_ranges()
+        d.addCallback(check)
+        return d
+
+    def test_ranges_compressed_blocks(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.logfile.compressMethod = 'gz'
+        self.logfile.compressBlockSize = 50
+        d = self.logfile.compressLog()
+        def check(_):
+            self.pickle_and_restore()
+            f = self.logfile.getFile()
+            self.assertTrue(isinstance(f, logfile.BlockCompressedFile))
+            self.assertTrue(len(f.offsets) > 3)
+            self.check_ranges()
+
+            # the blocks together form an ordinary gzip file
+            gz = gzip.GzipFile(self.logfile.getFilename() + '.gz')
+            text = gz.read()
+            f.seek(0)
+            self.assertEqual(f.read(), text)
+
+            # seeking only decompresses the block containing the position
+            loaded = []
+            loadBlock = f._loadBlock
+            def countLoads(i):
+                loaded.append(i)
+                loadBlock(i)
+            f._loadBlock = countLoads
+            f.seek(120)
+            self.assertEqual(f.read(20), text[120:140])
+            self.assertEqual(loaded, [ 2 ])
+        d.addCallback(check)
+        return d
+
+    def do_test_ranges_compressed_without_blocks(self, method):
+        # without the table of blocks, a log is read from the start, through
+        # all of its blocks
+        self.add_lines()
+        self.logfile.finish()
+        length = os.path.getsize(self.logfile.getFilename())
+        self.logfile.compressMethod = method
+        self.logfile.compressBlockSize = 50
+        d = self.logfile.compressLog()
+        def check(_):
+            self.pickle_and_restore()
+            os.unlink(self.logfile.getFilename() + '.blocks')
+            f = self.logfile.getFile()
+            self.assertFalse(isinstance(f, logfile.BlockCompressedFile))
+            self.assertEqual(len(f.read()), length)
+            self.assertEqual(f.tell(), length)
+            self.check_ranges()
+        d.addCallback(check)
+        return d
+
+    def test_ranges_compressed_without_blocks_bz2(self):
+        return self.do_test_ranges_compressed_without_blocks('bz2')
+
+    def test_ranges_compressed_without_blocks_gz(self):
+        return self.do_test_ranges_compressed_without_blocks('gz')
+
+    def test_ranges_compressed_single_stream(self):
+        # logs compressed before blocks were used are a single stream
+        self.add_lines()
+        self.logfile.finish()
+        filename = self.logfile.getFilename()
+        text = open(filename).read()
+        cf = bz2.BZ2File(filename + '.bz2', 'w')
+        cf.write(text)
+        cf.close()
+        os.unlink(filename)
+        self.pickle_and_restore()
+        f = self.logfile.getFile()
+        f.seek(100)
+        self.assertEqual(f.read(), text[100:])
+        f.seek(10)
+        self.assertEqual(f.read(5), text[10:15])
+        self.check_ranges()
+
+    def test_ranges_without_index(self):
+        self.add_lines()
+        self.logfile.finish()
+        index = self.logfile.getIndex()
+        self.pickle_and_restore()
+        # truncate the index file, so the log is scanned instead
+        filename = self.logfile.getFilename() + '.idx'
+        data = open(filename, 'rb').read()
+        open(filename, 'wb').write(data[:-10])
+        self.assertEqual(self.logfile.getIndex().counts, index.counts)
+        self.assertEqual(self.logfile.getIndex().offsets, index.offsets)
+        self.check_ranges()
+
+    def test_readlines(self):
+        self.logfile.chunkSize = 4
+        self.logfile.addEntry(0, 'first line\nsec')
+        self.logfile.addEntry(2, 'header\n')
+        self.logfile.addEntry(0, 'ond line\n\nlast')
+        self.logfile.addEntry(1, 'err\n')
+        self.logfile.finish()
+        lines = self.logfile.readlines()
+        self.assertFalse(isinstance(lines, list))
+        self.assertEqual(list(lines),
+                [ 'first line\n', 'second line\n', '\n', 'last' ])
+        self.assertEqual(list(self.logfile.readlines(logfile.STDERR)),
+                [ 'err\n' ])
+        self.assertEqual(
+                list(self.logfile.readlines(channels=[0, 1])),
+                [ 'first line\n', 'second line\n', '\n', 'lasterr\n' ])
@@ -19,7 +19,7 @@ from twisted.trial import unittest
 from buildbot.test.util import dirs
 
 from buildbot.status.persistent_queue import MemoryQueue, DiskQueue, \
-    IQueue, PersistentQueue, WriteFile
+    IQueue, PersistentQueue, SegmentedDiskQueue, WriteFile
 
 class test_Queues(dirs.DirsMixin, unittest.TestCase):
 
@@ -144,4 +144,52 @@ class test_Queues(dirs.DirsMixin, unittest.TestCase):
         self._test_helper(PersistentQueue(MemoryQueue(3),
                                           DiskQueue('fake_dir', 5)))
 
+    def testSegmentedDiskQueue(self):
+        self._test_helper(SegmentedDiskQueue('fake_dir', maxItems=8,
+                                             segmentItems=3))
+
+    def testPersistentSegmentedQueue(self):
+        self._test_helper(PersistentQueue(MemoryQueue(3),
+                SegmentedDiskQueue('fake_dir', 5, segmentItems=2)))
+
+    def testSegmentedReload(self):
+        q = SegmentedDiskQueue('fake_dir', 10, segmentItems=3)
+        for i in range(7):
+            q.pushItem(i)
+        self.assertEqual([0, 1, 2, 3], q.popChunk(4))
+        self.assertEqual(None, q.insertBackChunk([2, 3]))
+        self.assertEqual(sorted(os.listdir('fake_dir')),
+                ['checkpoint', 'segment-0', 'segment-1', 'segment-2'])
+
+        q = SegmentedDiskQueue('fake_dir', 10, segmentItems=3)
+        self.assertEqual(5, q.nbItems())
+        self.assertEqual([2, 3, 4, 5, 6], q.items())
+        self.assertEqual(None, q.pushItem(7))
+        self.assertEqual([2, 3, 4, 5, 6, 7], q.popChunk(6))
+        self.assertEqual([], os.listdir('fake_dir'))
+
+    def testSegmentedPartialWrite(self):
+        q = SegmentedDiskQueue('fake_dir', 10, pickleFn=str, unpickleFn=str)
+        q.pushItem('foo')
+        q.pushItem('bar')
+        f = open(os.path.join('fake_dir', 'segment-0'), 'ab')
+        f.write('\x00\x00\x00\x10ba')
+        f.close()
+        q = SegmentedDiskQueue('fake_dir', 10, pickleFn=str, unpickleFn=str)
+        self.assertEqual(['foo', 'bar'], q.items())
+        q.pushItem('baz')
+        self.assertEqual(['foo', 'bar', 'baz'], q.popChunk())
+
+    def testSegmentedMigration(self):
+        # items queued by DiskQueue are picked up in order
+        WriteFile(os.path.join('fake_dir', '3'), 'foo3')
+        WriteFile(os.path.join('fake_dir', '5'), 'foo5')
+        WriteFile(os.path.join('fake_dir', '8'), 'foo8')
+        q = SegmentedDiskQueue('fake_dir', 5, pickleFn=str, unpickleFn=str)
+        self.assertEqual(sorted(os.listdir('fake_dir')),
+                ['checkpoint', 'segment-0'])
+        self.assertEqual(['foo3', 'foo5', 'foo8'], q.items())
+        q.pushItem('foo9')
+        self.assertEqual(['foo3', 'foo5', 'foo8', 'foo9'], q.popChunk())
+
 # vim: set ts=4 sts=4 sw=4 et:
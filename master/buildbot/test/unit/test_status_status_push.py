@@ -0,0 +1,248 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import gzip
+import urlparse
+import mock
+from cStringIO import StringIO
+from twisted.trial import unittest
+from twisted.internet import defer, error
+from twisted.python import failure
+from twisted.web import client, http
+from twisted.web import error as web_error
+from buildbot.status.status_push import HttpStatusPush
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+class TestHttpStatusPush(unittest.TestCase):
+
+    def makePush(self, **kwargs):
+        sp = HttpStatusPush('http://example.com/push', maxDiskItems=0,
+                            **kwargs)
+        sp.status = mock.Mock()
+        sp.status.getTitle.return_value = 'proj'
+        sp.status.asDict.return_value = {}
+        # pushes are triggered explicitly by the tests
+        sp.queueNextServerPush = lambda : None
+        self.posted = []
+        self.results = []
+        def postData(data):
+            self.posted.append(data)
+            d = defer.Deferred()
+            self.results.append(d)
+            return d
+        sp.postData = postData
+        return sp
+
+    def makeStep(self, buildNumber, name):
+        build = mock.Mock()
+        build.getBuilder.return_value.getName.return_value = 'bldr'
+        build.getNumber.return_value = buildNumber
+        build.asDict.return_value = dict(number=buildNumber)
+        step = mock.Mock()
+        step.getBuild.return_value = build
+        step.getName.return_value = name
+        step.asDict.return_value = dict(name=name)
+        return build, step
+
+    def decode(self, data):
+        return json.loads(urlparse.parse_qs(data)['packets'][0])
+
+    def test_coalesce(self):
+        sp = self.makePush(coalesce=True)
+        build, compile = self.makeStep(3, 'compile')
+        build, test = self.makeStep(3, 'test')
+        sp.push('stepStarted', build=build, step=compile)
+        sp.push('stepETAUpdate', build=build, step=compile, ETA=10)
+        sp.push('stepETAUpdate', build=build, step=test, ETA=20)
+        sp.push('stepETAUpdate', build=build, step=compile, ETA=5)
+        # held back until the next push
+        self.assertEqual(sp.queue.nbItems(), 1)
+        sp.serverPushCb()
+        packets = self.decode(self.posted[0])
+        self.assertEqual([ (p['id'], p['event'], p['payload'].get('ETA'))
+                           for p in packets ],
+                         [ (1, 'stepStarted', None), (2, 'stepETAUpdate', 5),
+                           (3, 'stepETAUpdate', 20) ])
+
+    def test_coalesce_flushed_by_other_events(self):
+        sp = self.makePush(coalesce=True)
+        build, step = self.makeStep(3, 'compile')
+        sp.push('stepETAUpdate', build=build, step=step, ETA=10)
+        sp.push('stepFinished', build=build, step=step)
+        sp.push('stepETAUpdate', build=build, step=step, ETA=5)
+        sp.serverPushCb()
+        packets = self.decode(self.posted[0])
+        self.assertEqual([ p['event'] for p in packets ],
+                [ 'stepETAUpdate', 'stepFinished', 'stepETAUpdate' ])
+
+    def test_no_coalesce(self):
+        sp = self.makePush()
+        build, step = self.makeStep(3, 'compile')
+        sp.push('stepETAUpdate', build=build, step=step, ETA=10)
+        sp.push('stepETAUpdate', build=build, step=step, ETA=5)
+        self.assertEqual(sp.queue.nbItems(), 2)
+
+    def test_compress(self):
+        sp = self.makePush(compress=True)
+        sp.push('start', status=sp.status)
+        sp.serverPushCb()
+        data = gzip.GzipFile(fileobj=StringIO(self.posted[0])).read()
+        self.assertEqual(self.decode(data)[0]['event'], 'start')
+
+    def test_concurrent_chunks(self):
+        sp = self.makePush(chunkSize=2, maxInFlight=3)
+        for i in range(5):
+            sp.push('start', status=sp.status)
+        d = sp.serverPushCb()
+        self.assertEqual([ [ p['id'] for p in self.decode(data) ]
+                           for data in self.posted ],
+                         [ [1, 2], [3, 4], [5] ])
+        self.results[2].callback(None)
+        self.results[0].errback(RuntimeError('down'))
+        self.results[1].errback(RuntimeError('down'))
+        def check(_):
+            self.assertFalse(sp.wasLastPushSuccessful())
+            self.assertEqual([ p['id'] for p in sp.queue.items() ],
+                             [ 1, 2, 3, 4 ])
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 0)
+        d.addCallback(check)
+        return d
+
+    def test_retry_sends_one_item(self):
+        sp = self.makePush(chunkSize=2, maxInFlight=3)
+        sp.lastPushWasSuccessful = False
+        for i in range(5):
+            sp.push('start', status=sp.status)
+        sp.serverPushCb()
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(len(self.decode(self.posted[0])), 1)
+
+
+class FakeResponse(object):
+
+    def __init__(self, code, phrase, body, reason):
+        self.code = code
+        self.phrase = phrase
+        self.body = body
+        self.reason = reason
+        self.delivered = False
+
+    def deliverBody(self, protocol):
+        self.delivered = True
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(self.reason))
+
+class FakeAgent(object):
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        self.requests.append((method, uri, headers, bodyProducer))
+        return defer.succeed(self.responses.pop(0))
+
+class TestHttpStatusPushAgent(unittest.TestCase):
+
+    def makePush(self, **kwargs):
+        sp = HttpStatusPush('http://example.com/push', maxDiskItems=0,
+                            **kwargs)
+        sp.status = mock.Mock()
+        sp.status.getTitle.return_value = 'proj'
+        sp.status.asDict.return_value = {}
+        sp.queueNextServerPush = lambda : None
+        sp.agent = self.agent = FakeAgent()
+        return sp
+
+    def addResponse(self, code, phrase='OK', reason=None):
+        if reason is None:
+            reason = client.ResponseDone()
+        response = FakeResponse(code, phrase, 'body', reason)
+        self.agent.responses.append(response)
+        return response
+
+    def test_persistent_pool(self):
+        pool = mock.Mock()
+        patch_pool = mock.patch.object(client, 'HTTPConnectionPool',
+                                       create=True)
+        patch_agent = mock.patch.object(client, 'Agent')
+        HTTPConnectionPool = patch_pool.start()
+        self.addCleanup(patch_pool.stop)
+        Agent = patch_agent.start()
+        self.addCleanup(patch_agent.stop)
+        HTTPConnectionPool.return_value = pool
+
+        sp = HttpStatusPush('http://example.com/push', maxDiskItems=0,
+                            maxInFlight=3, persistent=True)
+        self.assertEqual(HTTPConnectionPool.call_args[1],
+                         dict(persistent=True))
+        self.assertEqual(pool.maxPersistentPerHost, 3)
+        self.assertEqual(Agent.call_args[1], dict(pool=pool))
+        self.assertIdentical(sp.agent, Agent.return_value)
+
+    def test_postData(self):
+        sp = self.makePush(compress=True)
+        response = self.addResponse(200)
+        d = sp.postData('data')
+        def check(_):
+            (method, uri, headers, body), = self.agent.requests
+            self.assertEqual((method, uri), ('POST', 'http://example.com/push'))
+            self.assertEqual(sorted(headers.getAllRawHeaders()), [
+                ('Content-Encoding', ['gzip']),
+                ('Content-Type', ['application/x-www-form-urlencoded']),
+                ('User-Agent', ['buildbot']) ])
+            self.assertEqual(body.length, len('data'))
+            # the body is read, so that the connection can be reused
+            self.assertTrue(response.delivered)
+        d.addCallback(check)
+        return d
+
+    def test_postData_potential_data_loss(self):
+        sp = self.makePush()
+        self.addResponse(200, reason=http.PotentialDataLoss())
+        return sp.postData('data')
+
+    def test_postData_error_code(self):
+        sp = self.makePush()
+        self.addResponse(500, 'Internal Server Error')
+        d = sp.postData('data')
+        def check(f):
+            f.trap(web_error.Error)
+            self.assertEqual((f.value.status, f.value.message),
+                             ('500', 'Internal Server Error'))
+        d.addCallbacks(lambda _ : self.fail("should have failed"), check)
+        return d
+
+    def test_postData_body_lost(self):
+        sp = self.makePush()
+        self.addResponse(200, reason=error.ConnectionLost())
+        d = sp.postData('data')
+        return self.assertFailure(d, error.ConnectionLost)
+
+    def test_push_requeued_on_error_code(self):
+        sp = self.makePush()
+        sp.push('start', status=sp.status)
+        self.addResponse(503, 'Service Unavailable')
+        d = sp.serverPushCb()
+        def check(_):
+            self.assertFalse(sp.wasLastPushSuccessful())
+            self.assertEqual(sp.queue.nbItems(), 1)
+        d.addCallback(check)
+        return d
@@ -0,0 +1,162 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from twisted.web import server
+from buildbot.status import logfile
+from buildbot.status.web import logs, base
+from buildbot.test.util import dirs
+from buildbot.util import eventual
+
+class FakeRequest:
+
+    def __init__(self, args={}, headers={}):
+        self.args = args
+        self.headers = headers
+        self.responseHeaders = {}
+        self.code = 200
+        self.written = ''
+        self.finished = False
+        self.prepath = [ 'builders', 'b', 'builds', '1', 'steps', 's',
+                         'logs', 'stdio' ]
+        self.site = mock.Mock()
+        self.site.buildbot_service.templates = base.createJinjaEnv()
+
+    def getHeader(self, name):
+        return self.headers.get(name)
+
+    def setHeader(self, name, value):
+        self.responseHeaders[name] = value
+
+    def setResponseCode(self, code):
+        self.code = code
+
+    def childLink(self, name):
+        return name
+
+    def write(self, data):
+        self.written += data
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if not streaming:
+            # a pull producer, ask for data until it is done
+            while self.producer:
+                producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def finish(self):
+        self.finished = True
+
+class TestTextLog(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        step = mock.Mock(name='build_step_status')
+        basedir = step.build.builder.basedir = os.path.abspath('basedir')
+        self.setUpDirs(basedir)
+        self.log = logfile.LogFile(step, 'stdio', '1-stdio')
+        self.log.chunkSize = 10
+        for i in range(100):
+            self.log.addHeader('header %d\n' % i)
+            self.log.addStdout('line %02d\n' % i)
+        self.log.finish()
+        self.text = self.log.getText()
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def render(self, asText=True, args={}, headers={}):
+        req = FakeRequest(args, headers)
+        rsrc = logs.TextLog(self.log)
+        rsrc.asText = asText
+        res = rsrc.render_GET(req)
+        if res != server.NOT_DONE_YET:
+            req.written = res
+        return req
+
+    def test_text_whole(self):
+        req = self.render()
+        self.assertEqual(req.code, 200)
+        self.assertEqual(req.responseHeaders['accept-ranges'], 'bytes')
+        d = eventual.flushEventualQueue()
+        def check(_):
+            self.assertTrue(req.finished)
+            self.assertEqual(req.written, self.text)
+        d.addCallback(check)
+        return d
+
+    def test_text_range(self):
+        req = self.render(headers={'range' : 'bytes=16-39'})
+        self.assertEqual(req.code, 206)
+        self.assertEqual(req.written, self.text[16:40])
+        self.assertEqual(req.responseHeaders['content-range'],
+                         'bytes 16-39/800')
+        self.assertEqual(req.responseHeaders['content-length'], 24)
+
+    def test_text_range_suffix(self):
+        req = self.render(headers={'range' : 'bytes=-10'})
+        self.assertEqual(req.code, 206)
+        self.assertEqual(req.written, self.text[-10:])
+
+    def test_text_range_open(self):
+        req = self.render(headers={'range' : 'bytes=790-'})
+        self.assertEqual(req.written, self.text[790:])
+        self.assertEqual(req.responseHeaders['content-range'],
+                         'bytes 790-799/800')
+
+    def test_text_range_unsatisfiable(self):
+        req = self.render(headers={'range' : 'bytes=800-'})
+        self.assertEqual(req.code, 416)
+        self.assertEqual(req.responseHeaders['content-range'], 'bytes */800')
+        self.assertEqual(req.written, '')
+
+    def test_text_multiple_ranges(self):
+        req = self.render(headers={'range' : 'bytes=0-1,5-6'})
+        self.assertEqual(req.code, 200)
+        self.assertNotIn('content-range', req.responseHeaders)
+        return eventual.flushEventualQueue()
+
+    def test_text_tail(self):
+        req = self.render(args={'tail' : ['3']})
+        self.assertEqual(req.written, 'line 97\nline 98\nline 99\n')
+
+    def test_text_offset_length(self):
+        req = self.render(args={'offset' : ['8'], 'length' : ['8']})
+        self.assertEqual(req.code, 200)
+        self.assertEqual(req.written, 'line 01\n')
+
+    def test_text_bad_args(self):
+        req = self.render(args={'tail' : ['x']})
+        self.assertEqual(req.code, 400)
+
+    def test_html_paginated(self):
+        self.patch(logs.TextLog, 'pageSize', 100)
+        req = self.render(asText=False)
+        self.assertTrue(req.finished)
+        self.assertIn('Showing bytes 1690 to 1790 of 1790', req.written)
+        self.assertIn('line 99', req.written)
+        self.assertNotIn('line 90', req.written)
+        self.assertIn('?length=100&amp;offset=1590', req.written)
+
+    def test_html_offset(self):
+        self.patch(logs.TextLog, 'pageSize', 100)
+        req = self.render(asText=False, args={'offset' : ['0']})
+        self.assertIn('header 0', req.written)
+        self.assertNotIn('line 06', req.written)
+        self.assertIn('?length=100&amp;offset=100', req.written)
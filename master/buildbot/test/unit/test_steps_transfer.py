@@ -13,8 +13,10 @@
 #
 # Copyright Buildbot Team Members
 
-import tempfile, os
+import tempfile, os, shutil, tarfile, threading
+from cStringIO import StringIO
 from twisted.trial import unittest
+from twisted.internet import defer
 
 from mock import Mock
 
@@ -22,6 +24,8 @@ from buildbot.process.properties import Properties
 from buildbot.util import json
 from buildbot.steps.transfer import StringDownload, JSONStringDownload, JSONPropertiesDownload, \
     FileUpload
+from buildbot.steps import transfer
+from buildbot import util
 
 class TestFileUpload(unittest.TestCase):
     def setUp(self):
@@ -94,6 +98,115 @@ class TestFileUpload(unittest.TestCase):
         self.assertAlmostEquals(timestamp[0],desttimestamp[0],places=5)
         self.assertAlmostEquals(timestamp[1],desttimestamp[1],places=5)
 
+    def testStatistics(self):
+        s = FileUpload(slavesrc=__file__, masterdest=self.destfile,
+                       maxsize=1500)
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.build.getSlaveCommandVersion.return_value = "2.17"
+
+        s.step_status = Mock()
+        s.buildslave = Mock()
+        s.remote = Mock()
+        s.start()
+
+        kwargs = s.remote.callRemote.call_args[0][4]
+        self.assertEqual(kwargs['pipeline'], 4)
+        self.assertEqual(kwargs['maxblocksize'], 256*1024)
+        writer = kwargs['writer']
+        times = [ 10.0, 12.0 ]
+        self.patch(util, 'now', lambda : times.pop(0))
+        writer.remote_write('x' * 1000)
+        writer.remote_write('x' * 1000)
+        writer.remote_close()
+        # maxsize is still enforced
+        self.assertEqual(os.path.getsize(self.destfile), 1500)
+
+        statistics = {}
+        s.step_status.setStatistic = statistics.__setitem__
+        s.cmd.rc = 0
+        s.deferred = Mock()
+        s.finished(None)
+        self.assertEqual(statistics, {'transfer-bytes' : 2000,
+                'transfer-time' : 2.0, 'transfer-rate' : 1000.0})
+
+class TestDirectoryWriter(unittest.TestCase):
+    def setUp(self):
+        self.destdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.destdir)
+
+    def makeArchive(self, compress):
+        f = StringIO()
+        archive = tarfile.open(fileobj=f, mode='w|' + (compress or ''))
+        for name, size in [ ('small', 100), ('big', 200*1024) ]:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            archive.addfile(info, StringIO(name[0] * size))
+        archive.close()
+        return f.getvalue()
+
+    def testStreaming(self, compress=None):
+        self.patch(transfer._DirectoryWriter, 'bufferSize', 10000)
+        writer = transfer._DirectoryWriter(self.destdir, None, compress, 0600)
+        data = self.makeArchive(compress)
+        blocks = [ data[i:i+4096] for i in range(0, len(data), 4096) ]
+        self.waited = False
+
+        # write the blocks one at a time, as the slave would, waiting when
+        # the pipe to the extraction thread is full
+        d = defer.succeed(None)
+        def write(_, block):
+            res = writer.remote_write(block)
+            if res is not None:
+                self.waited = True
+            return res
+        for block in blocks:
+            d.addCallback(write, block)
+        d.addCallback(lambda _ : writer.remote_unpack())
+        def check(_):
+            if not compress:
+                self.assertTrue(self.waited)
+            self.assertEqual(open(os.path.join(self.destdir, 'big')).read(),
+                             'b' * 200*1024)
+            self.assertEqual(open(os.path.join(self.destdir, 'small')).read(),
+                             's' * 100)
+            self.assertEqual(writer.nbytes, len(data))
+        d.addCallback(check)
+        return d
+
+    def testStreamingGz(self):
+        return self.testStreaming('gz')
+
+    def testStreamingBz2(self):
+        return self.testStreaming('bz2')
+
+    def testOwnThread(self):
+        # the extraction does not occupy one of the reactor's pool threads
+        writer = transfer._DirectoryWriter(self.destdir, None, None, 0600)
+        extracting = []
+        extract = writer._extract
+        def recordThread():
+            extracting.append(threading.currentThread())
+            extract()
+        writer._extract = recordThread
+        writer.remote_write(self.makeArchive(None))
+        d = writer.remote_unpack()
+        def check(_):
+            self.assertNotIdentical(extracting[0], threading.currentThread())
+            self.assertTrue(extracting[0].getName().startswith(
+                                                    'DirectoryUpload'))
+        d.addCallback(check)
+        return d
+
+    def testCancel(self):
+        writer = transfer._DirectoryWriter(self.destdir, None, None, 0600)
+        writer.remote_write(self.makeArchive(None)[:5000])
+        writer.cancel()
+        # the extraction thread ends, and its failure is not left unhandled
+        return writer.extracted
+
 class TestStringDownload(unittest.TestCase):
     def testBasic(self):
         s = StringDownload("Hello World", "hello.txt")
@@ -407,3 +407,104 @@ class LRUCache(unittest.TestCase):
                 self.lru.get('p'))
         yield wfd
         self.check_result(wfd.getResult(), set(['P2P2']))
+
+    def test_contains(self):
+        self.assertFalse(self.lru.contains('c'))
+        d = self.lru.get('c')
+        def check(_):
+            self.assertTrue(self.lru.contains('c'))
+        d.addCallback(check)
+        return d
+
+    @defer.deferredGenerator
+    def test_add(self):
+        self.lru.add('a', short('a'))
+        self.lru.add('z', None)
+        self.assertTrue(self.lru.contains('a'))
+        self.assertFalse(self.lru.contains('z'))
+
+        # the added value is returned without calling the miss_fn
+        self.lru.miss_fn = self.long_miss_fn
+        wfd = defer.waitForDeferred(
+                self.lru.get('a'))
+        yield wfd
+        self.check_result(wfd.getResult(), short('a'), 1, 1)
+
+    def test_add_expulsion(self):
+        for c in 'abcd':
+            self.lru.add(c, short(c))
+        self.assertEqual(sorted(self.lru.cache.keys()), ['b', 'c', 'd'])
+        self.lru.inv()
+
+class SyncLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        lru.inv_failed = False
+        self.lru = lru.LRUCache(self.short_miss_fn, 3)
+
+    def tearDown(self):
+        self.assertFalse(lru.inv_failed, "invariant failed; see logs")
+
+    def short_miss_fn(self, key):
+        return short(key)
+
+    def check_counts(self, hits, misses, refhits=0):
+        self.assertEqual((self.lru.hits, self.lru.misses, self.lru.refhits),
+                         (hits, misses, refhits))
+
+    def test_single_key(self):
+        self.assertEqual(self.lru.get('a'), short('a'))
+        self.lru.miss_fn = long
+        self.assertEqual(self.lru.get('a'), short('a'))
+        self.check_counts(1, 1)
+
+    def test_lru_expulsion(self):
+        self.lru.miss_fn = long
+        for c in 'abcb':
+            self.lru.get(c)
+        # 'a' is least recently used, and is no longer referenced
+        self.lru.get('d')
+        self.assertEqual(sorted(self.lru.cache.keys()), ['b', 'c', 'd'])
+        self.lru.inv()
+
+    def test_weakrefs(self):
+        self.lru.miss_fn = long
+        a = self.lru.get('a')
+        for c in 'bcd':
+            self.lru.get(c)
+        self.assertFalse('a' in self.lru.cache)
+        self.assertIdentical(self.lru.get('a'), a)
+        self.check_counts(0, 4, 1)
+        self.assertTrue(len(self.lru.cache) <= 3)
+        self.lru.inv()
+
+    def test_miss_fn_returns_none(self):
+        self.lru.miss_fn = lambda k : None
+        self.assertEqual(self.lru.get('a'), None)
+        self.assertFalse(self.lru.contains('a'))
+
+    def test_miss_fn_exception(self):
+        def fail(k):
+            raise IndexError(k)
+        self.lru.miss_fn = fail
+        self.assertRaises(IndexError, lambda : self.lru.get('a'))
+        self.check_counts(0, 1)
+
+    def test_keys(self):
+        a = self.lru.get('a')
+        self.lru.set_max_size(1)
+        self.lru.get('b')
+        # 'a' is still live, so its key is kept
+        self.assertEqual(a, short('a'))
+        self.assertEqual(sorted(self.lru.keys()), ['a', 'b'])
+
+    def test_values(self):
+        a = self.lru.get('a')
+        self.lru.set_max_size(1)
+        b = self.lru.get('b')
+        self.assertEqual(sorted(self.lru.values()), sorted([a, b]))
+
+    def test_add_not_fetched(self):
+        self.lru.add('a', short('a'), fetched=False)
+        self.assertEqual(self.lru.get('a'), short('a'))
+        self.check_counts(1, 0)
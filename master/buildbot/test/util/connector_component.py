@@ -29,6 +29,7 @@ class ConnectorComponentMixin(db.RealDatabaseMixin):
 
     @ivar db: fake database connector
     @ivar db.pool: DB thread pool
+    @ivar db.read_pool: DB thread pool for read-only queries (same as db.pool)
     @ivar db.model: DB model
     """
     def setUpConnectorComponent(self, table_names=[], basedir='basedir'):
@@ -36,7 +37,7 @@ class ConnectorComponentMixin(db.RealDatabaseMixin):
         d = self.setUpRealDatabase(table_names=table_names, basedir=basedir)
         def finish_setup(_):
             self.db = FakeDBConnector()
-            self.db.pool = self.db_pool
+            self.db.pool = self.db.read_pool = self.db_pool
             self.db.model = model.Model(self.db)
             self.db.master = fakemaster.make_master()
         d.addCallback(finish_setup)
@@ -48,6 +49,7 @@ class ConnectorComponentMixin(db.RealDatabaseMixin):
             self.db_pool.shutdown()
             # break some reference loops, just for fun
             del self.db.pool
+            del self.db.read_pool
             del self.db.model
             del self.db
         d.addCallback(finish_cleanup)
@@ -20,7 +20,232 @@ from twisted.internet import defer
 from collections import deque
 from buildbot.util.bbcollections import defaultdict
 
-class AsyncLRUCache(object):
+class LRUCache(object):
+    """
+
+    A least-recently-used cache, with a fixed maximum size.  This is the
+    synchronous version of L{AsyncLRUCache}: the C{miss_fn} returns the value
+    directly, and C{get} returns it directly.  It is suited to objects that
+    are loaded synchronously, such as build status objects.
+
+    All values are also stored in a weak valued dictionary, even after they
+    have expired from the cache; see L{AsyncLRUCache}.  If the result of the
+    C{miss_fn} is C{None}, then the value is not cached.
+
+    @ivar hits: cache hits so far
+    @ivar refhits: cache misses found in the weak ref dictionary, so far
+    @ivar misses: cache misses leading to re-fetches, so far
+    @ivar max_size: maximum allowed size of the cache
+    """
+
+    __slots__ = ('max_size max_queue miss_fn '
+                 'queue cache weakrefs refcount '
+                 'hits refhits misses'.split())
+    sentinel = object()
+    QUEUE_SIZE_FACTOR = 10
+
+    def __init__(self, miss_fn, max_size=50):
+        """
+        Constructor.
+
+        @param miss_fn: function to call, with key as parameter, for cache
+        misses.
+
+        @param max_size: maximum number of objects in the cache
+        """
+        self.miss_fn = miss_fn
+        self.max_size = max_size
+        self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
+        self.queue = deque()
+        self.cache = {}
+        self.weakrefs = WeakValueDictionary()
+        self.hits = self.misses = self.refhits = 0
+        self.refcount = defaultdict(lambda : 0)
+
+    def get(self, key, **miss_fn_kwargs):
+        """
+        Fetch a value from the cache by key, invoking C{self.miss_fn(key)} if
+        the key is not in the cache.  Any additional keyword arguments are
+        passed to the C{miss_fn}, as for L{AsyncLRUCache.get}.  Exceptions
+        from the C{miss_fn} are propagated to the caller.
+
+        @param key: cache key
+        @param **miss_fn_kwargs: keyword arguments to  the miss_fn
+        @returns: value
+        """
+        try:
+            result = self.cache[key]
+            self.hits += 1
+            self._ref_key(key)
+            return result
+        except KeyError:
+            pass
+
+        try:
+            result = self.weakrefs[key]
+            self.refhits += 1
+            self.cache[key] = result
+            self._ref_key(key)
+            self._purge()
+            return result
+        except KeyError:
+            pass
+
+        self.misses += 1
+        result = self.miss_fn(key, **miss_fn_kwargs)
+        if result is not None:
+            self.cache[key] = result
+            self.weakrefs[key] = result
+            self._ref_key(key)
+            self._purge()
+        return result
+
+    def _ref_key(self, key):
+        """Record a recent use of this key"""
+        queue = self.queue
+        refcount = self.refcount
+
+        queue.append(key)
+        refcount[key] = refcount[key] + 1
+
+        # periodically compact the queue by eliminating duplicate keys
+        # while preserving order of most recent access.  Note that this
+        # is only required when the cache does not exceed its maximum
+        # size
+        if len(queue) > self.max_queue:
+            refcount.clear()
+            queue_appendleft = queue.appendleft
+            queue_appendleft(self.sentinel)
+            for k in ifilterfalse(refcount.__contains__,
+                                    iter(queue.pop, self.sentinel)):
+                queue_appendleft(k)
+                refcount[k] = 1
+
+    def _purge(self):
+        if len(self.cache) <= self.max_size:
+            return
+
+        cache = self.cache
+        refcount = self.refcount
+        queue = self.queue
+        max_size = self.max_size
+
+        # purge least recently used entries, using refcount to count entries
+        # that appear multiple times in the queue
+        while len(cache) > max_size:
+            refc = 1
+            while refc:
+                k = queue.popleft()
+                refc = refcount[k] = refcount[k] - 1
+            del cache[k]
+            del refcount[k]
+
+    def put(self, key, value):
+        """
+        Update the cache with the given key and value, if the key is already in
+        the cache.  This is intended to be used when updated values are
+        available for an existing cached object, and does not record a
+        reference to the key.
+
+        @param key: key to update
+        @param value: new value
+        @returns: nothing
+        """
+        if key in self.cache:
+            self.cache[key] = value
+            self.weakrefs[key] = value
+        elif key in self.weakrefs:
+            self.weakrefs[key] = value
+
+    def contains(self, key):
+        """
+        Return true if a call to C{get} for this key would be satisfied
+        without invoking the C{miss_fn}: the key is in the cache or in the weak
+        reference dictionary.
+
+        @param key: key to check
+        @returns: boolean
+        """
+        return key in self.cache or key in self.weakrefs
+
+    def add(self, key, value, fetched=True):
+        """
+        Add the given key and value to the cache, as if the value had just been
+        fetched by the C{miss_fn}.  This is intended for callers that fetch
+        several values at once, and counts as a miss, unless C{fetched} is
+        false because the value was just created rather than fetched.  A value
+        of C{None} is not cached.
+
+        @param key: key to add
+        @param value: value fetched for this key
+        @param fetched: if false, do not count a miss
+        @returns: nothing
+        """
+        if value is None:
+            return
+        if fetched:
+            self.misses += 1
+        new_key = key not in self.cache
+        self.cache[key] = value
+        self.weakrefs[key] = value
+        if new_key:
+            self.queue.append(key)
+            self.refcount[key] = self.refcount[key] + 1
+            self._purge()
+
+    def keys(self):
+        """
+        Return the keys of all values available without invoking the
+        C{miss_fn}, including those found only in the weak reference
+        dictionary.
+
+        @returns: list of keys
+        """
+        return list(set(self.cache.keys()) | set(self.weakrefs.keys()))
+
+    def values(self):
+        """
+        Return all values available without invoking the C{miss_fn}, including
+        those found only in the weak reference dictionary.
+
+        @returns: list of values
+        """
+        return self.weakrefs.values()
+
+    def set_max_size(self, max_size):
+        if self.max_size == max_size:
+            return
+
+        self.max_size = max_size
+        self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
+        self._purge()
+
+    def inv(self):
+        """Check invariants and log if they are not met; used for debugging"""
+        global inv_failed
+
+        # the keys of the queue and cache should be identical
+        cache_keys = set(self.cache.keys())
+        queue_keys = set(self.queue)
+        if queue_keys - cache_keys:
+            log.msg("INV: uncached keys in queue:", queue_keys - cache_keys)
+            inv_failed = True
+        if cache_keys - queue_keys:
+            log.msg("INV: unqueued keys in cache:", cache_keys - queue_keys)
+            inv_failed = True
+
+        # refcount should always represent the number of times each key appears
+        # in the queue
+        exp_refcount = dict()
+        for k in self.queue:
+            exp_refcount[k] = exp_refcount.get(k, 0) + 1
+        if exp_refcount != self.refcount:
+            log.msg("INV: refcounts differ:")
+            log.msg(" expected:", sorted(exp_refcount.items()))
+            log.msg("      got:", sorted(self.refcount.items()))
+            inv_failed = True
+
+class AsyncLRUCache(LRUCache):
     """
 
     A least-recently-used cache, with a fixed maximum size.  This cache is
@@ -50,11 +275,7 @@ class AsyncLRUCache(object):
     @ivar max_size: maximum allowed size of the cache
     """
 
-    __slots__ = ('max_size max_queue miss_fn '
-                 'queue cache weakrefs refcount concurrent '
-                 'hits refhits misses'.split())
-    sentinel = object()
-    QUEUE_SIZE_FACTOR = 10
+    __slots__ = ('concurrent',)
 
     def __init__(self, miss_fn, max_size=50):
         """
@@ -65,15 +286,8 @@ class AsyncLRUCache(object):
 
         @param max_size: maximum number of objects in the cache
         """
-        self.miss_fn = miss_fn
-        self.max_size = max_size
-        self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
-        self.queue = deque()
-        self.cache = {}
-        self.weakrefs = WeakValueDictionary()
+        LRUCache.__init__(self, miss_fn, max_size)
         self.concurrent = {}
-        self.hits = self.misses = self.refhits = 0
-        self.refcount = defaultdict(lambda : 0)
 
     def get(self, key, **miss_fn_kwargs):
         """
@@ -93,39 +307,19 @@ class AsyncLRUCache(object):
         """
         cache = self.cache
         weakrefs = self.weakrefs
-        refcount = self.refcount
         concurrent = self.concurrent
-        queue = self.queue
-
-        # utility function to record recent use of this key
-        def ref_key():
-            queue.append(key)
-            refcount[key] = refcount[key] + 1
-
-            # periodically compact the queue by eliminating duplicate keys
-            # while preserving order of most recent access.  Note that this
-            # is only required when the cache does not exceed its maximum
-            # size
-            if len(queue) > self.max_queue:
-                refcount.clear()
-                queue_appendleft = queue.appendleft
-                queue_appendleft(self.sentinel)
-                for k in ifilterfalse(refcount.__contains__,
-                                        iter(queue.pop, self.sentinel)):
-                    queue_appendleft(k)
-                    refcount[k] = 1
 
         try:
             result = cache[key]
             self.hits += 1
-            ref_key()
+            self._ref_key(key)
             return defer.succeed(result)
         except KeyError:
             try:
                 result = weakrefs[key]
                 self.refhits += 1
                 cache[key] = result
-                ref_key()
+                self._ref_key(key)
                 return defer.succeed(result)
             except KeyError:
                 # if there's already a fetch going on, add
@@ -154,7 +348,7 @@ class AsyncLRUCache(object):
 
                 # reference the key once, possibly standing in for multiple
                 # concurrent accesses
-                ref_key()
+                self._ref_key(key)
 
             self.inv()
             self._purge()
@@ -175,74 +369,17 @@ class AsyncLRUCache(object):
 
         return d
 
-    def _purge(self):
-        if len(self.cache) <= self.max_size:
-            return
-
-        cache = self.cache
-        refcount = self.refcount
-        queue = self.queue
-        max_size = self.max_size
-
-        # purge least recently used entries, using refcount to count entries
-        # that appear multiple times in the queue
-        while len(cache) > max_size:
-            refc = 1
-            while refc:
-                k = queue.popleft()
-                refc = refcount[k] = refcount[k] - 1
-            del cache[k]
-            del refcount[k]
-
-    def put(self, key, value):
+    def contains(self, key):
         """
-        Update the cache with the given key and value, if the key is already in
-        the cache.  This is intended to be used when updated values are
-        available for an existing cached object, and does not record a
-        reference to the key.
+        Return true if a call to C{get} for this key would be satisfied
+        without invoking the C{miss_fn}: the key is in the cache, in the weak
+        reference dictionary, or currently being fetched.
 
-        @param key: key to update
-        @param value: new value
-        @returns: nothing
+        @param key: key to check
+        @returns: boolean
         """
-        if key in self.cache:
-            self.cache[key] = value
-            self.weakrefs[key] = value
-        elif key in self.weakrefs:
-            self.weakrefs[key] = value
-
-    def set_max_size(self, max_size):
-        if self.max_size == max_size:
-            return
-
-        self.max_size = max_size
-        self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
-        self._purge()
-
-    def inv(self):
-        """Check invariants and log if they are not met; used for debugging"""
-        global inv_failed
-
-        # the keys of the queue and cache should be identical
-        cache_keys = set(self.cache.keys())
-        queue_keys = set(self.queue)
-        if queue_keys - cache_keys:
-            log.msg("INV: uncached keys in queue:", queue_keys - cache_keys)
-            inv_failed = True
-        if cache_keys - queue_keys:
-            log.msg("INV: unqueued keys in cache:", cache_keys - queue_keys)
-            inv_failed = True
-
-        # refcount should always represent the number of times each key appears
-        # in the queue
-        exp_refcount = dict()
-        for k in self.queue:
-            exp_refcount[k] = exp_refcount.get(k, 0) + 1
-        if exp_refcount != self.refcount:
-            log.msg("INV: refcounts differ:")
-            log.msg(" expected:", sorted(exp_refcount.items()))
-            log.msg("      got:", sorted(self.refcount.items()))
-            inv_failed = True
+        return (key in self.cache or key in self.weakrefs
+                or key in self.concurrent)
 
 # for tests
 inv_failed = False
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""%prog [options]
+
+Compares the on-disk build formats (see buildbot.status.buildstore) on a set
+of synthetic builds: the time taken to save them, to load them as the history
+displays do (without their steps), and to load them completely, along with
+the space they take on disk.
+"""
+
+import os, time, shutil, tempfile
+
+def makeBuilds(basedir, count, steps):
+    from buildbot.status.builder import BuilderStatus
+    from buildbot.sourcestamp import SourceStamp
+    from buildbot.changes.changes import Change
+
+    builder = BuilderStatus('bench')
+    builder.basedir = basedir
+    builder.master = None
+    builder.nextBuildNumber = 0
+    builds = []
+    for number in range(count):
+        b = builder.newBuild()
+        changes = [ Change('dev%d' % (number % 7), ['src/file%d.c' % i],
+                           'change %d' % number, revision=str(number))
+                    for i in range(3) ]
+        b.setSourceStamp(SourceStamp(branch='trunk', revision=str(number),
+                                     changes=changes))
+        b.setReason('scheduler')
+        b.setBlamelist([ c.who for c in changes ])
+        b.setSlavename('slave%d' % (number % 5))
+        b.setProperty('buildnumber', number, 'Build')
+        b.setProperty('got_revision', str(number), 'Source')
+        b.started = 1000.0 + number
+        for i in range(steps):
+            s = b.addStepWithName('step%d' % i)
+            s.started = b.started + i
+            s.setText([ 'step%d' % i ])
+            s.setText2([ 'step%d' % i ])
+            s.stepFinished(0)
+        b.setText([ 'build', 'successful' ])
+        b.setResults(0)
+        b.finished = b.started + steps
+        builds.append(b)
+    return builder, builds
+
+def bench(format, count, steps):
+    basedir = tempfile.mkdtemp()
+    try:
+        builder, builds = makeBuilds(basedir, count, steps)
+        builder.setBuildStatusFormat(format)
+
+        start = time.time()
+        for b in builds:
+            b.saveYourself()
+        save = time.time() - start
+
+        size = sum(os.path.getsize(os.path.join(basedir, f))
+                   for f in os.listdir(basedir) if f.isdigit())
+
+        start = time.time()
+        for b in builds:
+            builder._loadBuild(b.number).getText()
+        load = time.time() - start
+
+        start = time.time()
+        for b in builds:
+            builder._loadBuild(b.number).getSteps()
+        load_steps = time.time() - start
+    finally:
+        shutil.rmtree(basedir)
+    return save, load, load_steps, size
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    from buildbot.status import buildstore
+
+    parser = OptionParser(__doc__)
+    parser.add_option("-n", "--builds", dest="builds", type="int",
+            default=2000, help="number of builds (default 2000)")
+    parser.add_option("-s", "--steps", dest="steps", type="int",
+            default=10, help="number of steps per build (default 10)")
+    options, args = parser.parse_args()
+
+    print "%d builds of %d steps" % (options.builds, options.steps)
+    print "%-8s %9s %9s %11s %11s" % ("format", "save", "load",
+                                      "load+steps", "bytes")
+    for format in buildstore.FORMATS:
+        save, load, load_steps, size = bench(format, options.builds,
+                                             options.steps)
+        print "%-8s %8.2fs %8.2fs %10.2fs %11d" % (format, save, load,
+                                                   load_steps, size)
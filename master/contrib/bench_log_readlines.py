@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""%prog [options]
+
+Measures the peak memory used to read the lines of a large synthetic log, by
+joining its text and splitting it (as LogFile.readlines used to do) and by
+iterating over LogFile.readlines.  Each method runs in its own process, so
+that their peak resident set sizes can be compared.
+"""
+
+import os, sys, time, resource, shutil, tempfile, subprocess, cPickle
+
+class FakeStep:
+    class build:
+        class builder:
+            pass
+
+def makeLog(basedir, megabytes):
+    from buildbot.status.logfile import LogFile
+
+    FakeStep.build.builder.basedir = basedir
+    log = LogFile(FakeStep, 'stdio', 'log')
+    line = "gcc -c -O2 -Wall src/module.c -o build/module.o # warning: x\n"
+    chunk = line * 1000
+    for i in range(megabytes * 1024 * 1024 / len(chunk)):
+        log.addStdout(chunk)
+        log.addStderr(line)
+    log.finish()
+    cPickle.dump(log, open(os.path.join(basedir, 'log.pickle'), 'wb'))
+
+def readLines(basedir, method):
+    from buildbot.status.logfile import STDOUT, STDERR
+
+    FakeStep.build.builder.basedir = basedir
+    log = cPickle.load(open(os.path.join(basedir, 'log.pickle'), 'rb'))
+    log.step = FakeStep
+    start = time.time()
+    count = 0
+    if method == 'split':
+        for line in log.getText().split("\n"):
+            count += 1
+    else:
+        for line in log.readlines(channels=[STDOUT, STDERR]):
+            count += 1
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%d %f %d" % (count, elapsed, maxrss)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        readLines(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = OptionParser(__doc__)
+    parser.add_option("-m", "--megabytes", dest="megabytes", type="int",
+            default=200, help="size of the log in MB (default 200)")
+    options, args = parser.parse_args()
+
+    basedir = tempfile.mkdtemp()
+    try:
+        makeLog(basedir, options.megabytes)
+        print "%dMB log" % options.megabytes
+        print "%-10s %10s %9s %14s" % ("method", "lines", "time",
+                                       "peak RSS (kB)")
+        for method in 'split', 'readlines':
+            output = subprocess.Popen(
+                    [sys.executable, __file__, '--child', basedir, method],
+                    stdout=subprocess.PIPE).communicate()[0]
+            count, elapsed, maxrss = output.split()
+            print "%-10s %10s %8.2fs %14s" % (method, count, float(elapsed),
+                                             maxrss)
+    finally:
+        shutil.rmtree(basedir)
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+"""%prog [options] basedir [builder ...]
+
+Converts the finished builds stored in a buildmaster's builder directories to
+the given on-disk format ('records' by default, or 'pickle').  Only the named
+builder directories are converted, or all of them if none are given.  The
+buildmaster should not be running while builds are converted.
+"""
+
+if __name__ == '__main__':
+    import sys, os
+    from optparse import OptionParser
+    from buildbot.status import buildstore
+
+    parser = OptionParser(__doc__)
+    parser.add_option("-f", "--format", dest="format", default="records",
+            help="format to convert to: %s" % ", ".join(buildstore.FORMATS))
+
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("Need the buildmaster's base directory")
+    if options.format not in buildstore.FORMATS:
+        parser.error("Unknown format %r" % (options.format,))
+
+    basedir = args[0]
+    builders = args[1:]
+    if not builders:
+        builders = [ d for d in sorted(os.listdir(basedir))
+                     if os.path.exists(os.path.join(basedir, d, "builder")) ]
+
+    converted = failed = 0
+    for builder in builders:
+        builderdir = os.path.join(basedir, builder)
+        numbers = sorted(int(f) for f in os.listdir(builderdir) if f.isdigit())
+        print "converting %d builds of %s" % (len(numbers), builder)
+        for number in numbers:
+            filename = os.path.join(builderdir, "%d" % number)
+            try:
+                if buildstore.convertBuild(filename, options.format):
+                    converted += 1
+            except Exception, e:
+                print "  unable to convert build %d: %s" % (number, e)
+                failed += 1
+
+    print "converted %d builds, %d failures" % (converted, failed)
+    sys.exit(failed and 1 or 0)
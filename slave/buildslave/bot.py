@@ -17,6 +17,7 @@ import os.path
 import socket
 import sys
 import signal
+import zlib
 
 from twisted.spread import pb
 from twisted.python import log
@@ -27,7 +28,7 @@ from twisted.cred import credentials
 import buildslave
 from buildslave.pbutil import ReconnectingPBClientFactory
 from buildslave.commands import registry, base
-from buildslave import monkeypatches
+from buildslave import monkeypatches, util
 
 class UnknownCommand(pb.Error):
     pass
@@ -54,9 +55,40 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     # when the step is started
     remoteStep = None
 
+    # the version of the update protocol used with the master for the current
+    # command. With version 2, an update may be a list of (key, value) pairs,
+    # which the master handles in order, and the updates sent during a
+    # reactor turn are delivered in a single remote_update call, or in calls
+    # of about maxBatchSize bytes.
+    updateProtocol = 1
+    maxUpdateProtocol = 2
+    maxBatchSize = 256*1024
+
+    # the compression applied to the output of the current command, if the
+    # master asked for it: each stream of output is sent as a single zlib
+    # stream, flushed at the end of every update
+    updateCompression = None
+    supportedCompressions = ('zlib',)
+
+    # flow control: at most maxUnackedSize bytes, in at most
+    # maxUnackedUpdates remote_update calls, may be waiting for the master's
+    # acknowledgement. Further updates are queued, and the producers
+    # registered with registerUpdateProducer are paused until the master
+    # catches up.
+    maxUnackedSize = 1024*1024
+    maxUnackedUpdates = 16
+
     def __init__(self, name):
         #service.Service.__init__(self) # Service has no __init__ method
         self.setName(name)
+        self.pendingUpdates = []
+        self.pendingSize = 0
+        self.flushTimer = None
+        self.unackedSize = 0
+        self.unackedUpdates = 0
+        self.updateProducers = []
+        self.producersPaused = None
+        self.logCompressors = {}
 
     def __repr__(self):
         return "<SlaveBuilder '%s' at %d>" % (self.name, id(self))
@@ -104,6 +136,7 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     def lostRemoteStep(self, remotestep):
         log.msg("lost remote step")
         self.remoteStep = None
+        self._dropUpdates()
         if self.stopCommandOnShutdown:
             self.stopCommand()
 
@@ -114,13 +147,19 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         doesn't do much, but masters call it so it's still here."""
         pass
 
-    def remote_startCommand(self, stepref, stepId, command, args):
+    def remote_startCommand(self, stepref, stepId, command, args,
+                            updateProtocol=1, updateCompression=None):
         """
         This gets invoked by L{buildbot.process.step.RemoteCommand.start}, as
         part of various master-side BuildSteps, to start various commands
         that actually do the build. I return nothing. Eventually I will call
         .commandComplete() to notify the master-side RemoteCommand that I'm
         done.
+
+        Masters that support newer versions of the update protocol request
+        them with C{updateProtocol}; I use the highest version we both
+        support. With version 2, they may also ask for the command's output
+        to be compressed, by setting C{updateCompression} to 'zlib'.
         """
 
         self.activity()
@@ -133,6 +172,14 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             factory = registry.getFactory(command)
         except KeyError:
             raise UnknownCommand, "unrecognized SlaveCommand '%s'" % command
+        self.updateProtocol = min(updateProtocol, self.maxUpdateProtocol)
+        if (self.updateProtocol >= 2 and
+                updateCompression in self.supportedCompressions):
+            self.updateCompression = updateCompression
+        else:
+            self.updateCompression = None
+        self.logCompressors = {}
+        self._dropUpdates()
         self.command = factory(self, stepId, args)
 
         log.msg(" startCommand:%s [id %s]" % (command,stepId))
@@ -184,10 +231,105 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         # interoperability issues between new slaves and old masters.
         if self.remoteStep:
             update = [data, 0]
-            updates = [update]
-            d = self.remoteStep.callRemote("update", updates)
-            d.addCallback(self.ackUpdate)
-            d.addErrback(self._ackFailed, "SlaveBuilder.sendUpdate")
+            self.pendingUpdates.append((update, _updateSize(data)))
+            self.pendingSize += self.pendingUpdates[-1][1]
+            if self.updateProtocol < 2 or self.pendingSize >= self.maxBatchSize:
+                self.flushUpdates()
+            elif not self.flushTimer:
+                self.flushTimer = reactor.callLater(0, self.flushUpdates)
+
+    def flushUpdates(self, force=False):
+        """Send the updates queued by sendUpdate to the master, as far as the
+        flow control window allows, or all of them if C{force} is true."""
+        if self.flushTimer:
+            if self.flushTimer.active():
+                self.flushTimer.cancel()
+            self.flushTimer = None
+        while self.pendingUpdates and self.remoteStep:
+            if self.windowIsFull() and not force:
+                break
+            updates = []
+            size = 0
+            while self.pendingUpdates:
+                update, updateSize = self.pendingUpdates.pop(0)
+                updates.append(update)
+                size += updateSize
+                if self.updateProtocol < 2 or size >= self.maxBatchSize:
+                    break
+            self.pendingSize -= size
+            self._sendUpdates(updates, size)
+        self._checkWindow()
+
+    def compressLogData(self, logname, data):
+        """Compress some output of the current command for the stream
+        C{logname}, returning the data to send to the master."""
+        if logname not in self.logCompressors:
+            self.logCompressors[logname] = zlib.compressobj()
+        compressor = self.logCompressors[logname]
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def windowIsFull(self):
+        return (self.unackedSize >= self.maxUnackedSize or
+                self.unackedUpdates >= self.maxUnackedUpdates)
+
+    def getQueueDepth(self):
+        """Return the number of updates and bytes waiting to be sent, and the
+        number of remote_update calls and bytes waiting to be acknowledged by
+        the master."""
+        return (len(self.pendingUpdates), self.pendingSize,
+                self.unackedUpdates, self.unackedSize)
+
+    def registerUpdateProducer(self, producer):
+        """Register an L{IPushProducer} that is paused while the master is
+        not keeping up with our updates."""
+        self.updateProducers.append(producer)
+        if self.producersPaused:
+            producer.pauseProducing()
+
+    def unregisterUpdateProducer(self, producer):
+        if producer in self.updateProducers:
+            self.updateProducers.remove(producer)
+
+    def _checkWindow(self):
+        # pause the producers while updates are queued behind a full window
+        if self.windowIsFull() and self.pendingUpdates:
+            if not self.producersPaused:
+                self.producersPaused = util.now()
+                log.msg("update window full: %d updates (%d bytes) queued, "
+                        "%d calls (%d bytes) unacknowledged; pausing output"
+                        % self.getQueueDepth())
+                for producer in self.updateProducers[:]:
+                    producer.pauseProducing()
+        elif self.producersPaused:
+            log.msg("resuming output after %.1f seconds"
+                    % (util.now() - self.producersPaused))
+            self.producersPaused = None
+            for producer in self.updateProducers[:]:
+                producer.resumeProducing()
+
+    def _dropUpdates(self):
+        if self.flushTimer:
+            if self.flushTimer.active():
+                self.flushTimer.cancel()
+            self.flushTimer = None
+        self.pendingUpdates = []
+        self.pendingSize = 0
+        self._checkWindow()
+
+    def _sendUpdates(self, updates, size):
+        # the window is released when the master acknowledges the call, or
+        # when the call fails
+        self.unackedSize += size
+        self.unackedUpdates += 1
+        d = self.remoteStep.callRemote("update", updates)
+        d.addCallback(self.ackUpdate)
+        d.addErrback(self._ackFailed, "SlaveBuilder.sendUpdate")
+        d.addCallback(self._releaseWindow, size)
+
+    def _releaseWindow(self, _, size):
+        self.unackedSize -= size
+        self.unackedUpdates -= 1
+        self.flushUpdates()
 
     def ackUpdate(self, acknum):
         self.activity() # update the "last activity" timer
@@ -217,6 +359,9 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             log.msg(" but we weren't running, quitting silently")
             return
         if self.remoteStep:
+            # the updates must reach the master before the completion; the
+            # command has stopped producing, so the queue is bounded
+            self.flushUpdates(force=True)
             self.remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
             d = self.remoteStep.callRemote("complete", failure)
             d.addCallback(self.ackComplete)
@@ -230,6 +375,17 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         reactor.stop()
 
 
+def _updateSize(data):
+    # approximate size of an update on the wire, counting its strings
+    if isinstance(data, str):
+        return len(data)
+    if isinstance(data, dict):
+        data = data.values()
+    if isinstance(data, (list, tuple)):
+        return sum([ _updateSize(d) for d in data ])
+    return 0
+
+
 class Bot(pb.Referenceable, service.MultiService):
     """I represent the slave-side bot."""
     usePTY = None
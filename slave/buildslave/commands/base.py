@@ -32,7 +32,7 @@ from buildslave import util
 # this used to be a CVS $-style "Revision" auto-updated keyword, but since I
 # moved to Darcs as the primary repository, this is updated manually each
 # time this file is changed. The last cvs_ver that was here was 1.51 .
-command_version = "2.14"
+command_version = "2.17"
 
 # version history:
 #  >=1.17: commands are interruptable
@@ -63,6 +63,12 @@ command_version = "2.14"
 #  >= 2.12: SlaveShellCommand no longer accepts 'keep_stdin_open'
 #  >= 2.13: SlaveFileUploadCommand supports option 'keepstamp'
 #  >= 2.14: RemoveDirectory can delete multiple directories
+#  >= 2.15: startCommand accepts 'updateProtocol'; with protocol 2, updates
+#           may be lists of (key, value) pairs, and are sent in batches
+#  >= 2.16: startCommand accepts 'updateCompression'; with 'zlib', output sent
+#           by RunProcess may arrive as 'zlib' entries
+#  >= 2.17: uploadFile, uploadDirectory and downloadFile accept 'pipeline' and
+#           'maxblocksize'
 
 class Command:
     implements(ISlaveCommand)
@@ -13,14 +13,100 @@
 #
 # Copyright Buildbot Team Members
 
-import os, tarfile, tempfile
+import os, tarfile
 
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.internet import defer
 
 from buildslave.commands.base import Command
+from buildslave import util
 
 class TransferCommand(Command):
+    """
+    Base class for the transfer commands, which move a file in blocks.
+
+    Up to C{pipeline} blocks may be in flight at once (the 'pipeline'
+    argument, 1 by default). If the master gives a 'maxblocksize' larger than
+    'blocksize', the block size adapts to the link: it doubles while blocks
+    are acknowledged quickly, up to maxblocksize, and halves, down to
+    blocksize, when they are slow.
+    """
+
+    # blocks are sent as single PB strings, which are limited to 640k
+    MAX_BLOCKSIZE = 512*1024
+    FAST_BLOCK = 0.25
+    SLOW_BLOCK = 2.0
+
+    def setupPipeline(self, args):
+        self.pipeline = max(args.get('pipeline') or 1, 1)
+        self.minblocksize = self.blocksize
+        self.maxblocksize = min(max(args.get('maxblocksize') or 0,
+                                    self.blocksize), self.MAX_BLOCKSIZE)
+
+    def _adaptBlocksize(self, elapsed):
+        if elapsed < self.FAST_BLOCK:
+            self.blocksize = min(self.blocksize * 2, self.maxblocksize)
+        elif elapsed > self.SLOW_BLOCK:
+            self.blocksize = max(self.blocksize / 2, self.minblocksize)
+
+    def _loop(self, fire_when_done):
+        """
+        Transfer blocks with self._transferBlock until it returns True, with
+        up to self.pipeline of the Deferreds it returns outstanding, then fire
+        C{fire_when_done}.
+        """
+        self._fire_when_done = fire_when_done
+        self._outstanding = 0
+        self._filling = False
+        self._transferDone = False
+        self._transferFailure = None
+        self._fillPipeline()
+
+    def _fillPipeline(self):
+        # blocks that complete synchronously are handled by this loop rather
+        # than by recursion
+        self._filling = True
+        while (not self._transferDone and self._transferFailure is None
+               and self._outstanding < self.pipeline):
+            started = util.now(self._reactor)
+            try:
+                res = self._transferBlock()
+            except:
+                self._transferFailure = failure.Failure()
+                break
+            if res is True:
+                self._transferDone = True
+            elif res is None:
+                # nothing to transfer until the blocks in flight complete
+                break
+            else:
+                self._outstanding += 1
+                res.addCallbacks(self._blockDone, self._blockFailed,
+                                 callbackArgs=(started,))
+        self._filling = False
+
+        if self._outstanding == 0 and self._fire_when_done:
+            if self._transferFailure is not None:
+                d, self._fire_when_done = self._fire_when_done, None
+                d.errback(self._transferFailure)
+            elif self._transferDone:
+                d, self._fire_when_done = self._fire_when_done, None
+                d.callback(None)
+
+    def _blockDone(self, finished, started):
+        self._outstanding -= 1
+        if finished:
+            self._transferDone = True
+        self._adaptBlocksize(util.now(self._reactor) - started)
+        if not self._filling:
+            self._fillPipeline()
+
+    def _blockFailed(self, why):
+        self._outstanding -= 1
+        if self._transferFailure is None:
+            self._transferFailure = why
+        if not self._filling:
+            self._fillPipeline()
 
     def finished(self, res):
         if self.debug:
@@ -56,6 +142,8 @@ class SlaveFileUploadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['keepstamp']: whether to preserve file modified and accessed times
+        - ['pipeline']:  number of blocks to have in flight at once
+        - ['maxblocksize']: max size the data blocks may grow to
     """
     debug = False
 
@@ -66,6 +154,7 @@ class SlaveFileUploadCommand(TransferCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.keepstamp = args.get('keepstamp', False)
+        self.setupPipeline(args)
         self.stderr = None
         self.rc = 0
 
@@ -120,17 +209,8 @@ class SlaveFileUploadCommand(TransferCommand):
         d.addBoth(self.finished)
         return d
 
-    def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._writeBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+    def _transferBlock(self):
+        return self._writeBlock()
 
     def _writeBlock(self):
         """Write a block of data to the remote writer"""
@@ -168,6 +248,84 @@ class SlaveFileUploadCommand(TransferCommand):
         return d
 
 
+class _TarStream:
+    """
+    A file-like object from which the tar archive of a directory, compressed
+    with 'gz' or 'bz2' if requested, is read as it is created. The directory
+    is walked and its files are read a piece at a time, so only a bounded
+    amount of the archive is held in memory, however big the directory is.
+    """
+
+    BUFSIZE = 64*1024
+
+    def __init__(self, path, compress):
+        self.path = path
+        self.buffered = ''
+        self.current = None
+        if compress in ('gz', 'bz2'):
+            mode = 'w|' + compress
+        else:
+            mode = 'w|'
+        # the archive writes its output, compressed, to our write method; we
+        # only use it to add headers, and write file contents through its
+        # fileobj ourselves, as its addfile method would
+        self.archive = tarfile.open(mode=mode, fileobj=self)
+        self.pieces = self._addMember(path, '')
+
+    def write(self, data):
+        self.buffered += data
+
+    def read(self, length):
+        while len(self.buffered) < length and self.pieces is not None:
+            try:
+                self.pieces.next()
+            except StopIteration:
+                self.pieces = None
+                self.archive.close()
+        data = self.buffered[:length]
+        self.buffered = self.buffered[length:]
+        return data
+
+    def close(self):
+        self.pieces = None
+        if self.current:
+            self.current.close()
+            self.current = None
+
+    def _addMember(self, name, arcname):
+        # like TarFile.add, but yields after each header and each piece of
+        # file contents
+        tarinfo = self.archive.gettarinfo(name, arcname)
+        if tarinfo is None:
+            log.msg("tarfile: unsupported type %r" % name)
+            return
+        self.archive.addfile(tarinfo)
+        yield None
+        if tarinfo.isreg():
+            f = self.current = open(name, 'rb')
+            remaining = tarinfo.size
+            while remaining > 0:
+                data = f.read(min(self.BUFSIZE, remaining))
+                if not data:
+                    raise IOError("end of file reached")
+                self.archive.fileobj.write(data)
+                remaining -= len(data)
+                yield None
+            f.close()
+            self.current = None
+            blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+            if remainder > 0:
+                self.archive.fileobj.write(
+                        tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            self.archive.offset += blocks * tarfile.BLOCKSIZE
+        elif tarinfo.isdir():
+            for f in sorted(os.listdir(name)):
+                for piece in self._addMember(os.path.join(name, f),
+                                             os.path.join(arcname, f)):
+                    yield piece
+
+
 class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
     """
     Upload a directory from slave to build master
@@ -179,6 +337,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['compress']:  one of [None, 'bz2', 'gz']
+        - ['pipeline']:  number of blocks to have in flight at once
+        - ['maxblocksize']: max size the data blocks may grow to
     """
     debug = False
 
@@ -189,6 +349,7 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.compress = args['compress']
+        self.setupPipeline(args)
         self.stderr = None
         self.rc = 0
 
@@ -202,22 +363,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         if self.debug:
             log.msg("path: %r" % self.path)
 
-        # Create temporary archive
-        fd, self.tarname = tempfile.mkstemp()
-        fileobj = os.fdopen(fd, 'w')
-        if self.compress == 'bz2':
-            mode='w|bz2'
-        elif self.compress == 'gz':
-            mode='w|gz'
-        else:
-            mode = 'w'
-        archive = tarfile.open(name=self.tarname, mode=mode, fileobj=fileobj)
-        archive.add(self.path, '')
-        archive.close()
-        fileobj.close()
-
-        # Transfer it
-        self.fp = open(self.tarname, 'rb')
+        # the archive is created as it is sent
+        self.fp = _TarStream(self.path, self.compress)
 
         self.sendStatus({'header': "sending %s" % self.path})
 
@@ -235,7 +382,6 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
 
     def finished(self, res):
         self.fp.close()
-        os.remove(self.tarname)
         return TransferCommand.finished(self, res)
 
 
@@ -250,6 +396,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['mode']:      access mode for the new file
+        - ['pipeline']:  number of blocks to have in flight at once
+        - ['maxblocksize']: max size the data blocks may grow to
     """
     debug = False
 
@@ -260,6 +408,7 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.bytes_remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.mode = args['mode']
+        self.setupPipeline(args)
         self.stderr = None
         self.rc = 0
 
@@ -309,17 +458,8 @@ class SlaveFileDownloadCommand(TransferCommand):
         d.addBoth(self.finished)
         return d
 
-    def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._readBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+    def _transferBlock(self):
+        return self._readBlock()
 
     def _readBlock(self):
         """Read a block of data from the remote reader."""
@@ -334,12 +474,19 @@ class SlaveFileDownloadCommand(TransferCommand):
             length = self.bytes_remaining
 
         if length <= 0:
+            if self._outstanding:
+                # the reads in flight may still reach the end of the file
+                return None
             if self.stderr is None:
                 self.stderr = "Maximum filesize reached, truncating file '%s'" \
                                 % self.path
                 self.rc = 1
             return True
         else:
+            # the reads in flight are answered in order, and only the last
+            # one can be short, so reserve the requested length now
+            if self.bytes_remaining is not None:
+                self.bytes_remaining = self.bytes_remaining - length
             d = self.reader.callRemote('read', length)
             d.addCallback(self._writeData)
             return d
@@ -351,9 +498,6 @@ class SlaveFileDownloadCommand(TransferCommand):
         if len(data) == 0:
             return True
 
-        if self.bytes_remaining is not None:
-            self.bytes_remaining = self.bytes_remaining - len(data)
-            assert self.bytes_remaining >= 0
         self.fp.write(data)
         return False
 
@@ -221,6 +221,10 @@ class RunProcess:
     startTime = None
     elapsedTime = None
 
+    # True while the builder has paused us, because the master is not keeping
+    # up with our updates
+    paused = False
+
     # For scheduling future events
     _reactor = reactor
 
@@ -508,6 +512,22 @@ class RunProcess:
         for w in self.logFileWatchers:
             w.start()
 
+        self.builder.registerUpdateProducer(self)
+
+    def pauseProducing(self):
+        """
+        Stop reading the output of the child until resumeProducing is called;
+        the child blocks once its pipes are full.
+        """
+        self.paused = True
+        if self.process:
+            self.process.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.process:
+            self.process.resumeProducing()
+
     def _spawnProcess(self, processProtocol, executable, args=(), env={},
             path=None, uid=None, gid=None, usePTY=False, childFDs=None):
         """private implementation of reactor.spawnProcess, to allow use of
@@ -563,6 +583,9 @@ class RunProcess:
         """
         Send all the content in our buffers.
         """
+        if self.builder.updateProtocol >= 2:
+            self._sendBufferedEntries()
+            return
         msg = {}
         msg_size = 0
         lastlog = None
@@ -611,6 +634,53 @@ class RunProcess:
                 self.buftimer.cancel()
             self.buftimer = None
 
+    def _sendBufferedEntries(self):
+        """
+        Send all the content in our buffers as lists of (logname, data)
+        entries, in the order it was added, which the master supports with
+        version 2 of the update protocol.
+        """
+        entries = []
+        msg_size = 0
+        while self.buffered:
+            logname, data = self.buffered.popleft()
+            for chunk in self._chunkForSend(data):
+                if len(chunk) == 0: continue
+                if entries and entries[-1][0] == logname:
+                    entries[-1][1].append(chunk)
+                else:
+                    entries.append((logname, [chunk]))
+                msg_size += len(chunk)
+                if msg_size >= self.CHUNK_LIMIT:
+                    self._sendEntries(entries)
+                    entries = []
+                    msg_size = 0
+        self.buflen = 0
+        if entries:
+            self._sendEntries(entries)
+        if self.buftimer:
+            if self.buftimer.active():
+                self.buftimer.cancel()
+            self.buftimer = None
+
+    def _sendEntries(self, entries):
+        update = []
+        for logname, chunks in entries:
+            data = "".join(chunks)
+            if isinstance(logname, tuple) and logname[0] == 'log':
+                key, name = logname
+            else:
+                key, name = logname, None
+            if self.builder.updateCompression == 'zlib':
+                # ('zlib', (key, logfile name or None, compressed data))
+                data = self.builder.compressLogData(logname, data)
+                update.append(('zlib', (key, name, data)))
+            elif name is not None:
+                update.append(('log', (name, data)))
+            else:
+                update.append((key, data))
+        self.sendStatus(update)
+
     def _addToBuffers(self, logname, data):
         """
         Add data to the buffer for logname
@@ -657,6 +727,7 @@ class RunProcess:
         for w in self.logFileWatchers:
             # this will send the final updates
             w.stop()
+        self.builder.unregisterUpdateProducer(self)
         self._sendBuffers()
         if sig is not None:
             rc = -1
@@ -683,6 +754,7 @@ class RunProcess:
             log.msg("Hey, command %s finished twice" % self)
 
     def failed(self, why):
+        self.builder.unregisterUpdateProducer(self)
         self._sendBuffers()
         log.msg("RunProcess.failed: command failed: %s" % (why,))
         if self.timer:
@@ -703,6 +775,10 @@ class RunProcess:
 
     def doTimeout(self):
         self.timer = None
+        if self.paused:
+            # the child is quiet because we are not reading its output
+            self.timer = self._reactor.callLater(self.timeout, self.doTimeout)
+            return
         msg = "command timed out: %d seconds without output" % self.timeout
         self.kill(msg)
 
@@ -727,6 +803,10 @@ class RunProcess:
         msg += ", attempting to kill"
         log.msg(msg)
         self.sendStatus({'header': "\n" + msg + "\n"})
+        # the child's pipes must be read for processEnded to fire
+        self.builder.unregisterUpdateProducer(self)
+        if self.paused:
+            self.resumeProducing()
 
         # let the PP know that we are killing it, so that it can ensure that
         # the exit status comes out right
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import pprint
+import zlib
 
 class FakeSlaveBuilder:
     """
@@ -22,16 +23,32 @@ class FakeSlaveBuilder:
     showing the updates.  Set debug to True to show updates as they happen.
     """
     debug = False
+    updateProtocol = 1
+    updateCompression = None
     def __init__(self, usePTY=False, basedir="/slavebuilder/basedir"):
         self.updates = []
         self.basedir = basedir
         self.usePTY = usePTY
+        self.logCompressors = {}
 
     def sendUpdate(self, data):
         if self.debug:
             print "FakeSlaveBuilder.sendUpdate", data
         self.updates.append(data)
 
+    def compressLogData(self, logname, data):
+        # each stream gets its own zlib stream, as in the real SlaveBuilder
+        if logname not in self.logCompressors:
+            self.logCompressors[logname] = zlib.compressobj()
+        compressor = self.logCompressors[logname]
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def registerUpdateProducer(self, producer):
+        self.producer = producer
+
+    def unregisterUpdateProducer(self, producer):
+        self.producer = None
+
     def show(self):
         return pprint.pformat(self.updates)
 
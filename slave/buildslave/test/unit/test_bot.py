@@ -15,6 +15,7 @@
 
 import os
 import shutil
+import zlib
 import mock
 
 from twisted.trial import unittest
@@ -264,6 +265,87 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_startCommand_batched(self):
+        st = FakeStep()
+
+        self.patch_runprocess(
+            Expect([ 'echo', 'hello' ], os.path.join(self.basedir, 'sb', 'workdir'))
+            + { 'hdr' : 'headers' } + { 'stdout' : 'hello\n' } + { 'rc' : 0 }
+            + 0,
+        )
+
+        d = defer.succeed(None)
+        def do_start(_):
+            return self.sb.callRemote("startCommand", FakeRemote(st),
+                                      "13", "shell", dict(
+                                                command=[ 'echo', 'hello' ],
+                                                workdir='workdir',
+                                            ), updateProtocol=5)
+        d.addCallback(do_start)
+        d.addCallback(lambda _ : st.wait_for_finish())
+        def check(_):
+            self.assertEqual(self.sb.original.updateProtocol, 2)
+            self.assertEqual(st.actions, [
+                         ['update', [[{'hdr': 'headers'}, 0],
+                                     [{'stdout': 'hello\n'}, 0],
+                                     [{'rc': 0}, 0],
+                                     [{'elapsed': 1}, 0]]],
+                         ['complete', None],
+                    ])
+        d.addCallback(check)
+        return d
+
+    def test_startCommand_compressed(self):
+        st = FakeStep()
+
+        self.patch_runprocess(
+            Expect([ 'echo', 'hello' ], os.path.join(self.basedir, 'sb', 'workdir'))
+            + { 'rc' : 0 }
+            + 0,
+        )
+
+        d = defer.succeed(None)
+        def do_start(_):
+            return self.sb.callRemote("startCommand", FakeRemote(st),
+                                      "13", "shell", dict(
+                                                command=[ 'echo', 'hello' ],
+                                                workdir='workdir',
+                                            ), updateProtocol=2,
+                                            updateCompression='zlib')
+        d.addCallback(do_start)
+        d.addCallback(lambda _ : st.wait_for_finish())
+        def check(_):
+            sb = self.sb.original
+            self.assertEqual(sb.updateCompression, 'zlib')
+            data = sb.compressLogData('stdout', 'hello\n')
+            self.assertEqual(zlib.decompressobj().decompress(data), 'hello\n')
+        d.addCallback(check)
+        return d
+
+    def test_startCommand_unknown_compression(self):
+        st = FakeStep()
+
+        self.patch_runprocess(
+            Expect([ 'echo', 'hello' ], os.path.join(self.basedir, 'sb', 'workdir'))
+            + { 'rc' : 0 }
+            + 0,
+        )
+
+        d = defer.succeed(None)
+        def do_start(_):
+            return self.sb.callRemote("startCommand", FakeRemote(st),
+                                      "13", "shell", dict(
+                                                command=[ 'echo', 'hello' ],
+                                                workdir='workdir',
+                                            ), updateProtocol=2,
+                                            updateCompression='lzma')
+        d.addCallback(do_start)
+        d.addCallback(lambda _ : st.wait_for_finish())
+        def check(_):
+            self.assertEqual(self.sb.original.updateCompression, None)
+        d.addCallback(check)
+        return d
+
     def test_startCommand_interruptCommand(self):
         # set up a fake step to receive updates
         st = FakeStep()
@@ -332,6 +414,42 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_sendUpdate_window(self):
+        sb = self.sb.original
+        sb.maxUnackedUpdates = 2
+        acks = []
+        class SlowStep(FakeStep):
+            def remote_update(self, updates):
+                FakeStep.remote_update(self, updates)
+                d = defer.Deferred()
+                acks.append(d)
+                return d
+        st = SlowStep()
+        sb.remoteStep = FakeRemote(st)
+        producer = mock.Mock()
+        sb.registerUpdateProducer(producer)
+
+        for i in range(4):
+            sb.sendUpdate({'stdout' : str(i)})
+        self.assertEqual([ a[1] for a in st.actions ],
+                [ [[{'stdout' : '0'}, 0]], [[{'stdout' : '1'}, 0]] ])
+        self.assertEqual(sb.getQueueDepth(), (2, 2, 2, 2))
+        producer.pauseProducing.assert_called_with()
+
+        # each acknowledgement lets another update through
+        acks[0].callback(0)
+        self.assertEqual(len(st.actions), 3)
+        self.assertFalse(producer.resumeProducing.called)
+        acks[1].callback(0)
+        self.assertEqual(st.actions[3][1], [[{'stdout' : '3'}, 0]])
+        self.assertEqual(sb.getQueueDepth(), (0, 0, 2, 2))
+        producer.resumeProducing.assert_called_with()
+
+        acks[2].callback(0)
+        acks[3].callback(0)
+        self.assertEqual(sb.getQueueDepth(), (0, 0, 0, 0))
+        sb.unregisterUpdateProducer(producer)
+
 class TestBotFactory(unittest.TestCase):
 
     def setUp(self):
@@ -46,6 +46,20 @@ class FakeMasterMethods(object):
         self.read = False
         self.data = ''
 
+        # the most delayed writes or reads outstanding at once
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def _delay(self, result):
+        self.in_flight += 1
+        self.max_in_flight = max(self.in_flight, self.max_in_flight)
+        d = defer.Deferred()
+        def fire():
+            self.in_flight -= 1
+            d.callback(result)
+        reactor.callLater(0.01, fire)
+        return d
+
     def remote_write(self, data):
         if self.count_writes:
             self.add_update('write %d' % len(data))
@@ -57,9 +71,7 @@ class FakeMasterMethods(object):
             self.data += data
 
         if self.delay_write:
-            d = defer.Deferred()
-            reactor.callLater(0.01, d.callback, None)
-            return d
+            return self._delay(None)
 
     def remote_read(self, length):
         if self.count_reads:
@@ -73,9 +85,7 @@ class FakeMasterMethods(object):
 
         slice, self.data = self.data[:length], self.data[length:]
         if self.delay_read:
-            d = defer.Deferred()
-            reactor.callLater(0.01, d.callback, slice)
-            return d
+            return self._delay(slice)
         else:
             return slice
 
@@ -239,6 +249,60 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pipelined(self):
+        self.fakemaster.delay_write = True
+        self.fakemaster.keep_data = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=100,
+            blocksize=8,
+            keepstamp=False,
+            pipeline=4,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.fakemaster.max_in_flight, 4)
+            self.assertEqual(self.fakemaster.data,
+                             ("this is some data\n" * 10)[:100])
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datafile},
+                    'write(s)', 'close',
+                    {'rc': 1,
+                     'stderr': "Maximum filesize reached, truncating file '%s'" % self.datafile}
+                ])
+        d.addCallback(check)
+        return d
+
+    def test_adaptive_blocksize(self):
+        self.fakemaster.count_writes = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=16,
+            keepstamp=False,
+            maxblocksize=64,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            # the blocks are acknowledged immediately, so they grow
+            self.assertUpdates([
+                    {'header': 'sending %s' % self.datafile},
+                    'write 16', 'write 32', 'write 64', 'write 64', 'write 4',
+                    'close', {'rc': 0}
+                ])
+        d.addCallback(check)
+        return d
+
 class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -305,6 +369,30 @@ class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
     if sys.version_info[:2] <= (2,4):
         test_simple_bz2.skip = "bz2 stream decompression not supported on Python-2.4"
 
+    def test_tarstream(self):
+        # the archive is produced a little at a time, as it is read
+        os.makedirs(os.path.join(self.datadir, 'sub'))
+        big = ''.join([ chr(i % 251) for i in range(300*1024) ])
+        open(os.path.join(self.datadir, 'sub', 'big'), 'wb').write(big)
+        self.patch(transfer._TarStream, 'BUFSIZE', 1000)
+        stream = transfer._TarStream(self.datadir, 'gz')
+        pieces = []
+        while True:
+            data = stream.read(4096)
+            self.assertTrue(len(stream.buffered) < 4096 + 1000)
+            if not data:
+                break
+            pieces.append(data)
+        stream.close()
+
+        a = tarfile.open(fileobj=StringIO.StringIO(''.join(pieces)),
+                         mode='r:gz')
+        self.assertEqual(a.extractfile('sub/big').read(), big)
+        self.assertEqual(a.extractfile('aa').read(), "lots of a" * 100)
+        self.assertEqual(sorted(a.getnames()),
+                         [ '', 'aa', 'bb', 'sub', 'sub/big' ])
+        a.close()
+
     # this is just a subclass of SlaveUpload, so the remaining permutations
     # are already tested
 
@@ -355,6 +443,56 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pipelined(self):
+        self.fakemaster.delay_read = True
+        self.fakemaster.data = test_data = 'abcdefghij' * 10
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=16,
+            mode=None,
+            pipeline=3,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.fakemaster.max_in_flight, 3)
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+            self.assertUpdates([ 'read(s)', 'close', {'rc': 0} ])
+        d.addCallback(check)
+        return d
+
+    def test_pipelined_maxsize(self):
+        self.fakemaster.delay_read = True
+        self.fakemaster.count_reads = True
+        self.fakemaster.data = 'tenchars--' * 4
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=50,
+            blocksize=16,
+            mode=None,
+            pipeline=4,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            # the file is shorter than maxsize, so it is not truncated
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), 'tenchars--' * 4)
+            self.assertUpdates([ 'read 16', 'read 16', 'read 16', 'read 2',
+                                 'close', {'rc': 0} ])
+        d.addCallback(check)
+        return d
+
     def test_mkdir(self):
         self.fakemaster.data = test_data = 'hi'
 
@@ -18,6 +18,7 @@ import re
 import os
 import time
 import signal
+import zlib
 
 from twisted.trial import unittest
 from twisted.internet import task, defer, reactor
@@ -151,6 +152,25 @@ class TestRunProcess(BasedirMixin, unittest.TestCase):
         clock.advance(6)
         return d
 
+    def testCommandTimeoutPaused(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        s = runprocess.RunProcess(b, sleepCommand(10), self.basedir, timeout=5)
+        clock = task.Clock()
+        s._reactor = clock
+        d = s.start()
+        self.assertIdentical(b.producer, s)
+        # a child whose output we are not reading does not time out
+        s.pauseProducing()
+        clock.advance(6)
+        self.failUnless(s.deferred, b.show())
+        s.resumeProducing()
+        def check(ign):
+            self.failUnless({'rc': FATAL_RC} in b.updates, b.show())
+            self.assertEqual(b.producer, None)
+        d.addCallback(check)
+        clock.advance(6)
+        return d
+
     def testCommandMaxTime(self):
         b = FakeSlaveBuilder(False, self.basedir)
         s = runprocess.RunProcess(b, sleepCommand(10), self.basedir, maxTime=5)
@@ -505,6 +525,62 @@ class TestLogging(BasedirMixin, unittest.TestCase):
         s._sendBuffers()
         self.failUnlessEqual(len(b.updates), 2)
 
+    def testSendBufferedEntries(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.updateProtocol = 2
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'hello ')
+        s._addToBuffers('stdout', 'world')
+        s._addToBuffers('stderr', 'DIEEEEEEE')
+        s._addToBuffers(('log', 'out'), 'log')
+        s._addToBuffers('stdout', '!')
+        s._sendBuffers()
+        self.failUnlessEqual(b.updates, [
+            [ ('stdout', 'hello world'), ('stderr', 'DIEEEEEEE'),
+              ('log', ('out', 'log')), ('stdout', '!') ],
+            ], b.show())
+
+    def testSendEntriesChunked(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.updateProtocol = 2
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        data = "x" * (runprocess.RunProcess.CHUNK_LIMIT * 3 / 2)
+        s._addToBuffers('stderr', 'y')
+        s._addToBuffers('stdout', data)
+        self.failUnlessEqual(len(b.updates), 2)
+        self.failUnlessEqual(b.updates[0][0], ('stderr', 'y'))
+        self.failUnlessEqual(b.updates[1], [('stdout', "x" * (len(data) -
+                                    runprocess.RunProcess.CHUNK_LIMIT))])
+
+    def testSendEntriesCompressed(self):
+        b = FakeSlaveBuilder(False, self.basedir)
+        b.updateProtocol = 2
+        b.updateCompression = 'zlib'
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'hello ' * 100)
+        s._addToBuffers(('log', 'x.log'), 'log line\n')
+        s._sendBuffers()
+        s._addToBuffers('stdout', 'hello again\n')
+        s._sendBuffers()
+
+        decompressors = {}
+        received = []
+        wire = 0
+        for update in b.updates:
+            for key, value in update:
+                self.failUnlessEqual(key, 'zlib')
+                key, name, data = value
+                wire += len(data)
+                if (key, name) not in decompressors:
+                    decompressors[(key, name)] = zlib.decompressobj()
+                received.append((key, name,
+                                 decompressors[(key, name)].decompress(data)))
+        self.failUnlessEqual(received, [
+            ('stdout', None, 'hello ' * 100),
+            ('log', 'x.log', 'log line\n'),
+            ('stdout', None, 'hello again\n')])
+        self.failUnless(wire < 100, wire)
+
     def testSendNotimeout(self):
         b = FakeSlaveBuilder(False, self.basedir)
         s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)